@@ -0,0 +1,43 @@
+"""
+Compare the speed of the order statistics rolling quantile used in robust_vol_calc
+against pd.rolling_quantile, on 40 years of daily vol for many instruments
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from syscore.algos import rolling_quantile, robust_vol_calc
+
+number_of_days = 40 * 256
+number_of_instruments = 50
+
+index = pd.date_range("1976-01-01", periods=number_of_days, freq="B")
+returns = pd.DataFrame(np.random.standard_t(4, (number_of_days, number_of_instruments)),
+                       index=index)
+vol = pd.ewmstd(returns, span=35, min_periods=10)
+
+start = time.time()
+old_results = [pd.rolling_quantile(vol[column], 500, 0.05, 100)
+               for column in vol.columns]
+print("pd.rolling_quantile, one instrument at a time: %.2f seconds" % (time.time() - start))
+
+start = time.time()
+new_results = [rolling_quantile(vol[column], 500, 0.05, 100)
+               for column in vol.columns]
+print("rolling_quantile, one instrument at a time: %.2f seconds" % (time.time() - start))
+
+start = time.time()
+batch_results = rolling_quantile(vol, 500, 0.05, 100)
+print("rolling_quantile, all instruments in one batch: %.2f seconds" % (time.time() - start))
+
+for (column, old_result) in zip(vol.columns, old_results):
+    assert old_result.equals(batch_results[column])
+
+start = time.time()
+vols = [robust_vol_calc(returns[column]) for column in returns.columns]
+print("robust_vol_calc, one instrument at a time: %.2f seconds" % (time.time() - start))
+
+start = time.time()
+vols = robust_vol_calc(returns)
+print("robust_vol_calc, all instruments in one batch: %.2f seconds" % (time.time() - start))
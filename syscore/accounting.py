@@ -10,12 +10,13 @@ from pandas.tseries.offsets import BDay
 import numpy as np
 from scipy.stats import skew, ttest_rel, ttest_1samp
 import scipy.stats as stats
-import random
+import warnings
 
-from syscore.algos import robust_vol_calc
+from syscore.algos import returns_volatility_from_config
 from syscore.pdutils import  drawdown
 from syscore.dateutils import BUSINESS_DAYS_IN_YEAR, ROOT_BDAYS_INYEAR, WEEKS_IN_YEAR, ROOT_WEEKS_IN_YEAR
 from syscore.dateutils import MONTHS_IN_YEAR, ROOT_MONTHS_IN_YEAR
+from systems.defaults import system_defaults
 
 """
 some defaults
@@ -24,6 +25,17 @@ DEFAULT_CAPITAL = 10000000.0
 DEFAULT_ANN_RISK_TARGET = 0.16
 DEFAULT_DAILY_CAPITAL=DEFAULT_CAPITAL * DEFAULT_ANN_RISK_TARGET / ROOT_BDAYS_INYEAR
 
+## how we resample returns for each frequency of account curve (daily is done when the curve is created)
+FREQ_RESAMPLE_RULES=dict(W="W", M="MS", Y="A")
+
+## statistics shown by accountCurveSingleElementOneFreq.stats(); account_curve_stats does all of them at once
+ACCOUNT_STATS_LIST = ["min", "max", "median", "mean", "std", "skew",
+                      "ann_mean", "ann_std", "sharpe", "sortino",
+                      "avg_drawdown", "time_in_drawdown",
+                      "calmar", "avg_return_to_drawdown",
+                      "avg_loss", "avg_gain", "gaintolossratio", "profitfactor", "hitrate",
+                      "t_stat", "p_value"]
+
 
 def account_test(ac1, ac2):
     """
@@ -45,10 +57,9 @@ def account_test(ac1, ac2):
     ac2_common=ac2.cumsum().reindex(common_ts, method="ffill").diff().values
     
     
-    missing_values=[idx for idx in range(len(common_ts)) 
-                    if (np.isnan(ac1_common[idx]) or np.isnan(ac2_common[idx]))]
-    ac1_common=[ac1_common[idx] for idx in range(len(common_ts)) if idx not in missing_values]
-    ac2_common=[ac2_common[idx] for idx in range(len(common_ts)) if idx not in missing_values]
+    both_present=~(np.isnan(ac1_common) | np.isnan(ac2_common))
+    ac1_common=ac1_common[both_present]
+    ac2_common=ac2_common[both_present]
 
     ac1_common=ac1_common/np.nanstd(ac1_common)
     ac2_common=ac2_common/np.nanstd(ac2_common)
@@ -233,7 +244,7 @@ def get_positions_from_forecasts(price, get_daily_returns_volatility, forecast,
     :type capital: float or None or pd.Series aligned to forecast
 
 
-    **kwargs: passed to vol calculation
+    **kwargs: override the default volatility_calculation config (eg func, days)
 
     :returns: Tx1 pd dataframe of positions
 
@@ -244,7 +255,10 @@ def get_positions_from_forecasts(price, get_daily_returns_volatility, forecast,
             "forecast")
 
     if get_daily_returns_volatility is None:
-        get_daily_returns_volatility = robust_vol_calc(price.diff(), **kwargs)
+        volconfig = copy(system_defaults['volatility_calculation'])
+        volconfig.update(kwargs)
+        get_daily_returns_volatility = returns_volatility_from_config(
+            price.diff(), volconfig)
 
     """
     Herein the proof why this position calculation is correct (see chapters
@@ -276,6 +290,113 @@ def get_positions_from_forecasts(price, get_daily_returns_volatility, forecast,
     return positions
 
     
+def account_curve_stats(returns, returns_scalar=BUSINESS_DAYS_IN_YEAR, vol_scalar=ROOT_BDAYS_INYEAR, 
+                        present=None):
+    """
+    Work out all the statistics in ACCOUNT_STATS_LIST for a number of account curves at once
+
+    Each statistic is the same as the accountCurveSingleElementOneFreq method with the same name, 
+    except that we return nan rather than raising an exception if there is nothing to work it out from.
+
+    :param returns: returns, one column for each curve. Missing values are ignored
+    :type returns: TxN np.array, or 1-dim for a single curve
+
+    :param returns_scalar: Multiply mean returns by this to annualise
+    :type returns_scalar: float
+
+    :param vol_scalar: Multiply standard deviations by this to annualise
+    :type vol_scalar: float
+
+    :param present: Which rows are part of each curve, if they've been aligned to a common index. 
+                    Missing values inside a curve still count towards drawdowns. None if all rows are.
+    :type present: TxN np.array of bool, or None
+
+    :returns: dict of np.array, each of length N
+
+    >>> returns=np.array([[1.0, 2.0], [-2.0, np.nan], [3.0, -1.0], [np.nan, 0.5]])
+    >>> ans=account_curve_stats(returns, returns_scalar=1.0, vol_scalar=1.0)
+    >>> np.allclose(ans["mean"], [2.0/3.0, 0.5])
+    True
+    >>> np.allclose(ans["avg_drawdown"], [-0.5, -0.375])
+    True
+    >>> list(ans["hitrate"])==[2.0/3.0, 2.0/3.0]
+    True
+    """
+    returns=np.array(returns, dtype=float)
+    if returns.ndim==1:
+        returns=returns[:, np.newaxis]
+
+    if present is None:
+        present=np.ones(returns.shape, dtype=bool)
+
+    valid=~np.isnan(returns)
+    zeroed=np.where(valid, returns, 0.0)
+    count=valid.sum(axis=0).astype(float)
+    
+    is_gain=zeroed>0.0
+    is_loss=zeroed<0.0
+    gain_count=is_gain.sum(axis=0).astype(float)
+    loss_count=is_loss.sum(axis=0).astype(float)
+    gain_sum=np.where(is_gain, zeroed, 0.0).sum(axis=0)
+    loss_sum=np.where(is_loss, zeroed, 0.0).sum(axis=0)
+
+    ## curves are cumulated and forward filled, so only missing values before the start are left out of drawdowns
+    started=np.logical_or.accumulate(valid, axis=0) & present
+    curve=np.where(started, np.cumsum(zeroed, axis=0), np.nan)
+    drawdowns=curve - np.fmax.accumulate(curve, axis=0)
+    drawdown_count=started.sum(axis=0).astype(float)
+
+    ans=dict()
+    with np.errstate(divide="ignore", invalid="ignore"), warnings.catch_warnings():
+        ## all nan slices
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+
+        ans["min"]=np.nanmin(returns, axis=0)
+        ans["max"]=np.nanmax(returns, axis=0)
+        ans["median"]=np.nanmedian(returns, axis=0)
+
+        mean=zeroed.sum(axis=0) / count
+        demeaned=np.where(valid, returns - mean, 0.0)
+        moment2=(demeaned**2).sum(axis=0) / count
+        moment3=(demeaned**3).sum(axis=0) / count
+        std=(moment2 * count / (count - 1.0))**.5
+
+        ans["mean"]=mean
+        ans["std"]=std
+        ## as scipy, skew is nan when all the values are (to within rounding) the same
+        zero_variance=moment2 <= (np.finfo(float).eps * mean)**2
+        ans["skew"]=np.where(zero_variance, np.nan, moment3 / moment2**1.5)
+
+        ann_mean=mean * returns_scalar
+        ann_std=std * vol_scalar
+        ans["ann_mean"]=ann_mean
+        ans["ann_std"]=ann_std
+        ans["sharpe"]=np.where(ann_std==0.0, np.nan, ann_mean / ann_std)
+
+        avg_loss=loss_sum / loss_count
+        avg_gain=gain_sum / gain_count
+        loss_std=(np.where(is_loss, zeroed - avg_loss, 0.0)**2).sum(axis=0) / loss_count
+        ans["sortino"]=ann_mean / (loss_std**.5 * vol_scalar)
+        ans["avg_loss"]=avg_loss
+        ans["avg_gain"]=avg_gain
+        ans["gaintolossratio"]=avg_gain / -avg_loss
+        ## not -loss_sum; with no losses that's -0.0, and we'd get -inf
+        ans["profitfactor"]=gain_sum / (0.0 - loss_sum)
+        ans["hitrate"]=gain_count / (gain_count + loss_count)
+
+        avg_drawdown=np.where(started, drawdowns, 0.0).sum(axis=0) / drawdown_count
+        worst_drawdown=np.where(drawdown_count>0, np.where(started, drawdowns, np.inf).min(axis=0), np.nan)
+        ans["avg_drawdown"]=avg_drawdown
+        ans["time_in_drawdown"]=(started & (drawdowns < 0.0)).sum(axis=0) / drawdown_count
+        ans["calmar"]=ann_mean / -worst_drawdown
+        ans["avg_return_to_drawdown"]=ann_mean / -avg_drawdown
+
+        t_stat=mean / (std / count**.5)
+        ans["t_stat"]=t_stat
+        ans["p_value"]=2.0 * stats.t.sf(np.abs(t_stat), count - 1.0)
+
+    return ans
+
 def percent(accurve):
     """
     Takes any account curve object
@@ -504,18 +625,10 @@ class accountCurveSingleElementOneFreq(pd.Series):
 
     def stats(self):
 
-        stats_list = ["min", "max", "median", "mean", "std", "skew",
-                      "ann_mean", "ann_std", "sharpe", "sortino",
-                      "avg_drawdown", "time_in_drawdown",
-                      "calmar", "avg_return_to_drawdown",
-                      "avg_loss", "avg_gain", "gaintolossratio", "profitfactor", "hitrate",
-                      "t_stat", "p_value"]
+        ## all at once, rather than going through the returns for each statistic
+        all_stats = account_curve_stats(self.values, self._returns_scalar, self._vol_scalar)
 
-        build_stats = []
-        for stat_name in stats_list:
-            stat_method = getattr(self, stat_name)
-            ans = stat_method()
-            build_stats.append((stat_name, "{0:.4g}".format(ans)))
+        build_stats = [(stat_name, "{0:.4g}".format(all_stats[stat_name][0])) for stat_name in ACCOUNT_STATS_LIST]
 
         comment1 = ("You can also plot / print:", [
                     "rolling_ann_std", "drawdown", "curve", "percent", "cumulative"])
@@ -555,16 +668,44 @@ class accountCurveSingleElement(accountCurveSingleElementOneFreq):
         """
         ## We often want to use  
         daily_returns = returns_df.resample("1B", how="sum")
-        weekly_returns=returns_df.resample("W", how="sum")
-        monthly_returns=returns_df.resample("MS", how="sum")
-        annual_returns=returns_df.resample("A", how="sum")
         
         super().__init__(daily_returns, capital, frequency="D",  weighted_flag=weighted_flag)
 
-        setattr(self, "daily", accountCurveSingleElementOneFreq(daily_returns, capital, frequency="D", weighted_flag=weighted_flag))
-        setattr(self, "weekly", accountCurveSingleElementOneFreq(weekly_returns, capital, frequency="W",  weighted_flag=weighted_flag))
-        setattr(self, "monthly", accountCurveSingleElementOneFreq(monthly_returns, capital, frequency="M", weighted_flag=weighted_flag))
-        setattr(self, "annual", accountCurveSingleElementOneFreq(annual_returns, capital, frequency="Y",  weighted_flag=weighted_flag))
+        ## Other frequencies are only resampled if someone asks for them; most curves only ever get used daily
+        setattr(self, "_unresampled_returns", returns_df)
+
+    @property
+    def daily(self):
+        return self._freq_view("D")
+
+    @property
+    def weekly(self):
+        return self._freq_view("W")
+
+    @property
+    def monthly(self):
+        return self._freq_view("M")
+
+    @property
+    def annual(self):
+        return self._freq_view("Y")
+
+    def _freq_view(self, frequency):
+        # we cache these, so they're only resampled once
+        cache_name = "_freq_view_%s" % frequency
+        if hasattr(self, cache_name):
+            return getattr(self, cache_name)
+
+        if frequency == "D":
+            freq_returns = self._returns_df
+        else:
+            freq_returns = self._unresampled_returns.resample(FREQ_RESAMPLE_RULES[frequency], how="sum")
+
+        freq_view = accountCurveSingleElementOneFreq(freq_returns, self.capital, frequency=frequency,
+                                                     weighted_flag=self.weighted_flag)
+        setattr(self, cache_name, freq_view)
+
+        return freq_view
 
     def __repr__(self):
         return super().__repr__()+ "\n Use object.freq.method() to access periods (freq=daily, weekly, monthly, annual) default: daily"
@@ -938,6 +1079,301 @@ def resolve_capital(ts_to_scale_to, capital=None, ann_risk_target=None):
     
     return (base_capital, ann_risk, daily_risk_capital)
 
+## arguments account_curves_from_panel knows how to put in a panel; anything else is done one curve at a time
+PANEL_PANDL_ARGS=["price", "positions", "forecast", "get_daily_returns_volatility", "fx", 
+                  "value_of_price_point", "SR_cost", "cash_costs"]
+
+def pandl_panel(prices, positions, fx=None, value_of_price_point=None, present=None,
+                delayfill=True, roundpositions=False, SR_cost=None, ann_risk=None, cash_costs=None):
+    """
+    Calculate pandl and costs for N instruments at once, from positions
+    
+    Gives the same answers as pandl_with_data (with positions aligned to price) followed by calc_costs, 
+    for each instrument, but all in one go
+    
+    Instruments can have different indices; rows that aren't in the index of an instrument are False in present,
+      and will be nan in everything returned
+
+    :param prices: prices
+    :type prices: TxN np.array
+
+    :param positions: positions, aligned to prices
+    :type positions: TxN np.array
+
+    :param fx: fx rates, aligned to prices and forward filled (as pandl_with_data does). None for 1.0
+    :type fx: TxN np.array or None
+
+    :param value_of_price_point: value of one unit movement in price of each instrument. None for 1.0
+    :type value_of_price_point: list or np.array length N, or None
+
+    :param present: Is each row in the index for each instrument? None means all rows are
+    :type present: TxN np.array of bool, or None
+
+    :param delayfill: should we delay fills?
+    :type delayfill: bool
+
+    :param roundpositions: should we round positions when calculating trades?
+    :type roundpositions: bool
+
+    :param SR_cost: Cost in annualised Sharpe Ratio units for each instrument, nan if not using SR costs
+    :type SR_cost: list or np.array length N, or None
+
+    :param ann_risk: Capital at risk on annualised basis, needed for SR costs
+    :type ann_risk: TxN np.array or None
+
+    :param cash_costs: value_total_per_block, value_of_pertrade_commission, percentage_cost for each instrument,
+                        nan if not using cash costs. SR costs are used if an instrument has both.
+    :type cash_costs: Nx3 np.array or None
+
+    :returns: dict of TxN np.arrays: cum_trades, trades_to_use, instr_ccy_returns, base_ccy_returns, 
+                 costs_instr_ccy, costs_base_ccy (minus numbers are losses)
+
+    >>> prices=np.array([[10.0, 50.0], [11.0, np.nan], [12.0, 52.0], [11.0, 51.0]])
+    >>> positions=np.array([[1.0, 1.0], [1.0, np.nan], [2.0, 1.0], [2.0, 1.0]])
+    >>> present=np.array([[True, True], [True, False], [True, True], [True, True]])
+    >>> pandl_panel(prices, positions, present=present, delayfill=False)["base_ccy_returns"]
+    array([[ nan,  nan],
+           [ nan,  nan],
+           [  1.,  nan],
+           [ -2.,  -1.]])
+    """
+    prices=np.array(prices, dtype=float)
+    (no_rows, no_instruments)=prices.shape
+    
+    if present is None:
+        present=np.ones(prices.shape, dtype=bool)
+
+    if fx is None:
+        fx=np.ones(prices.shape)
+
+    if value_of_price_point is None:
+        value_of_price_point=np.ones(no_instruments)
+    value_of_price_point=np.array(value_of_price_point, dtype=float)[np.newaxis, :]
+
+    ## everything that pandas does on each instruments own index, we do using the previous row in the index
+    previous_row=_previous_present_row(present)
+    
+    use_positions=np.where(present, np.array(positions, dtype=float), np.nan)
+    if roundpositions:
+        use_positions=np.round(use_positions)
+
+    if delayfill:
+        use_positions=_shift_present(use_positions, previous_row)
+
+    cum_trades=_ffill_present(use_positions, present)
+    trades_to_use=cum_trades - _shift_present(cum_trades, previous_row)
+
+    price_returns=prices - _shift_present(prices, previous_row)
+    
+    instr_ccy_returns=_shift_present(cum_trades, previous_row) * price_returns * value_of_price_point
+    instr_ccy_returns=_cumsum_diff_present(instr_ccy_returns, present)
+    base_ccy_returns=instr_ccy_returns * fx
+
+    ## costs, as calc_costs; zero unless an instrument has SR or cash costs
+    costs_instr_ccy=np.zeros(prices.shape)
+    
+    use_SR_cost=np.zeros(no_instruments, dtype=bool)
+    if SR_cost is not None:
+        SR_cost=np.array(SR_cost, dtype=float)
+        use_SR_cost=~np.isnan(SR_cost)
+        
+        ann_cost = -SR_cost[np.newaxis, :]*np.array(ann_risk, dtype=float)
+        costs_instr_ccy[:, use_SR_cost] = (ann_cost/BUSINESS_DAYS_IN_YEAR)[:, use_SR_cost]
+
+    if cash_costs is not None:
+        cash_costs=np.array(cash_costs, dtype=float)
+        use_cash_costs=~np.any(np.isnan(cash_costs), axis=1) & ~use_SR_cost
+        
+        (value_total_per_block, value_of_pertrade_commission, percentage_cost)=[
+            cash_costs[:, cost_idx][np.newaxis, :] for cost_idx in range(3)]
+
+        trades_in_blocks=np.abs(trades_to_use)
+        costs_blocks = - trades_in_blocks*value_total_per_block
+        
+        value_of_trades=trades_in_blocks * value_of_price_point
+        costs_percentage = percentage_cost * value_of_trades
+
+        ## per trade commission goes on positive trades; other rows are nan, so have no costs, unless there
+        ## are no positive trades at all
+        with np.errstate(invalid="ignore"):
+            traded=trades_to_use>0
+        costs_pertrade=np.where(traded, value_of_pertrade_commission, np.nan)
+        costs_pertrade[:, ~np.any(traded, axis=0)]=0.0
+        
+        all_cash_costs=costs_blocks+costs_percentage+costs_pertrade
+        costs_instr_ccy[:, use_cash_costs]=all_cash_costs[:, use_cash_costs]
+
+    costs_instr_ccy=_cumsum_diff_present(costs_instr_ccy, present)
+    
+    costs_base_ccy=costs_instr_ccy * _ffill_present(fx, present)
+    costs_base_ccy[present & np.isnan(costs_base_ccy)]=0.0
+
+    return dict(cum_trades=cum_trades, trades_to_use=trades_to_use, instr_ccy_returns=instr_ccy_returns,
+                base_ccy_returns=base_ccy_returns, costs_instr_ccy=costs_instr_ccy, costs_base_ccy=costs_base_ccy)
+
+def _previous_present_row(present):
+    """
+    For each row and column, the last row before it that is present in that column; -1 if there isn't one
+    """
+    row_number=np.where(present, np.arange(present.shape[0])[:, np.newaxis], -1)
+    last_present_row=np.maximum.accumulate(row_number, axis=0)
+    
+    return np.vstack([np.full((1, present.shape[1]), -1), last_present_row[:-1, :]])
+
+def _shift_present(x, previous_row):
+    """
+    Like pd.Series.shift(1) on each columns own index
+    """
+    shifted=x[np.maximum(previous_row, 0), np.arange(x.shape[1])]
+    
+    return np.where(previous_row>=0, shifted, np.nan)
+
+def _ffill_present(x, present):
+    """
+    Like pd.Series.ffill() on each columns own index
+    """
+    x=np.where(present, x, np.nan)
+    row_index=np.where(np.isnan(x), 0, np.arange(x.shape[0])[:, np.newaxis])
+    row_index=np.maximum.accumulate(row_index, axis=0)
+    
+    return np.where(present, x[row_index, np.arange(x.shape[1])], np.nan)
+
+def _cumsum_diff_present(x, present):
+    """
+    Like x.cumsum().ffill().diff() on each columns own index; nans after the first valid value become zero, 
+      and the first valid value is lost 
+    """
+    valid=present & ~np.isnan(x)
+    started=np.logical_or.accumulate(valid, axis=0)
+    first_valid=started & ~np.vstack([np.zeros((1, x.shape[1]), dtype=bool), started[:-1, :]])
+    
+    ans=np.where(started & ~valid, 0.0, x)
+    ans[first_valid]=np.nan
+    ans[~present]=np.nan
+    
+    return ans
+
+def account_curves_from_panel(list_of_kwargs, capital=None, ann_risk_target=None, delayfill=True, 
+                              roundpositions=False):
+    """
+    Create an account curve for each of a list of instruments, working out the p&l together with pandl_panel
+    
+    Gives the same as [accountCurve(capital=capital, ann_risk_target=ann_risk_target, delayfill=delayfill, 
+                                    roundpositions=roundpositions, **kwargs) for kwargs in list_of_kwargs]
+
+    Instruments that can't go in the panel (eg positions aren't aligned to price, trades are given) are done 
+      one at a time. So is everything if capital isn't fixed.
+
+    :param list_of_kwargs: passed to profit and loss calculation for each instrument 
+                           (price, positions, forecast, get_daily_returns_volatility, fx, 
+                           value_of_price_point, SR_cost, cash_costs)
+    :type list_of_kwargs: list of dict
+    
+    :param capital: Capital at risk. Used for % returns, and calculating daily risk for SR costs  
+    :type capital: None, float, int
+    
+    :param ann_risk_target: Annual risk target, as % of capital. Used to calculate daily risk for SR costs
+    :type ann_risk_target: None or float
+
+    :param delayfill: should we delay fills?
+    :type delayfill: bool
+
+    :param roundpositions: should we round positions when calculating trades?
+    :type roundpositions: bool
+
+    :returns: list of accountCurve
+    """
+    def _single_account_curve(kwargs):
+        return accountCurve(capital=capital, ann_risk_target=ann_risk_target, delayfill=delayfill, 
+                            roundpositions=roundpositions, **kwargs)
+    
+    if not (capital is None or type(capital) is float or type(capital) is int):
+        return [_single_account_curve(kwargs) for kwargs in list_of_kwargs]
+    
+    account_curves=[None]*len(list_of_kwargs)
+    panel_data=[]
+    
+    for (curve_idx, kwargs) in enumerate(list_of_kwargs):
+        price=kwargs.get("price", None)
+        if price is None or any([arg_name not in PANEL_PANDL_ARGS for arg_name in kwargs.keys()]):
+            account_curves[curve_idx]=_single_account_curve(kwargs)
+            continue
+
+        (base_capital, ann_risk, daily_risk_capital)=resolve_capital(price, capital, ann_risk_target)
+
+        fx=kwargs.get("fx", None)
+        if fx is None:
+            use_fx = pd.Series([1.0] * len(price.index), index=price.index)
+        else:
+            use_fx = fx.reindex(price.index, method="ffill")
+
+        value_of_price_point=kwargs.get("value_of_price_point", 1.0)
+        
+        positions=kwargs.get("positions", None)
+        if positions is None:
+            positions = get_positions_from_forecasts(price, kwargs.get("get_daily_returns_volatility", None),
+                                                     kwargs.get("forecast", None), use_fx, value_of_price_point,
+                                                     daily_risk_capital)
+
+        if not (price.index.is_unique and positions.index.equals(price.index)):
+            account_curves[curve_idx]=_single_account_curve(dict(kwargs, positions=positions))
+            continue
+        
+        panel_data.append((curve_idx, price, positions, use_fx, value_of_price_point, base_capital, ann_risk,
+                           kwargs.get("SR_cost", None), kwargs.get("cash_costs", None)))
+
+    if len(panel_data)==0:
+        return account_curves
+
+    ## all the rows we need, and where each instruments rows are
+    price_list=[panel_item[1] for panel_item in panel_data]
+    panel_index=np.concatenate([np.array(price.index, dtype="datetime64[ns]") for price in price_list])
+    panel_index=pd.DatetimeIndex(np.unique(panel_index))
+    rows_list=[panel_index.get_indexer(price.index) for price in price_list]
+    
+    def _to_panel(series_list):
+        panel=np.full((len(panel_index), len(series_list)), np.nan)
+        for (panel_column, (rows, series)) in enumerate(zip(rows_list, series_list)):
+            panel[rows, panel_column]=np.array(series, dtype=float).ravel()
+        
+        return panel
+
+    present=np.zeros((len(panel_index), len(panel_data)), dtype=bool)
+    for (panel_column, rows) in enumerate(rows_list):
+        present[rows, panel_column]=True
+    
+    SR_cost=[np.nan if panel_item[7] is None else panel_item[7] for panel_item in panel_data]
+    cash_costs=[[np.nan]*3 if panel_item[8] is None else list(panel_item[8]) for panel_item in panel_data]
+    if all([panel_item[7] is None for panel_item in panel_data]):
+        ann_risk=None
+    else:
+        ann_risk=_to_panel([panel_item[6] for panel_item in panel_data])
+    
+    panel_pandl=pandl_panel(_to_panel(price_list), _to_panel([panel_item[2] for panel_item in panel_data]), 
+                            fx=_to_panel([panel_item[3] for panel_item in panel_data]), 
+                            value_of_price_point=[panel_item[4] for panel_item in panel_data], 
+                            present=present, delayfill=delayfill, roundpositions=roundpositions,
+                            SR_cost=SR_cost, ann_risk=ann_risk, cash_costs=cash_costs)
+    
+    for (panel_column, (rows, panel_item)) in enumerate(zip(rows_list, panel_data)):
+        (curve_idx, price, positions_not_used, use_fx, value_of_price_point, base_capital)=panel_item[:6]
+        
+        def _from_panel(item_name):
+            return pd.Series(panel_pandl[item_name][rows, panel_column], index=price.index)
+        
+        instr_ccy_returns=_from_panel("instr_ccy_returns")
+        costs_instr_ccy=_from_panel("costs_instr_ccy")
+        
+        returns_data=(_from_panel("cum_trades"), _from_panel("trades_to_use"), instr_ccy_returns,
+                      _from_panel("base_ccy_returns"), use_fx, value_of_price_point)
+        unweighted_instr_ccy_pandl=dict(gross=instr_ccy_returns, costs=costs_instr_ccy, 
+                                        net=instr_ccy_returns+costs_instr_ccy)
+
+        pre_calc_data=(returns_data, base_capital, _from_panel("costs_base_ccy"), unweighted_instr_ccy_pandl)
+        account_curves[curve_idx]=accountCurve(pre_calc_data=pre_calc_data)
+    
+    return account_curves
+
 def acc_list_to_pd_frame(list_of_ac_curves, asset_columns):
     """
     
@@ -949,18 +1385,35 @@ def acc_list_to_pd_frame(list_of_ac_curves, asset_columns):
     :param asset_columns: Names of each asset
     :type asset_columns: list of str 
 
+    :returns: TxN pd.DataFrame
+    """
+    ans=aligned_acc_list(list_of_ac_curves, asset_columns)
+    ans=ans.cumsum().ffill().diff()
+    
+    return ans
+
+def aligned_acc_list(list_of_ac_curves, asset_columns):
+    """
+    
+    Returns a pandas data frame of the returns in each curve, on a common index but otherwise as they are
+
+    :param list_of_ac_curves: Elements to include
+    :type list_of_ac_curves: list of any accountcurve like object
+
+    :param asset_columns: Names of each asset
+    :type asset_columns: list of str 
+
     :returns: TxN pd.DataFrame
     """
     list_of_df=[acc.as_ts() for acc in list_of_ac_curves]
     ans=pd.concat(list_of_df, axis=1,  join="outer")
     
     ans.columns=asset_columns
-    ans=ans.cumsum().ffill().diff()
     
     return ans
 
 
-def total_from_list(list_of_ac_curves, asset_columns, capital):
+def total_from_list(list_of_ac_curves, asset_columns, capital, pdframe=None):
     """
     
     Return a single accountCurveSingleElement whose returns are the total across the portfolio
@@ -973,10 +1426,14 @@ def total_from_list(list_of_ac_curves, asset_columns, capital):
 
     :param capital: Capital, if None will discover from list elements
     :type capital: None, float, or pd.Series 
+
+    :param pdframe: acc_list_to_pd_frame(list_of_ac_curves, asset_columns), if we already have it
+    :type pdframe: TxN pd.DataFrame or None
     
     :returns: 2 tuple of pd.Series
     """
-    pdframe=acc_list_to_pd_frame(list_of_ac_curves, asset_columns)
+    if pdframe is None:
+        pdframe=acc_list_to_pd_frame(list_of_ac_curves, asset_columns)
     
     def _resolve_capital_for_total(capital, pdframe):
         if type(capital) is float:
@@ -1017,7 +1474,8 @@ class accountCurveGroupForType(accountCurveSingleElement):
     """
     an accountCurveGroup for one cost type (gross, net, costs)
     """
-    def __init__(self, acc_curve_for_type_list, asset_columns, capital=None, weighted_flag=False, curve_type="net"):
+    def __init__(self, acc_curve_for_type_list, asset_columns, capital=None, weighted_flag=False, curve_type="net",
+                 aligned_returns=None):
         """
         Create a group of account curves from a list and some column names
         
@@ -1053,16 +1511,73 @@ class accountCurveGroupForType(accountCurveSingleElement):
 
         :param capital: Capital, if None will discover from list elements
         :type capital: None, float, or pd.Series 
+
+        :param aligned_returns: Returns of each curve, instead of acc_curve_for_type_list (which should be None). 
+                                Each column is a whole curve, on a business day index. Curves are only created
+                                if they're needed. capital must be given.
+        :type aligned_returns: TxN pd.DataFrame or None
         
         """
-        (acc_total, capital)=total_from_list(acc_curve_for_type_list, asset_columns, capital)
+        if aligned_returns is None:
+            ## Put the returns together once, and keep them, rather than every time we need a frame, total or stats
+            aligned_returns=aligned_acc_list(acc_curve_for_type_list, asset_columns)
+            present=np.column_stack([aligned_returns.index.isin(ac_curve.as_ts().index) 
+                                     for ac_curve in acc_curve_for_type_list])
+            member_capital=[ac_curve.capital for ac_curve in acc_curve_for_type_list]
+            member_weighted_flag=[ac_curve.weighted_flag for ac_curve in acc_curve_for_type_list]
+        else:
+            if capital is None:
+                raise Exception("Need to give capital if creating an account curve group from returns")
+            present=np.ones(aligned_returns.shape, dtype=bool)
+            member_capital=[capital]*len(asset_columns)
+            member_weighted_flag=[weighted_flag]*len(asset_columns)
+
+        returns_frame=aligned_returns.cumsum().ffill().diff()
+
+        (acc_total, capital)=total_from_list(acc_curve_for_type_list, asset_columns, capital, pdframe=returns_frame)
         
         super().__init__(acc_total, weighted_flag=weighted_flag, capital=capital)
+
+        if acc_curve_for_type_list is not None and \
+            all([type(ac_curve) is accountCurveSingleElement for ac_curve in acc_curve_for_type_list]):
+            ## plain curves can be made again from the aligned returns, so we don't need to keep them
+            ## (other curves, eg groups, have more in them than their returns)
+            acc_curve_for_type_list=None
         
-        setattr(self, "to_list", acc_curve_for_type_list)
+        setattr(self, "_to_list", acc_curve_for_type_list)
         setattr(self, "asset_columns", asset_columns)
         setattr(self, "curve_type", curve_type)
 
+        setattr(self, "_returns_frame", returns_frame)
+        setattr(self, "_aligned_index", aligned_returns.index)
+        setattr(self, "_aligned_values", aligned_returns.values)
+        setattr(self, "_aligned_present", present)
+        setattr(self, "_member_capital", member_capital)
+        setattr(self, "_member_weighted_flag", member_weighted_flag)
+
+        ## aligned_returns for each frequency, once we've needed them
+        setattr(self, "_aligned_returns_cache", dict())
+
+    @property
+    def to_list(self):
+        if self._to_list is None:
+            ## made from the aligned returns each time, so we don't keep them
+            return [self._member(idx) for idx in range(len(self.asset_columns))]
+
+        return self._to_list
+
+    def _member_returns(self, idx):
+        ## as the curve's own returns; only the rows it has
+        present=self._aligned_present[:, idx]
+        return pd.Series(self._aligned_values[present, idx], index=self._aligned_index[present])
+
+    def _member(self, idx):
+        if self._to_list is not None:
+            return self._to_list[idx]
+
+        return accountCurveSingleElement(self._member_returns(idx), self._member_capital[idx], 
+                                         weighted_flag=self._member_weighted_flag[idx])
+
 
     def __getitem__(self, colname):
         """
@@ -1072,7 +1587,7 @@ class accountCurveGroupForType(accountCurveSingleElement):
         """
 
         try:
-            ans=self.to_list[self.asset_columns.index(colname)]
+            ans=self._member(self.asset_columns.index(colname))
         except ValueError:
             raise Exception("%s not found in account curve" % colname)
         
@@ -1085,7 +1600,48 @@ class accountCurveGroupForType(accountCurveSingleElement):
         :returns: TxN pd.DataFrame
         """
         
-        return acc_list_to_pd_frame(self.to_list, self.asset_columns)
+        ## a copy, so nobody can change our returns by accident
+        return self._returns_frame.copy()
+
+    def aligned_returns(self, freq="daily", percent=True):
+        """
+        Returns of each asset, on a common index
+
+        Daily returns come straight from the returns we put together when the group was created. 
+        Other frequencies, or curves with varying capital, have to be put together from each curve.
+
+        :param freq: frequency; daily, weekly, monthly or annual
+        :type freq: str 
+
+        :param percent: get % returns
+        :type percent: bool 
+
+        :returns: tuple: TxN np.array of returns, TxN np.array of bool (which rows each asset has), 
+                         float returns scalar, float vol scalar
+        """
+        cache_key=(freq, percent)
+        if cache_key not in self._aligned_returns_cache:
+            self._aligned_returns_cache[cache_key]=self._calc_aligned_returns(freq, percent)
+
+        return self._aligned_returns_cache[cache_key]
+
+    def _calc_aligned_returns(self, freq, percent):
+        capital_list=self._member_capital
+        if freq=="daily" and (not percent or all([np.isscalar(capital) for capital in capital_list])):
+            returns=self._aligned_values
+            if percent:
+                returns=100.0 * returns / np.array(capital_list, dtype=float)
+
+            return (returns, self._aligned_present, BUSINESS_DAYS_IN_YEAR, ROOT_BDAYS_INYEAR)
+
+        freq_obj_list=[getattr(ac_curve, freq) for ac_curve in self.to_list]
+        if percent:
+            freq_obj_list=[freq_obj.percent() for freq_obj in freq_obj_list]
+
+        returns_frame=pd.concat([freq_obj.as_ts() for freq_obj in freq_obj_list], axis=1)
+        present=np.column_stack([returns_frame.index.isin(freq_obj.index) for freq_obj in freq_obj_list])
+
+        return (returns_frame.values, present, freq_obj_list[0]._returns_scalar, freq_obj_list[0]._vol_scalar)
 
 
     def get_stats(self, stat_method, freq="daily", percent=True):
@@ -1112,14 +1668,11 @@ class accountCurveGroupForType(accountCurveSingleElement):
         
         :returns: dict of floats
         """
-        def _len_nonzero(ac_curve):
-            return_df=ac_curve.as_ts()
-            ans=len([x for x in return_df.values if not np.isnan(x)])
+        ## aligning the returns only adds missing values, so we can count them there
+        nonzero_count=np.sum(~np.isnan(self._aligned_values), axis=0)
             
-            return ans
-            
-        time_weights_dict=dict([(asset_name, _len_nonzero(ac_curve)) for (asset_name, ac_curve) 
-                  in zip(self.asset_columns, self.to_list)])
+        time_weights_dict=dict([(asset_name, int(asset_count)) for (asset_name, asset_count) 
+                  in zip(self.asset_columns, nonzero_count)])
         
         total_weight=sum(time_weights_dict.values())
         
@@ -1157,8 +1710,16 @@ class statsDict(dict):
             
             return stat_method_function()
         
-        dict_values=[(col_name, _get_stat_from_acobject(acgroup_for_type[col_name], stat_method, freq, percent)) 
-                  for col_name in column_names]
+        if stat_method in ACCOUNT_STATS_LIST:
+            ## work out the stat for all the curves together
+            (returns, present, returns_scalar, vol_scalar)=acgroup_for_type.aligned_returns(freq, percent)
+
+            all_stats=account_curve_stats(returns, returns_scalar, vol_scalar, present=present)
+
+            dict_values=list(zip(column_names, all_stats[stat_method]))
+        else:
+            dict_values=[(col_name, _get_stat_from_acobject(acgroup_for_type[col_name], stat_method, freq, percent)) 
+                      for col_name in column_names]
 
         super().__init__(dict_values)
         
@@ -1258,7 +1819,7 @@ class statsDict(dict):
         return pvalue
         
 class accountCurveGroup(accountCurveSingleElement):
-    def __init__(self, acc_curve_list, asset_columns, capital=None, weighted_flag=None):
+    def __init__(self, acc_curve_list, asset_columns, capital=None, weighted_flag=None, aligned_returns=None):
         """
         Create a group of account curves from a list and some column names
         
@@ -1299,8 +1860,21 @@ class accountCurveGroup(accountCurveSingleElement):
         :param weighted_flag: Is this a weighted_flag account curve? If None then inherits from list. 
         :type weighted_flag: None or bool
 
+        :param aligned_returns: Returns of each curve, instead of acc_curve_list (which should be None). 
+                                See accountCurveGroupForType. capital must be given.
+        :type aligned_returns: dict of TxN pd.DataFrame, keys net, gross and costs; or None
+
         
         """
+
+        if aligned_returns is not None:
+            if weighted_flag is None:
+                weighted_flag=False
+            acc_curve_list_for_type=dict(net=None, gross=None, costs=None)
+        else:
+            aligned_returns=dict(net=None, gross=None, costs=None)
+            acc_curve_list_for_type=dict([(curve_type, [getattr(x, curve_type) for x in acc_curve_list])
+                                          for curve_type in ["net", "gross", "costs"]])
         
         if weighted_flag is None:
             weighted_flag=[x.weighted_flag for x in acc_curve_list]
@@ -1313,26 +1887,25 @@ class accountCurveGroup(accountCurveSingleElement):
                 weighted_flag = False
             
         
-        net_list=[getattr(x, "net") for x in acc_curve_list]
-        gross_list=[getattr(x, "gross") for x in acc_curve_list]
-        costs_list=[getattr(x, "costs") for x in acc_curve_list]
+        net_list=acc_curve_list_for_type["net"]
         
         acc_list_net=accountCurveGroupForType(net_list, asset_columns=asset_columns, 
                                               capital = capital,
                                               weighted_flag=weighted_flag, 
-                                              curve_type="net")
+                                              curve_type="net", aligned_returns=aligned_returns["net"])
 
-        acc_list_gross=accountCurveGroupForType(gross_list, asset_columns=asset_columns,  
+        acc_list_gross=accountCurveGroupForType(acc_curve_list_for_type["gross"], asset_columns=asset_columns,  
                                                 capital=capital,
                                                 weighted_flag=weighted_flag, 
-                                                curve_type="gross")
+                                                curve_type="gross", aligned_returns=aligned_returns["gross"])
 
-        acc_list_costs=accountCurveGroupForType(costs_list, asset_columns=asset_columns, 
+        acc_list_costs=accountCurveGroupForType(acc_curve_list_for_type["costs"], asset_columns=asset_columns, 
                                                 capital=capital,
                                                  weighted_flag=weighted_flag,
-                                                curve_type="costs")
+                                                curve_type="costs", aligned_returns=aligned_returns["costs"])
 
-        (acc_total, capital)=total_from_list(net_list, asset_columns, capital)
+        ## the net group has already put the returns together
+        (acc_total, capital)=total_from_list(net_list, asset_columns, capital, pdframe=acc_list_net._returns_frame)
         
         super().__init__(acc_total,  weighted_flag=weighted_flag, capital=capital)
         
@@ -1340,9 +1913,30 @@ class accountCurveGroup(accountCurveSingleElement):
         setattr(self, "gross", acc_list_gross)
         setattr(self, "costs", acc_list_costs)
 
-        setattr(self, "to_list", acc_curve_list)
+        if acc_curve_list is not None and all([type(x) is accountCurveSingle for x in acc_curve_list]):
+            ## plain curves can be made again from the aligned returns, so we don't need to keep them
+            ## (other curves, eg accountCurve, have more in them than their returns)
+            acc_curve_list=None
+
+        setattr(self, "_to_list", acc_curve_list)
         setattr(self, "asset_columns", asset_columns)
 
+    @property
+    def to_list(self):
+        if self._to_list is None:
+            ## made from the aligned returns each time, so we don't keep them
+            return [self._member(idx) for idx in range(len(self.asset_columns))]
+
+        return self._to_list
+
+    def _member(self, idx):
+        if self._to_list is not None:
+            return self._to_list[idx]
+
+        return accountCurveSingle(self.gross._member_returns(idx), self.net._member_returns(idx), 
+                                  self.costs._member_returns(idx), self.net._member_capital[idx], 
+                                  weighted_flag=self.weighted_flag)
+
     def __repr__(self):
         return super().__repr__()+"\n Multiple curves. Use object.curve_type (curve_type= net, gross, costs)" +              "\n Useful methods: to_list, asset_columns(), get_stats(), to_frame()"
 
@@ -1355,7 +1949,7 @@ class accountCurveGroup(accountCurveSingleElement):
         
         """
         try:
-            ans=self.to_list[self.asset_columns.index(colname)]
+            ans=self._member(self.asset_columns.index(colname))
         except ValueError:
             raise Exception("%s not found in account curve" % colname)
         
@@ -1405,7 +1999,7 @@ class accountCurveGroup(accountCurveSingleElement):
         :returns: returnStack
         """
         
-        returnsStack(self.to_list)
+        return returnsStack(self.to_list)
 
 
     def to_ncg_frame(self):
@@ -1426,75 +2020,66 @@ class returnsStack(accountCurveSingle):
     """
     Create a stack of returns which we can bootstrap
     """
-    def __init__(self, returns_list):
+    def __init__(self, returns_list, capital=None):
         """
         Create a stack of returns which we can bootstrap
         
         :param returns_list: returns to be bootstrapped
         :type returns_list: List of accountCurve() objects
+
+        :param capital: Capital for the stack, if None the average capital of the returns
+        :type capital: None or float
         """
 
         
         ## Collapse indices to a single one
-        bs_index_to_use=[list(returns.index) for returns in returns_list]
-        bs_index_to_use=sum(bs_index_to_use, [])
-        bs_index_to_use=list(set(bs_index_to_use))
-        
-        bs_index_to_use.sort()
+        bs_index_to_use=np.concatenate([np.array(returns.index, dtype="datetime64[ns]") for returns in returns_list])
+        bs_index_to_use=pd.DatetimeIndex(np.unique(bs_index_to_use))
 
-        ## Collapse return lists
+        ## Collapse return lists, one after the other
         curve_type_list =["gross", "net", "costs"]
         
-        def _collapse_one_curve_type(returns_list, curve_type):
-            collapsed_values = sum(
-               
-                           [list(getattr(returns, curve_type).iloc[:,0].values) 
-                            for returns in returns_list]
-               
-                                , [])
-            
-            
-            return collapsed_values
-        
-        collapsed_curves_values=dict([(curve_type, _collapse_one_curve_type(returns_list, curve_type))
+        collapsed_curves_values=dict([(curve_type, 
+                                       np.concatenate([np.array(getattr(returns, curve_type).as_ts().values, dtype=float) 
+                                                       for returns in returns_list]))
                                         for curve_type in curve_type_list])
-        
+
+        if capital is None:
+            capital=float(np.mean([np.nanmean(np.array(returns.capital, dtype=float)) for returns in returns_list]))
         
         ## We set this to an arbitrary index so we can make an account curve
+        stack_index=pd.date_range(start=bs_index_to_use[0], periods=len(collapsed_curves_values["net"]), freq="B")
 
-        gross_returns_df=pd.Series(collapsed_curves_values["gross"], 
-                        pd.date_range(start=bs_index_to_use[0], periods=len(collapsed_curves_values["gross"]), freq="B"))
-
-        net_returns_df=pd.Series(collapsed_curves_values["net"], 
-                        pd.date_range(start=bs_index_to_use[0], periods=len(collapsed_curves_values["net"]), freq="B"))
-
-        costs_returns_df=pd.Series(collapsed_curves_values["costs"], 
-                        pd.date_range(start=bs_index_to_use[0], periods=len(collapsed_curves_values["costs"]), freq="B"))
+        (gross_returns_df, net_returns_df, costs_returns_df)=[pd.Series(collapsed_curves_values[curve_type], stack_index)
+                                                              for curve_type in curve_type_list]
         
-        super().__init__(gross_returns_df, net_returns_df, costs_returns_df)
+        super().__init__(gross_returns_df, net_returns_df, costs_returns_df, capital)
 
         ## We need to store this for bootstrapping purposes
         setattr(self, "_bs_index_to_use", bs_index_to_use)
+        setattr(self, "_values_to_sample_from", collapsed_curves_values)
 
 
-    def bootstrap(self, no_runs=50, length=None):
+    def bootstrap(self, no_runs=50, length=None, seed=None):
         """
         Create an accountCurveGroup object containing no_runs, each same length as the
           original portfolio (unless length is set)
+
+        All the runs are drawn at once, and the group is created straight from the sampled returns
           
         :param no_runs: Number of runs to do 
         :type no_runs: int
         
         :param length: Length of each run
         :type length: int
+
+        :param seed: Seed for np.random.RandomState, so results can be repeated. None to not seed
+        :type seed: int or None
         
         :returns: accountCurveGroup, one element for each of no_runs
         """
-        values_to_sample_from=dict(gross=list(getattr(self, "gross").iloc[:,0].values),
-                                   net=list(getattr(self, "net").iloc[:,0].values),
-                                   costs=list(getattr(self, "costs").iloc[:,0].values))
-        
-        size_of_bucket=len(self.index)
+        values_to_sample_from=self._values_to_sample_from
+        size_of_bucket=len(values_to_sample_from["net"])
         
         if length is None:
             index_to_use=self._bs_index_to_use
@@ -1502,24 +2087,20 @@ class returnsStack(accountCurveSingle):
             
         else:
             index_to_use=pd.date_range(start=self._bs_index_to_use[0], periods=length, freq="B")
-        
-        bs_list=[]
-        for notUsed in range(no_runs):
-            sample=[int(round(random.uniform(0, size_of_bucket-1))) for notUsed2 in range(length)]
-            
-            ## each element of accountCurveGroup is an accountCurveSingle
-            bs_list.append(     
-                             accountCurveSingle(
-                               pd.Series([values_to_sample_from["gross"][xidx] for xidx in sample], index=index_to_use),
-                               pd.Series([values_to_sample_from["net"][xidx] for xidx in sample], index=index_to_use),
-                               pd.Series([values_to_sample_from["costs"][xidx] for xidx in sample], index=index_to_use)
 
-                             )
-                           )
+        ## one matrix of draws; each row is a run
+        random_state=np.random.RandomState(seed)
+        sample=random_state.randint(0, size_of_bucket, size=(int(no_runs), int(length)))
         
         asset_columns=["b%d" % idx for idx in range(no_runs)]
+
+        ## each column is a run
+        aligned_returns=dict([(curve_type, pd.DataFrame(values_to_sample_from[curve_type][sample].transpose(), 
+                                                        index=index_to_use, columns=asset_columns))
+                              for curve_type in ["gross", "net", "costs"]])
         
-        return accountCurveGroup(bs_list, asset_columns)
+        return accountCurveGroup(None, asset_columns, capital=self.capital, weighted_flag=self.weighted_flag,
+                                 aligned_returns=aligned_returns)
 
 
 def decompose_group_pandl(pandl_list, pandl_this_code=None, pool_costs=True, backfillavgcosts=True):
@@ -7,11 +7,21 @@ Basic building blocks of trading rules, like volatility measurement and crossove
 import pandas as pd
 import numpy as np
 
+from copy import copy
+import hashlib
+import warnings
+
 from syscore.genutils import str2Bool
+from syscore.objects import resolve_function
 from systems.defaults import system_defaults
 
 LARGE_NUMBER_OF_DAYS=250*100*100
 
+## maximum number of data points we put into a single order statistics structure
+## when doing a batch rolling quantile; bounds memory use at roughly 20 bytes per
+## point per bit of the rank
+ROLLING_QUANTILE_CHUNK_SIZE=2**18
+
 def apply_with_min_periods(xcol, my_func=np.nanmean, min_periods=0):
     """
     :param x: data
@@ -82,6 +92,176 @@ def mean_estimator(x, using_exponent=True, min_periods=20, ew_lookback=500):
 
 
 
+def _rank_bit_levels(ranks, number_of_bits):
+    """
+    Build the levels of a wavelet matrix over a permutation of ranks
+
+    At each level (most significant bit first) we store the running count of
+    zero bits, and then stably move the zero bit entries to the front
+
+    :param ranks: unique integer ranks 0...n-1
+    :type ranks: np.array of int
+
+    :param number_of_bits: bits needed to represent the largest rank
+    :type number_of_bits: int
+
+    :returns: list of tuples (bit, zero count prefix, total zeros)
+    """
+    levels = []
+    current = ranks
+    for bit in range(number_of_bits - 1, -1, -1):
+        is_zero = ((current >> bit) & 1) == 0
+        zero_prefix = np.zeros(len(current) + 1, dtype=np.int32)
+        np.cumsum(is_zero, out=zero_prefix[1:])
+        levels.append((bit, zero_prefix, zero_prefix[-1]))
+        current = np.concatenate([current[is_zero], current[~is_zero]])
+
+    return levels
+
+
+def _kth_smallest_rank(levels, start, end, kth):
+    """
+    For each query find the kth (zero based) smallest rank in ranks[start:end]
+
+    All queries are answered together, with one vectorised step per bit
+
+    :param levels: output of _rank_bit_levels
+    :type levels: list
+
+    :param start: start of each range (inclusive)
+    :type start: np.array of int
+
+    :param end: end of each range (exclusive)
+    :type end: np.array of int
+
+    :param kth: order statistic required, must be less than end - start
+    :type kth: np.array of int
+
+    :returns: np.array of int
+    """
+    answer = np.zeros(len(kth), dtype=np.int64)
+    for (bit, zero_prefix, total_zeros) in levels:
+        zeros_before_start = zero_prefix[start]
+        zeros_before_end = zero_prefix[end]
+        zeros_in_range = zeros_before_end - zeros_before_start
+
+        go_right = kth >= zeros_in_range
+        kth = np.where(go_right, kth - zeros_in_range, kth)
+        start = np.where(go_right, total_zeros +
+                         start - zeros_before_start, zeros_before_start)
+        end = np.where(go_right, total_zeros +
+                       end - zeros_before_end, zeros_before_end)
+        answer[go_right] += 2 ** bit
+
+    return answer
+
+
+def _rolling_quantile_block(data, window, quantile, min_periods):
+    """
+    Rolling quantile for each column of a T x N array, in one pass
+
+    Columns are stacked end to end and windows are clipped so they never
+    cross into the previous column
+
+    :returns: T x N np.array
+    """
+    (T, N) = data.shape
+    values = data.T.ravel()
+    total_length = len(values)
+
+    ## NaN sort to the end, so they always have the highest ranks and are
+    ## never selected as long as we ask for k < number of valid observations
+    sort_order = np.argsort(values, kind="mergesort")
+    sorted_values = values[sort_order]
+    ranks = np.empty(total_length, dtype=np.int64)
+    ranks[sort_order] = np.arange(total_length)
+
+    not_nan_count = np.zeros(total_length + 1, dtype=np.int64)
+    np.cumsum(~np.isnan(values), out=not_nan_count[1:])
+
+    time_index = np.tile(np.arange(T), N)
+    column_start = np.repeat(np.arange(N) * T, T)
+    end = column_start + time_index + 1
+    start = column_start + np.maximum(time_index - window + 1, 0)
+    nobs = not_nan_count[end] - not_nan_count[start]
+
+    result = np.empty(total_length)
+    result.fill(np.nan)
+
+    valid = nobs >= min_periods
+    if valid.any():
+        number_of_bits = max(int(total_length - 1).bit_length(), 1)
+        levels = _rank_bit_levels(ranks, number_of_bits)
+
+        ## same as pandas: lower order statistic, no interpolation
+        kth = (quantile * (nobs[valid] - 1.0)).astype(np.int64)
+        kth_rank = _kth_smallest_rank(levels, start[valid], end[valid], kth)
+        result[valid] = sorted_values[kth_rank]
+
+    return result.reshape((N, T)).T
+
+
+def rolling_quantile(x, window, quantile, min_periods=None):
+    """
+    Rolling quantile, giving the same answers as pd.rolling_quantile
+
+    Uses a wavelet matrix over the ranks of the data, so that every window is
+    answered at once in O(n log n). Pass a DataFrame to do many series (eg the
+    vol of every instrument) in a single batch.
+
+    :param x: data
+    :type x: Tx1 pd.Series or TxN pd.DataFrame
+
+    :param window: Number of observations in window
+    :type window: int
+
+    :param quantile: Quantile, between 0 and 1
+    :type quantile: float
+
+    :param min_periods: Minimum non nan observations, else nan (*default* window)
+    :type min_periods: int
+
+    :returns: pd.Series or pd.DataFrame, same shape as x
+
+    >>> x=pd.Series([3.0, 1.0, np.nan, 4.0, 1.0, 5.0, 9.0, 2.0])
+    >>> list(rolling_quantile(x, 4, 0.5, 2).values)
+    [nan, 1.0, 1.0, 3.0, 1.0, 4.0, 4.0, 2.0]
+    """
+    if min_periods is None:
+        min_periods = window
+
+    if quantile < 0.0 or quantile > 1.0:
+        raise Exception("Quantile must be between 0 and 1, not %f" % quantile)
+
+    if min_periods > window:
+        raise Exception("min_periods %d must be <= window %d" %
+                        (min_periods, window))
+
+    min_periods = max(min_periods, 1)
+
+    is_series = isinstance(x, pd.Series)
+    if is_series:
+        data = np.asarray(x.values, dtype=float).reshape((len(x), 1))
+    else:
+        data = np.asarray(x.values, dtype=float)
+
+    (T, N) = data.shape
+    result = np.empty((T, N))
+    result.fill(np.nan)
+
+    if T > 0:
+        columns_per_chunk = max(ROLLING_QUANTILE_CHUNK_SIZE // T, 1)
+        for chunk_start in range(0, N, columns_per_chunk):
+            chunk_end = min(chunk_start + columns_per_chunk, N)
+            result[:, chunk_start:chunk_end] = _rolling_quantile_block(
+                data[:, chunk_start:chunk_end], window, quantile, min_periods)
+
+    if is_series:
+        return pd.Series(result[:, 0], index=x.index)
+
+    return pd.DataFrame(result, index=x.index, columns=x.columns)
+
+
 def robust_vol_calc(x, days=35, min_periods=10, vol_abs_min=0.0000000001, vol_floor=True,
                     floor_min_quant=0.05, floor_min_periods=100,
                     floor_days=500):
@@ -90,8 +270,8 @@ def robust_vol_calc(x, days=35, min_periods=10, vol_abs_min=0.0000000001, vol_fl
     We apply an absolute minimum level of vol (absmin);
     and a volfloor based on lowest vol over recent history
 
-    :param x: data
-    :type x: Tx1 pd.Series
+    :param x: data; pass a DataFrame to calculate many instruments in one batch
+    :type x: Tx1 pd.Series or TxN pd.DataFrame
 
     :param days: Number of days in lookback (*default* 35)
     :type days: int
@@ -123,22 +303,68 @@ def robust_vol_calc(x, days=35, min_periods=10, vol_abs_min=0.0000000001, vol_fl
 
     if vol_floor:
         # Find the rolling 5% quantile point to set as a minimum
-        vol_min = pd.rolling_quantile(
+        vol_min = rolling_quantile(
             vol, floor_days, floor_min_quant, floor_min_periods)
         # set this to zero for the first value then propogate forward, ensures
         # we always have a value
-        vol_min.set_value(vol_min.index[0], 0.0)
+        vol_min.iloc[0] = 0.0
         vol_min = vol_min.ffill()
 
         # apply the vol floor
-        vol_with_min = pd.concat([vol, vol_min], axis=1)
-        vol_floored = vol_with_min.max(axis=1, skipna=False)
+        if isinstance(vol, pd.DataFrame):
+            vol_floored = vol.where(
+                (vol >= vol_min) | vol.isnull(), vol_min)
+        else:
+            vol_with_min = pd.concat([vol, vol_min], axis=1)
+            vol_floored = vol_with_min.max(axis=1, skipna=False)
     else:
         vol_floored = vol
 
     return vol_floored
 
 
+def vol_config_key(volconfig):
+    """
+    A short key which identifies a volatility configuration, so that the same
+    vol series can be shared by everything that asks for it
+
+    :param volconfig: dict containing func key and arguments
+    :type volconfig: dict
+
+    :returns: str
+
+    >>> vol_config_key(dict(func="syscore.algos.robust_vol_calc", days=35))==vol_config_key(dict(days=35, func="syscore.algos.robust_vol_calc"))
+    True
+    >>> vol_config_key(dict(func="syscore.algos.robust_vol_calc", days=35))==vol_config_key(dict(func="syscore.algos.robust_vol_calc", days=36))
+    False
+    """
+    config_items = sorted([(str(key), str(value))
+                           for (key, value) in volconfig.items()])
+
+    return hashlib.md5(str(config_items).encode("utf-8")).hexdigest()[:12]
+
+
+def returns_volatility_from_config(returns, volconfig):
+    """
+    Volatility of returns, using the function and arguments in volconfig
+
+    :param returns: daily returns (not %)
+    :type returns: Tx1 pd.Series
+
+    :param volconfig: dict containing func key; anything else is passed to func
+    :type volconfig: dict
+
+    :returns: Tx1 pd.Series
+    """
+    # volconfig contains 'func' and some other arguments
+    # we turn func which could be a string into a function, and then
+    # call it with the other ags
+    volconfig = copy(volconfig)
+    volfunction = resolve_function(volconfig.pop('func'))
+
+    return volfunction(returns, **volconfig)
+
+
 def forecast_scalar(xcross, window=250000, min_periods=500, backfill=True):
     """
     Work out the scaling factor for xcross such that T*x has an abs value of 10
@@ -176,6 +402,63 @@ def forecast_scalar(xcross, window=250000, min_periods=500, backfill=True):
     return scaling_factor
 
 
+def forecast_scalars_pooled(xcross_list, window=250000, min_periods=500, backfill=True):
+    """
+    Batch version of forecast_scalar for several trading rules at once
+
+    All the cross sectional forecasts must share an index and have the same
+    number of columns. We stack them into a T x N x R array, take the cross
+    sectional median for every rule together, and then one rolling mean over
+    all rules.
+
+    :param xcross_list: cross sectional forecasts, one per rule
+    :type xcross_list: list of pd.DataFrame TxN
+
+    :returns: list of pd.Series, one per rule, same as forecast_scalar would give
+
+    >>> x=pd.DataFrame(dict(a=[1.0, 2.0, np.nan, 4.0], b=[-3.0, 1.0, 2.0, -2.0]), index=pd.date_range("2015-01-01", periods=4))
+    >>> y=-2.0*x
+    >>> (x_scalar, y_scalar)=forecast_scalars_pooled([x,y], min_periods=2)
+    >>> x_scalar.equals(forecast_scalar(x, min_periods=2))
+    True
+    >>> y_scalar.equals(forecast_scalar(y, min_periods=2))
+    True
+    """
+    backfill=str2Bool(backfill) ## in yaml will come in as text
+    ##We don't allow this to be changed in config
+    target_abs_forecast = system_defaults['average_absolute_forecast']
+
+    index = xcross_list[0].index
+    stacked = np.dstack([xcross.values for xcross in xcross_list])
+
+    ## Take CS average first, as forecast_scalar does
+    if stacked.shape[1]==1:
+        x=np.abs(stacked[:, 0, :])
+    else:
+        ## forward fill down the time axis, then median across instruments
+        (T, N, R) = stacked.shape
+        row_index = np.where(np.isnan(stacked), 0,
+                             np.arange(T)[:, np.newaxis, np.newaxis])
+        row_index = np.maximum.accumulate(row_index, axis=0)
+        stacked = stacked[row_index, np.arange(N)[np.newaxis, :, np.newaxis],
+                          np.arange(R)[np.newaxis, np.newaxis, :]]
+        with warnings.catch_warnings():
+            ## all nan slices are expected before any forecasts exist
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            x=np.nanmedian(np.abs(stacked), axis=1)
+
+    x=pd.DataFrame(x, index=index)
+
+    ## now the TS, all rules at once
+    avg_abs_value=pd.rolling_mean(x, window=window, min_periods=min_periods)
+    scaling_factor=target_abs_forecast/avg_abs_value
+
+    if backfill:
+        scaling_factor=scaling_factor.fillna(method="bfill")
+
+    return [scaling_factor.iloc[:, rule_number] for rule_number in range(len(xcross_list))]
+
+
 def apply_buffer_single_period(last_position, optimal_position, top_pos, bot_pos, trade_to_edge):
     """
     Apply a buffer to a position, single period
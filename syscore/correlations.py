@@ -2,6 +2,7 @@
 Correlations are important and used a lot
 '''
 from copy import copy
+import warnings
 
 
 import numpy as np
@@ -9,10 +10,13 @@ import pandas as pd
 
 from syscore.genutils import str2Bool, group_dict_from_natural
 from syscore.dateutils import generate_fitting_dates
-from syscore.pdutils import df_from_list, must_have_item
+from syscore.pdutils import must_have_item, pooledData, pooled_data_from_list
 
 from syslogdiag.log import logtoscreen
 
+## relative size below which we treat a sum of squared deviations as zero, when using running sums
+ROUNDING_TOLERANCE=1e-12
+
 def get_avg_corr(sigma):
     """
     >>> sigma=np.array([[1.0,0.0,0.5], [0.0, 1.0, 0.75],[0.5, 0.75, 1.0]])
@@ -51,9 +55,6 @@ def clean_correlation(corrmat, corr_with_no_data, must_haves=None):
 
     :returns: 2-dim square np.array
 
-    FIXME - this code is inefficient; especially if you use exponential weighting
-             (since we'll be recalculating the same rolling correlations multiple times)
-
     >>> corr_with_no_data=boring_corr_matrix(3, offdiag=0.99, diag=1.0)
     >>> sigma=np.array([[1.0,0.0,0.5], [0.0, 1.0, 0.75],[0.5, 0.75, 1.0]])
     >>> clean_correlation(sigma, corr_with_no_data)
@@ -88,32 +89,27 @@ def clean_correlation(corrmat, corr_with_no_data, must_haves=None):
     if must_haves is None:
         must_haves=[True]*corrmat.shape[0]
 
-    if not np.any(np.isnan(corrmat)):
+    missing=np.isnan(corrmat)
+
+    if not np.any(missing):
         ## no cleaning required
         return corrmat
 
-    if np.all(np.isnan(corrmat)):
+    if np.all(missing):
         return corr_with_no_data
 
-    
-    size_range=range(corrmat.shape[0])
-
     avgcorr=get_avg_corr(corrmat)
 
-    def _good_correlation(i,j,corrmat, avgcorr, must_haves, corr_with_no_data):
-        value=corrmat[i][j]
-        must_have_value=must_haves[i] and must_haves[j]
-        
-        if np.isnan(value):
-            if must_have_value:
-                return avgcorr
-            else:
-                return corr_with_no_data[i][j]
-        else:
-            return value
+    ## true where we need a value for both assets
+    must_haves=np.array(must_haves, dtype=bool)
+    must_have_value=must_haves[:, np.newaxis] & must_haves[np.newaxis, :]
+
+    ## missing values get the average correlation if we need them, otherwise the 'no data' value
+    replacement=np.where(must_have_value, avgcorr, np.array(corr_with_no_data, dtype=float))
+    corrmat=np.where(missing, replacement, corrmat)
 
-    corrmat=np.array([[_good_correlation(i,j, corrmat, avgcorr, must_haves,corr_with_no_data) 
-                       for i in size_range] for j in size_range], ndmin=2)
+    ## we've always built the cleaned matrix transposed; they're symmetric anyway
+    corrmat=np.array(corrmat.T, dtype=float)
 
     ## makes life easier and we'll deal with this later
     np.fill_diagonal(corrmat,1.0)
@@ -130,9 +126,12 @@ def correlation_single_period(data_for_estimate,
     It's important that forward filling, or index / ffill / diff has been done before we begin
     
     also that we're on the right time frame, eg weekly if that's what we're doing
+
+    If we're pooling and using an exponent, each member gets its own exponential correlation with 
+      the span as given, and we average those
     
     :param data_for_estimate: Data to get correlations from
-    :type data_for_estimate: pd.DataFrame
+    :type data_for_estimate: pd.DataFrame, list of them, or pooledData
 
     :param using_exponent: Should we use exponential weighting?
     :type using_exponent: bool 
@@ -152,16 +151,26 @@ def correlation_single_period(data_for_estimate,
     """
     ## These may come from config as str
     using_exponent=str2Bool(using_exponent)
-            
-    if using_exponent:
-        ## If we stack there will be duplicate dates
-        ## So we massage the span so it's correct
-        ## This assumes the index is at least daily and on same timestamp
-        ## This is an artifact of how we prepare the data
-        dindex=data_for_estimate.index
-        dlenadj=float(len(dindex))/len(set(list(dindex)))
+
+    if type(data_for_estimate) is list:
+        data_for_estimate=pooled_data_from_list(data_for_estimate)
+
+    if isinstance(data_for_estimate, pooledData):
+        if using_exponent:
+            ## each member is weighted over its own dates, with the span we were given; then we average
+            member_corr_list=[_exponential_correlation_snapshots(member_data.values.astype(float), int(ew_lookback), 
+                                                                 min_periods, [len(member_data)])[0]
+                              for member_data in data_for_estimate.member_frames()]
+            corrmat=average_member_correlations(member_corr_list)
+        else:
+            ## the same as a correlation over all the members' rows, without stacking them up
+            running_moments=runningMoments(data_for_estimate)
+            running_moments.set_window(None, None)
+            corrmat=running_moments.correlation(min_periods=min_periods, floor_at_zero=False)
+
+    elif using_exponent:
         ## Usual use for IDM, FDM calculation when whole data set is used
-        corrmat=pd.ewmcorr(data_for_estimate, span=int(ew_lookback*dlenadj), min_periods=min_periods)
+        corrmat=pd.ewmcorr(data_for_estimate, span=int(ew_lookback), min_periods=min_periods)
         
         ## only want the final one
         corrmat=corrmat.values[-1]
@@ -177,17 +186,357 @@ def correlation_single_period(data_for_estimate,
     return corrmat
 
 
+def average_member_correlations(member_corr_list):
+    """
+    Pooled correlation: the average of each member's correlation matrix, ignoring members without a value
+
+    :param member_corr_list: a correlation matrix for each member
+    :type member_corr_list: list of 2-dim square np.array
+
+    :returns: 2-dim square np.array, nan where no member has a value
+
+    >>> average_member_correlations([np.array([[1.0, 0.2], [0.2, 1.0]]), np.array([[1.0, np.nan], [np.nan, 1.0]]), 
+    ...                              np.array([[1.0, 0.6], [0.6, 1.0]])])
+    array([[ 1. ,  0.4],
+           [ 0.4,  1. ]])
+    """
+    with warnings.catch_warnings():
+        ## mean of empty slice, where no member has a value
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmean(np.array(member_corr_list, dtype=float), axis=0)
+
+
+def exponential_correlations_for_fit_periods(data, fit_dates, ew_lookback=250, min_periods=20, floor_at_zero=True):
+    """
+    Exponentially weighted correlations for each fitting period, as correlation_single_period with
+      using_exponent=True would give for data[fit_start:fit_end]
+
+    Rather than going over data from the start of the fitting period for each period, we run the 
+      exponential recursion once for each different fit_start (with an expanding window, that's once) 
+      and take the correlation matrix at each fit_end as we pass it
+
+    :param data: Data to get correlations from; index must be sorted, with no duplicates. 
+                 If pooled, each member is done on its own and we average them.
+    :type data: pd.DataFrame TxN, or pooledData
+
+    :param fit_dates: fitting periods
+    :type fit_dates: list of fitDates
+
+    :param ew_lookback: Lookback, in periods, for exp. weighting
+    :type ew_lookback: int 
+
+    :param min_periods: Minimum periods before we get a correlation
+    :type min_periods: int 
+
+    :param floor_at_zero: remove negative correlations before proceeding
+    :type floor_at_zero: bool or str
+
+    :returns: list of 2-dim square np.array; None for fitting periods with no data
+    """
+    if isinstance(data, pooledData):
+        member_corr_lists=[exponential_correlations_for_fit_periods(member_data, fit_dates, ew_lookback=ew_lookback, 
+                                                                    min_periods=min_periods, floor_at_zero=False)
+                           for member_data in data.member_frames()]
+
+        corr_list=[]
+        for (fit_period, member_corr_list) in zip(fit_dates, zip(*member_corr_lists)):
+            if fit_period.no_data:
+                corr_list.append(None)
+                continue
+
+            corrmat=average_member_correlations(member_corr_list)
+            if floor_at_zero:
+                corrmat[corrmat<0]=0.0
+            corr_list.append(corrmat)
+
+        return corr_list
+
+    corr_list=[None]*len(fit_dates)
+    values=data.values.astype(float)
+
+    ## periods which start fitting at the same date share one pass through the data
+    period_numbers_by_start=dict()
+    for (period_number, fit_period) in enumerate(fit_dates):
+        if not fit_period.no_data:
+            period_numbers_by_start.setdefault(fit_period.fit_start, []).append(period_number)
+
+    for (fit_start, period_numbers) in period_numbers_by_start.items():
+        start_row=data.index.searchsorted(fit_start, side="left")
+        end_rows=[data.index.searchsorted(fit_dates[period_number].fit_end, side="right") 
+                  for period_number in period_numbers]
+
+        snapshots=_exponential_correlation_snapshots(values[start_row:], int(ew_lookback), min_periods,
+                                                     [end_row-start_row for end_row in end_rows])
+
+        for (period_number, corrmat) in zip(period_numbers, snapshots):
+            if floor_at_zero:
+                corrmat[corrmat<0]=0.0
+            corr_list[period_number]=corrmat
+
+    return corr_list
+
+def _exponential_correlation_snapshots(values, span, min_periods, snapshot_lengths):
+    """
+    Pairwise exponentially weighted correlations, as pd.ewmcorr, for each of the first snapshot_lengths rows
+
+    Each pair only uses the rows where both have data, and weights decay across missing rows; 
+      this is the same recursion pandas uses (adjusted, not ignoring nans, biased covariance)
+
+    :param values: data
+    :type values: TxN np.array
+
+    :param snapshot_lengths: number of rows to use for each correlation matrix we want
+    :type snapshot_lengths: list of int
+
+    :returns: list of 2-dim square np.array, one for each of snapshot_lengths
+
+    >>> values=np.array([[1.0, 2.0], [2.0, 1.0], [3.0, 3.0], [np.nan, 1.0], [5.0, 4.0]])
+    >>> snapshots=_exponential_correlation_snapshots(values, 3, 2, [1, 3, 5])
+    >>> np.isnan(snapshots[0][0][1])
+    True
+    >>> np.allclose(snapshots[2][0][1], 0.9242692)
+    True
+    """
+    size=values.shape[1]
+    decay=1.0-2.0/(span+1.0)
+    min_periods=max(min_periods, 1)
+
+    ## [i, j] is over the rows where both i and j have data; nan means until we've seen any
+    mean_x=np.full((size, size), np.nan)
+    var_x=np.zeros((size, size))
+    covariance=np.zeros((size, size))
+    old_weight=np.ones((size, size))
+    observations=np.zeros((size, size))
+
+    snapshots=dict()
+    wanted_lengths=set(snapshot_lengths)
+
+    for row_number in range(max(snapshot_lengths+[0])):
+        row=values[row_number]
+        present=~np.isnan(row)
+        pair_present=present[:, np.newaxis] & present[np.newaxis, :]
+        x_values=np.repeat(row[:, np.newaxis], size, axis=1)
+
+        started=~np.isnan(mean_x)
+        updating=started & pair_present
+
+        old_weight=np.where(started, old_weight*decay, old_weight)
+
+        ## as pandas, don't move the mean if the value is equal to it (avoids rounding on constant series)
+        old_mean_x=mean_x
+        with np.errstate(invalid="ignore"):
+            new_mean_x=np.where(updating & (mean_x!=x_values), 
+                                (old_weight*old_mean_x+x_values)/(old_weight+1.0), mean_x)
+
+        x_move=old_mean_x-new_mean_x
+        x_deviation=x_values-new_mean_x
+
+        with np.errstate(invalid="ignore"):
+            new_covariance=(old_weight*(covariance+x_move*x_move.T)+x_deviation*x_deviation.T)/(old_weight+1.0)
+            new_var_x=(old_weight*(var_x+x_move*x_move)+x_deviation*x_deviation)/(old_weight+1.0)
+
+        covariance=np.where(updating, new_covariance, covariance)
+        var_x=np.where(updating, new_var_x, var_x)
+        mean_x=np.where(updating, new_mean_x, mean_x)
+        old_weight=np.where(updating, old_weight+1.0, old_weight)
+
+        ## first observation for a pair
+        mean_x=np.where(~started & pair_present, x_values, mean_x)
+
+        observations=observations+pair_present
+
+        if (row_number+1) in wanted_lengths:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                corrmat=covariance/np.sqrt(var_x*var_x.T)
+            corrmat[observations<min_periods]=np.nan
+            snapshots[row_number+1]=corrmat
+
+    corr_with_nan=np.full((size, size), np.nan)
+
+    return [copy(snapshots.get(snapshot_length, corr_with_nan)) for snapshot_length in snapshot_lengths]
+
 def boring_corr_matrix(size, offdiag=0.99, diag=1.0):
-    size_index=range(size)
-    def _od(offdag, i, j):
-        if i==j:
-            return diag
-        else:
-            return offdiag
-    m= [[_od(offdiag, i,j) for i in size_index] for j in size_index]
-    m=np.array(m)
+    """
+    >>> boring_corr_matrix(3, offdiag=0.5)
+    array([[ 1. ,  0.5,  0.5],
+           [ 0.5,  1. ,  0.5],
+           [ 0.5,  0.5,  1. ]])
+    """
+    m=np.full((size, size), offdiag, dtype=float)
+    np.fill_diagonal(m, diag)
     return m
 
+class runningMoments(object):
+    '''
+    Running sums of returns, squares and cross products for a window of some data
+
+    Moving the window only adds the rows that have come into it, and takes off the rows that have dropped
+      out of it, so with expanding or rolling fitting periods we don't have to go back over all the 
+      history each time
+
+    Gives the same answers as the non exponential estimators (mean_estimator, vol_estimator and 
+      correlation_single_period with using_exponent=False), up to rounding
+    '''
+
+    def __init__(self, data):
+        """
+        :param data: Data to get moments from; index must be sorted
+        :type data: pd.DataFrame TxN, or pooledData
+
+        """
+        values=data.values.astype(float)
+        present=~np.isnan(values)
+
+        ## take the first value off each column, so the sums of squares don't lose precision
+        first_row=np.argmax(present, axis=0)
+        shift=values[first_row, range(values.shape[1])]
+        shift[np.isnan(shift)]=0.0
+
+        size=values.shape[1]
+
+        setattr(self, "index", data.index)
+        setattr(self, "shift", shift)
+        setattr(self, "shifted_values", np.where(present, values-shift, 0.0))
+        setattr(self, "present", present.astype(float))
+
+        setattr(self, "start_row", 0)
+        setattr(self, "end_row", 0)
+        setattr(self, "row_count", 0)
+
+        ## [i, j] is over the rows where both i and j have data; so the diagonals are for i on its own
+        setattr(self, "pair_count", np.zeros((size, size)))
+        setattr(self, "pair_sum", np.zeros((size, size)))
+        setattr(self, "pair_sum_sq", np.zeros((size, size)))
+        setattr(self, "cross_sum", np.zeros((size, size)))
+
+    def set_window(self, start, end):
+        """
+        Move the window to cover data[start:end]
+
+        :param start: start of window (inclusive); None for the start of the data
+        :type start: datetime
+
+        :param end: end of window (inclusive); None for the end of the data
+        :type end: datetime
+        """
+        if start is None:
+            start_row=0
+        else:
+            start_row=self.index.searchsorted(start, side="left")
+
+        if end is None:
+            end_row=len(self.index)
+        else:
+            end_row=max(self.index.searchsorted(end, side="right"), start_row)
+
+        rows_changed=abs(start_row-self.start_row)+abs(end_row-self.end_row)
+
+        if rows_changed>(end_row-start_row):
+            ## quicker, and more accurate, to start again
+            self._reset()
+            self._update(start_row, end_row, 1.0)
+        else:
+            if start_row<self.start_row:
+                self._update(start_row, self.start_row, 1.0)
+            elif start_row>self.start_row:
+                self._update(self.start_row, start_row, -1.0)
+
+            if end_row>self.end_row:
+                self._update(self.end_row, end_row, 1.0)
+            elif end_row<self.end_row:
+                self._update(end_row, self.end_row, -1.0)
+
+        setattr(self, "start_row", start_row)
+        setattr(self, "end_row", end_row)
+
+    def _reset(self):
+        setattr(self, "row_count", 0)
+        for sum_name in ["pair_count", "pair_sum", "pair_sum_sq", "cross_sum"]:
+            getattr(self, sum_name)[:]=0.0
+
+    def _update(self, from_row, to_row, sign):
+        ## add (sign=1.0) or remove (sign=-1.0) some rows
+        values=self.shifted_values[from_row:to_row]
+        present=self.present[from_row:to_row]
+
+        self.row_count+=int(sign)*(to_row-from_row)
+        self.pair_count+=sign*present.T.dot(present)
+        self.pair_sum+=sign*values.T.dot(present)
+        self.pair_sum_sq+=sign*(values**2).T.dot(present)
+        self.cross_sum+=sign*values.T.dot(values)
+
+    def must_haves(self):
+        """
+        As must_have_item, for the current window
+
+        :returns: list of bool
+        """
+        return list(np.diag(self.pair_count)>0)
+
+    def means(self, min_periods=20):
+        """
+        As mean_estimator with using_exponent=False, for the current window, not annualised
+
+        :returns: list of float
+        """
+        count=np.diag(self.pair_count)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means=np.diag(self.pair_sum)/count+self.shift
+
+        ## same test as apply_with_min_periods
+        means[(self.row_count-count)<min_periods]=np.nan
+
+        return list(means)
+
+    def vol(self, min_periods=20):
+        """
+        As vol_estimator with using_exponent=False, for the current window, not annualised
+
+        :returns: list of float
+        """
+        count=np.diag(self.pair_count)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            shifted_mean=np.diag(self.pair_sum)/count
+            variance=np.diag(self.pair_sum_sq)/count-shifted_mean**2
+
+        stdevs=np.sqrt(np.maximum(variance, 0.0))
+        stdevs[(self.row_count-count)<min_periods]=np.nan
+
+        return list(stdevs)
+
+    def correlation(self, min_periods=20, floor_at_zero=True):
+        """
+        As correlation_single_period with using_exponent=False, for the current window
+
+        :returns: 2-dim square np.array
+        """
+        count=self.pair_count
+        sum_x=self.pair_sum
+        sum_y=self.pair_sum.T
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            covariance=self.cross_sum-sum_x*sum_y/count
+            x_sum_sq=np.maximum(self.pair_sum_sq-sum_x**2/count, 0.0)
+            y_sum_sq=x_sum_sq.T
+
+            divisor=np.sqrt(x_sum_sq*y_sum_sq)
+            corrmat=covariance/divisor
+
+        ## no variation, allowing for rounding
+        no_variation=(x_sum_sq<=ROUNDING_TOLERANCE*self.pair_sum_sq) | (y_sum_sq<=ROUNDING_TOLERANCE*self.pair_sum_sq.T)
+        corrmat[no_variation | (divisor==0.0)]=np.nan
+        corrmat[count<max(min_periods, 1)]=np.nan
+
+        diagonal=np.diag_indices_from(corrmat)
+        corrmat[diagonal]=np.where(np.isnan(corrmat[diagonal]), np.nan, 1.0)
+
+        corrmat=np.clip(corrmat, -1.0, 1.0)
+
+        if floor_at_zero:
+            corrmat[corrmat<0]=0.0
+
+        return corrmat
+
 class CorrelationList(object):
     '''
     A correlation list is a list of correlations, packed in with date information about them
@@ -233,15 +582,16 @@ class CorrelationEstimator(CorrelationList):
 
     def __init__(self, data, log=logtoscreen("optimiser"), frequency="W", date_method="expanding", 
                  rollyears=20, 
-                 dict_group=dict(), boring_offdiag=0.99, cleaning=True, **kwargs):
+                 dict_group=dict(), boring_offdiag=0.99, cleaning=True, incremental_moments=False, **kwargs):
         """
     
         We generate a correlation from eithier a pd.DataFrame, or a list of them if we're pooling
         
         Its important that forward filling, or index / ffill / diff has been done before we begin
                 
-        :param data: Data to get correlations from
-        :type data: pd.DataFrame or list if pooling
+        :param data: Data to get correlations from. If pooling each member is resampled on its own, 
+                     and never stacked up
+        :type data: pd.DataFrame, or list or pooledData if pooling
     
         :param frequency: Downsampling frequency. Must be "D", "W" or bigger
         :type frequency: str
@@ -257,6 +607,10 @@ class CorrelationEstimator(CorrelationList):
     
         :param boring_offdiag: Value used in creating 'boring' matrix, for when no data
         :type boring_offdiag: float 
+
+        :param incremental_moments: Keep running sums (or with using_exponent, run the exponential weighting once)
+                                    rather than going back over all the data for each period
+        :type incremental_moments: bool
     
         :param **kwargs: passed to correlation_single_period
         
@@ -264,14 +618,25 @@ class CorrelationEstimator(CorrelationList):
         """
 
         cleaning=str2Bool(cleaning)
+        incremental_moments=str2Bool(incremental_moments)
+        using_exponent=str2Bool(kwargs.get("using_exponent", True))
     
         ## grouping dictionary, convert to faster, algo friendly, form
         group_dict=group_dict_from_natural(dict_group)
 
-        data=df_from_list(data)    
-        column_names=list(data.columns)
+        if type(data) is list:
+            data=pooled_data_from_list(data)
+
+        if isinstance(data, pooledData):
+            data=pooled_data_from_list([member_data.resample(frequency, how="last") 
+                                        for member_data in data.member_frames()])
+
+            ## estimate directly from the pooled data, rather than going over it again for each period
+            incremental_moments=True
+        else:
+            data=data.resample(frequency, how="last")
 
-        data=data.resample(frequency, how="last")
+        column_names=list(data.columns)
             
         ### Generate time periods
         fit_dates = generate_fitting_dates(data, date_method=date_method, rollyears=rollyears)
@@ -283,9 +648,20 @@ class CorrelationEstimator(CorrelationList):
         corr_list=[]
         
         log.terse("Correlation estimate")
+
+        ew_corr_list=None
+        running_moments=None
+        if incremental_moments and using_exponent:
+            ## one pass through the data (or through each member, if pooled), rather than one for each period
+            ew_corr_list=exponential_correlations_for_fit_periods(data, fit_dates, 
+                                                                 ew_lookback=kwargs.get("ew_lookback", 250), 
+                                                                 min_periods=kwargs.get("min_periods", 20),
+                                                                 floor_at_zero=kwargs.get("floor_at_zero", True))
+        elif incremental_moments and not using_exponent:
+            running_moments=runningMoments(data)
         
         ## Now for each time period, estimate correlation
-        for fit_period in fit_dates:
+        for (period_number, fit_period) in enumerate(fit_dates):
             log.msg("Estimating from %s to %s" % (fit_period.period_start, fit_period.period_end))
             
             if fit_period.no_data:
@@ -293,6 +669,14 @@ class CorrelationEstimator(CorrelationList):
                 corr_with_nan=boring_corr_matrix(size, offdiag=np.nan, diag=np.nan)
                 corrmat=corr_with_nan
                 
+            elif ew_corr_list is not None:
+                corrmat=ew_corr_list[period_number]
+
+            elif running_moments is not None:
+                running_moments.set_window(fit_period.fit_start, fit_period.fit_end)
+                corrmat=running_moments.correlation(min_periods=kwargs.get("min_periods", 20),
+                                                    floor_at_zero=kwargs.get("floor_at_zero", True))
+
             else:
                 
                 data_for_estimate=data[fit_period.fit_start:fit_period.fit_end] 
@@ -301,8 +685,11 @@ class CorrelationEstimator(CorrelationList):
                                                      **kwargs)
 
             if cleaning:
-                current_period_data=data[fit_period.fit_start:fit_period.fit_end] 
-                must_haves=must_have_item(current_period_data)
+                if running_moments is not None and not fit_period.no_data:
+                    must_haves=running_moments.must_haves()
+                else:
+                    current_period_data=data[fit_period.fit_start:fit_period.fit_end] 
+                    must_haves=must_have_item(current_period_data)
 
                 # means we can use earlier correlations with sensible values
                 corrmat=clean_correlation(corrmat, corr_with_no_data, must_haves) 
@@ -42,8 +42,41 @@ def diversification_mult_single_period(corrmatrix, weights, dm_max=2.5):
 
     return dm
 
+def diversification_mult_batch(corr_array, weights, dm_max=2.5):
+    """
+    As diversification_mult_single_period, but for a number of correlation matrices and weights at once
+
+    :param corr_array: Correlation matrices
+    :type corr_array: np.array P x N x N
+
+    :param weights: Weights of assets, one row for each correlation matrix
+    :type weights: np.array P x N
+
+    :param dm_max: Max value
+    :type dm_max: float
+
+    :returns: np.array of length P
+
+    >>> corr_array=np.array([[[1.0,0.0], [0.0,1.0]], [[1.0,1.0], [1.0,1.0]], [[1.0,0.0], [0.0,1.0]]])
+    >>> weights=np.array([[.5,.5], [.5,.5], [0.0, 0.0]])
+    >>> np.allclose(diversification_mult_batch(corr_array, weights), [2.0**.5, 1.0, 1.0])
+    True
+    """
+    weights=np.array(weights, dtype=float, ndmin=2)
+
+    ## one quadratic form for each row
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dm=1.0 / np.einsum("pi,pij,pj->p", weights, corr_array, weights)**.5
+    dm=np.minimum(dm, dm_max)
+
+    ## edge cases...
+    no_weights=np.all(weights==0.0, axis=1) | np.all(np.isnan(weights), axis=1)
+    dm[no_weights]=1.0
+
+    return dm
+
 def diversification_multiplier_from_list(correlation_list_object, weight_df_raw, 
-                                         ewma_span=125,  **kwargs):
+                                         ewma_span=125, daily_dm=False, dm_max=2.5, **ignored_args):
     """
     Given a CorrelationList object, and a dataframe of weights, work out the div multiplier
 
@@ -56,40 +89,59 @@ def diversification_multiplier_from_list(correlation_list_object, weight_df_raw,
     :param ewma_span: Smoothing parameter to use on output (1= no smoothing)
     :type ewma_span: int
 
-    :param max: Maximum allowable value
-    :type max: float
+    :param daily_dm: Work out the multiplier every day, from that day's weights, rather than once a fitting period
+    :type daily_dm: bool
+
+    :param dm_max: Maximum allowable value
+    :type dm_max: float
+
+    Other arguments are ignored
 
-    :param **kwargs: Used for single period calculation 
-    
     :returns: Tx1 pd.Series
     
     """
     ## align weights to corr list
     weight_df=weight_df_raw[correlation_list_object.columns]
+    weight_values=weight_df.values
 
     ref_periods=[fit_period.period_start for fit_period in correlation_list_object.fit_dates]
-    
-    ## here's where we stack up the answers
-    div_mult_vector=[]
-    
-    for (corrmatrix, start_of_period) in zip(correlation_list_object.corr_list, ref_periods):
-    
-        weight_slice=weight_df[:start_of_period]
-        if weight_slice.shape[0]==0:
-            div_mult_vector.append(1.0)
-            continue
-        
-        weights=list(weight_slice.iloc[-1,:].values)
-        div_multiplier=diversification_mult_single_period(corrmatrix, weights,  **kwargs)
-        
-        div_mult_vector.append(div_multiplier)
-    
-    div_mult_df=pd.Series(div_mult_vector,  index=ref_periods)
-    div_mult_df=div_mult_df.reindex(weight_df.index, method="ffill")
+    asset_count=len(correlation_list_object.columns)
+    corr_array=np.array(correlation_list_object.corr_list, dtype=float).reshape(len(ref_periods), asset_count, asset_count)
+
+    if str2Bool(daily_dm):
+        div_mult_df=_daily_diversification_multiplier(corr_array, ref_periods, weight_df, dm_max)
+    else:
+        ## the last weights on or before the start of each period, as weight_df[:start_of_period]
+        weight_rows=weight_df.index.searchsorted(ref_periods, side="right")-1
+        have_weights=weight_rows>=0
+
+        div_mult_vector=np.ones(len(ref_periods))
+        div_mult_vector[have_weights]=diversification_mult_batch(corr_array[have_weights], 
+                                                    weight_values[weight_rows[have_weights]], dm_max=dm_max)
+
+        div_mult_df=pd.Series(div_mult_vector,  index=ref_periods)
+        div_mult_df=div_mult_df.reindex(weight_df.index, method="ffill")
     
     div_mult_df=pd.ewma(div_mult_df, span=ewma_span)
     
     return div_mult_df
+
+def _daily_diversification_multiplier(corr_array, ref_periods, weight_df, dm_max):
+    ## each day uses the correlation matrix for the period it's in; before the first period we don't have one
+    weight_values=weight_df.values
+    period_starts=weight_df.index.searchsorted(ref_periods, side="left")
+    period_ends=list(period_starts[1:])+[len(weight_df.index)]
+
+    div_mult_vector=np.full(len(weight_df.index), np.nan)
+    for (corrmatrix, period_start, period_end) in zip(corr_array, period_starts, period_ends):
+        if period_end<=period_start:
+            continue
+        
+        period_weights=weight_values[period_start:period_end]
+        period_corr=np.broadcast_to(corrmatrix, (period_end-period_start,)+corrmatrix.shape)
+        div_mult_vector[period_start:period_end]=diversification_mult_batch(period_corr, period_weights, dm_max=dm_max)
+
+    return pd.Series(div_mult_vector, index=weight_df.index)
     
 if __name__ == '__main__':
     import doctest
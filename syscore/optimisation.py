@@ -10,17 +10,30 @@ import datetime
 from scipy.optimize import minimize
 from copy import copy
 import random
+import multiprocessing
+import warnings
+import os
+import pickle
+import tempfile
+import hashlib
 
 from syscore.algos import vol_estimator, mean_estimator
-from syscore.correlations import correlation_single_period, boring_corr_matrix, get_avg_corr
+from syscore.correlations import correlation_single_period, boring_corr_matrix, get_avg_corr, runningMoments, ROUNDING_TOLERANCE
 from syscore.dateutils import generate_fitting_dates, BUSINESS_DAYS_IN_YEAR, WEEKS_IN_YEAR, MONTHS_IN_YEAR
 from syscore.genutils import str2Bool
-from syscore.pdutils import df_from_list, must_have_item
+from syscore.pdutils import df_from_list, must_have_item, pooledData, pooled_data_from_list
 from syscore.objects import resolve_function
 from syslogdiag.log import logtoscreen
 
 TARGET_ANN_SR=0.5
 FLAG_BAD_RETURN=-9999999.9
+DIAGNOSTIC_LEVELS=["none", "summary", "full"]
+
+## most correlation matrix elements to work out at once for batched bootstraps
+PAIRWISE_CHUNK_SIZE=1000000
+
+## change this if a code change means cached optimisation results are no longer valid
+RESULT_CACHE_VERSION=2
 
 class GenericOptimiser(object):
 
@@ -28,7 +41,8 @@ class GenericOptimiser(object):
                          rollyears=20, method="bootstrap", cleaning=True, 
                          cost_multiplier=1.0, apply_cost_weight=True, 
                          ann_target_SR=TARGET_ANN_SR, equalise_gross=False,
-                         **passed_params):
+                         seed=None, workers=1, incremental_moments=False,
+                         diagnostics="summary", diagnostics_path=None, result_cache_path=None, **passed_params):
         
         """
     
@@ -55,6 +69,25 @@ class GenericOptimiser(object):
         :param apply_cost_weight: Should we adjust our weightings to reflect costs?
         :type apply_cost_weight: bool
 
+        :param seed: Seed for random numbers (used when bootstrapping), so results can be repeated. None to not seed.
+        :type seed: int or None
+
+        :param workers: Number of processes to optimise the fitting periods over
+        :type workers: int
+
+        :param incremental_moments: Estimate moments for each period with running sums, rather than going back over 
+                                    all the data each time. Only for 'one_period' and 'shrinkage' with non exponential estimates
+        :type incremental_moments: bool
+
+        :param diagnostics: What to keep about each optimisation: 'none', 'summary' (weights and average moments) or 'full'
+        :type diagnostics: str
+
+        :param diagnostics_path: With full diagnostics, directory to write them to rather than keeping them in memory. None to keep in memory
+        :type diagnostics_path: str or None
+
+        :param result_cache_path: Directory to keep optimisation results in, so the same optimisation of the same data is only done once. None for no cache
+        :type result_cache_path: str or None
+
         :param *_estimate_params: dicts of **kwargs to pass to moments estimation, and optimisation functions
         
         :returns: pd.DataFrame of weights
@@ -77,7 +110,18 @@ class GenericOptimiser(object):
         moments_estimator=momentsEstimator(optimise_params, annualisation,  ann_target_SR)
 
         ## The optimiser instance will do the optimation once we have the appropriate data
-        optimiser=optimiserWithParams(method, optimise_params, moments_estimator)
+        optimiser=optimiserWithParams(method, optimise_params, moments_estimator,
+                                      diagnostics=diagnostics, diagnostics_path=diagnostics_path)
+
+        ## everything else that changes the results of optimising a given set of data
+        ## (frequency, costs and so on have already been applied to the data)
+        result_params=dict(method=method, annualisation=annualisation,
+                           optimise_params=dict([(key, value) for (key, value) in optimise_params.items()
+                                                 if key!="bootstrap_workers"]),
+                           ann_target_SR=ann_target_SR, cleaning=cleaning, seed=seed,
+                           incremental_moments=str2Bool(incremental_moments),
+                           diagnostics=optimiser.diagnostics, diagnostics_path=diagnostics_path,
+                           version=RESULT_CACHE_VERSION)
 
         setattr(self, "optimiser", optimiser)
         setattr(self, "log", log)
@@ -91,6 +135,12 @@ class GenericOptimiser(object):
         setattr(self, "rollyears", rollyears)
         setattr(self, "cleaning", cleaning)
         setattr(self, "apply_cost_weight", apply_cost_weight)
+        setattr(self, "seed", seed)
+        setattr(self, "workers", int(workers))
+        setattr(self, "incremental_moments", str2Bool(incremental_moments))
+        setattr(self, "diagnostics", optimiser.diagnostics)
+        setattr(self, "result_params", result_params)
+        setattr(self, "result_cache_path", result_cache_path)
 
     def need_data(self):
         if self.method=="equal_weights":
@@ -132,9 +182,9 @@ class GenericOptimiser(object):
         data_costs = [data_item.cumsum().resample(frequency, how="last").diff() for
                       data_item in data_costs]
 
-        ## stack de-pool pooled data    
-        data_gross=df_from_list(data_gross)    
-        data_costs=df_from_list(data_costs)    
+        ## pool data; without stacking it up, but anything that wants a stacked frame can treat it as one
+        data_gross=pooled_data_from_list(data_gross)    
+        data_costs=pooled_data_from_list(data_costs)    
         
         ## net gross and costs
         if equalise_gross:
@@ -161,8 +211,6 @@ class GenericOptimiser(object):
         log=self.log
         date_method = self.date_method
         rollyears = self.rollyears
-        optimiser = self.optimiser
-        cleaning = self.cleaning
         apply_cost_weight = self.apply_cost_weight
         
         data=getattr(self, "data", None)
@@ -171,22 +219,82 @@ class GenericOptimiser(object):
         
         fit_dates = generate_fitting_dates(data, date_method=date_method, rollyears=rollyears)
         setattr(self, "fit_dates", fit_dates)
+
+        if self.result_cache_path is None:
+            (opt_results, raw_weight_df)=self.optimise_periods(data, fit_dates)
+        else:
+            cache_key=optimisation_result_key(data, fit_dates, self.result_params)
+            cached_result=get_cached_result(self.result_cache_path, cache_key)
+            if cached_result is None:
+                (opt_results, raw_weight_df)=self.optimise_periods(data, fit_dates)
+                put_cached_result(self.result_cache_path, cache_key, (opt_results, raw_weight_df))
+            else:
+                log.terse("Using cached optimisation results")
+                (opt_results, raw_weight_df)=cached_result
+
+        if apply_cost_weight:
+            log.terse("Applying cost weighting to optimisation results")
+            weight_df = apply_cost_weighting(raw_weight_df, ann_SR_costs)
+        else:
+            weight_df =raw_weight_df 
+        
+        setattr(self, "results", opt_results)
+        setattr(self, "weights", weight_df)
+        setattr(self, "raw_weights", raw_weight_df)
+
+    def optimise_periods(self, data, fit_dates):
+        """
+        Optimise each fitting period
+
+        :param data: Returns data, as set up by .set_up_data()
+        :type data: pd.DataFrame or pooledData
+
+        :param fit_dates: Fitting periods, from generate_fitting_dates
+        :type fit_dates: list of fit_dates_object
+
+        :returns: tuple: list of optSinglePeriod, pd.DataFrame of raw weights
+        """
+        log=self.log
+        optimiser = self.optimiser
+
+        if self.incremental_moments and optimiser.uses_period_moments():
+            ## work these out in one pass, before we split the periods up
+            moments_list=optimiser.moments_estimator.moments_for_fit_periods(data, fit_dates)
+        else:
+            moments_list=[None]*len(fit_dates)
+
     
         ## Now for each time period, estimate weights
         ## create a list of weight vectors
         weight_list=[]
         
-        ## create a class object for each period
-        opt_results=[]
-        
         log.terse("Optimising...")
-        
-        for fit_period in fit_dates:
-            log.msg("Optimising for data from %s to %s" % (str(fit_period.period_start), str(fit_period.period_end)))
-            ## Do the optimisation for one period, using a particular optimiser instance
-            results_this_period=optSinglePeriod(self, data, fit_period, optimiser, cleaning)
 
-            opt_results.append(results_this_period)
+        ## Each period is independent, so we can do them in any order, or at the same time.
+        ## Every period's solver starts from the same place (not the previous period's weights),
+        ## so the weights don't depend on how many processes we use
+        period_list=list(enumerate(zip(fit_dates, moments_list)))
+
+        if self.workers > 1:
+            if in_pool_process():
+                ## eg optimising instruments in parallel, so we can't start a pool
+                log.warn("Already in a pool process, so optimising periods one at a time")
+            else:
+                log.terse("Using %d processes" % self.workers)
+
+        ## Do the optimisation for each period, using a particular optimiser instance
+        ## create a class object for each period
+        if self.workers > 1 and not in_pool_process():
+            ## every period's data has to be sliced up front to send it to the pool
+            period_task_list=[self._period_task(data, period_number, fit_period, period_moments)
+                              for (period_number, (fit_period, period_moments)) in period_list]
+            opt_results=map_in_pool(_opt_single_period_task, period_task_list, self.workers)
+        else:
+            ## one at a time, slicing each period's data as we get to it
+            opt_results=[_opt_single_period_task(self._period_task(data, period_number, fit_period, period_moments))
+                         for (period_number, (fit_period, period_moments)) in period_list]
+
+        for (fit_period, results_this_period) in zip(fit_dates, opt_results):
 
             weights=results_this_period.weights
             
@@ -201,17 +309,225 @@ class GenericOptimiser(object):
         ## Stack everything up    
         raw_weight_df=pd.concat(weight_list, axis=0)
 
+        return (opt_results, raw_weight_df)
 
-        
-        if apply_cost_weight:
-            log.terse("Applying cost weighting to optimisation results")
-            weight_df = apply_cost_weighting(raw_weight_df, ann_SR_costs)
-        else:
-            weight_df =raw_weight_df 
-        
-        setattr(self, "results", opt_results)
-        setattr(self, "weights", weight_df)
-        setattr(self, "raw_weights", raw_weight_df)
+    def _period_task(self, data, period_number, fit_period, period_moments):
+        """
+        Task for _opt_single_period_task to optimise one fitting period
+
+        :returns: tuple: data, fit_period, optimiser, cleaning, seed, moments
+        """
+        self.log.msg("Optimising for data from %s to %s" % (str(fit_period.period_start), str(fit_period.period_end)))
+
+        ## each period gets its own seed, so we get the same answer whichever process, and in whatever order, we're run
+        period_seed = period_seed_from_seed(self.seed, period_number)
+
+        ## only pass on the data this period needs
+        period_data = data[min(fit_period.fit_start, fit_period.period_start):max(fit_period.fit_end, fit_period.period_end)]
+
+        return (period_data, fit_period, self.optimiser, self.cleaning, period_seed, period_moments)
+
+
+def period_seed_from_seed(seed, period_number):
+    """
+    Seed to use for a particular fitting period
+
+    >>> period_seed_from_seed(None, 3) is None
+    True
+    >>> period_seed_from_seed(10, 3)
+    13
+    """
+    if seed is None:
+        return None
+
+    return int(seed) + period_number
+
+def optimisation_result_key(data, fit_dates, result_params):
+    """
+    A key which identifies an optimisation: the data, the fitting periods, and the parameters
+
+    :param data: Returns data, as set up by GenericOptimiser.set_up_data()
+    :type data: pd.DataFrame or pooledData
+
+    :param fit_dates: Fitting periods, from generate_fitting_dates
+    :type fit_dates: list of fit_dates_object
+
+    :param result_params: Anything else that affects the result
+    :type result_params: dict
+
+    :returns: str
+
+    >>> data=pd.DataFrame(dict(a=[1.0, np.nan, 3.0]), index=pd.date_range(pd.datetime(2015, 1, 1), periods=3))
+    >>> key=optimisation_result_key(data, [], dict(method="shrinkage", seed=None))
+    >>> key==optimisation_result_key(data.copy(), [], dict(seed=None, method="shrinkage"))
+    True
+    >>> key==optimisation_result_key(data*2.0, [], dict(method="shrinkage", seed=None))
+    False
+    """
+    key_hash=hashlib.md5()
+
+    values=np.ascontiguousarray(np.array(data.values, dtype=float))
+    key_hash.update(values.tobytes())
+    key_hash.update(str(values.shape).encode("utf-8"))
+    try:
+        index_values=np.array(data.index, dtype="datetime64[ns]")
+    except (TypeError, ValueError):
+        index_values=np.array([str(index_item) for index_item in data.index])
+    key_hash.update(np.ascontiguousarray(index_values).tobytes())
+    key_hash.update(str(list(data.columns)).encode("utf-8"))
+
+    key_hash.update(str([str(fit_period) for fit_period in fit_dates]).encode("utf-8"))
+    key_hash.update(_canonical_str(result_params).encode("utf-8"))
+
+    return key_hash.hexdigest()
+
+def _canonical_str(item):
+    ## str() of a dict depends on the order keys were added
+    if isinstance(item, dict):
+        return "{%s}" % ", ".join(["%s: %s" % (str(key), _canonical_str(item[key]))
+                                   for key in sorted(item.keys(), key=str)])
+    if isinstance(item, (list, tuple)):
+        return "[%s]" % ", ".join([_canonical_str(sub_item) for sub_item in item])
+
+    return repr(item)
+
+def _result_cache_filename(result_cache_path, cache_key):
+    return os.path.join(result_cache_path, "optresult_%s.pck" % cache_key)
+
+def get_cached_result(result_cache_path, cache_key):
+    """
+    Get an optimisation result from the cache
+
+    :param result_cache_path: Directory the cache is in
+    :type result_cache_path: str
+
+    :param cache_key: from optimisation_result_key
+    :type cache_key: str
+
+    :returns: whatever was put in the cache, or None if it isn't there
+    """
+    filename=_result_cache_filename(result_cache_path, cache_key)
+    if not os.path.exists(filename):
+        return None
+
+    try:
+        with open(filename, "rb") as fhandle:
+            return pickle.load(fhandle)
+    except Exception:
+        ## eg written by an incompatible version; we'll just do the optimisation again
+        return None
+
+def put_cached_result(result_cache_path, cache_key, result):
+    """
+    Put an optimisation result in the cache
+
+    The file is written under a temporary name and then renamed, so other systems (or processes) using the
+    same cache never see half a file.
+
+    :param result_cache_path: Directory the cache is in, created if it doesn't exist
+    :type result_cache_path: str
+
+    :param cache_key: from optimisation_result_key
+    :type cache_key: str
+
+    :param result: anything that can be pickled
+
+    :returns: None
+    """
+    os.makedirs(result_cache_path, exist_ok=True)
+
+    (file_number, temp_filename)=tempfile.mkstemp(prefix="optresult_", suffix=".tmp", dir=result_cache_path)
+    with os.fdopen(file_number, "wb") as fhandle:
+        pickle.dump(result, fhandle)
+
+    os.replace(temp_filename, _result_cache_filename(result_cache_path, cache_key))
+
+def fit_weighting_object(weight_func, ann_SR_costs=None, **data):
+    """
+    Set up some data in a weighting object (eg a GenericOptimiser), and optimise it
+
+    :param weight_func: weighting object
+    :type weight_func: GenericOptimiser, or anything with the same methods
+
+    :param ann_SR_costs: Annualised costs in SR units, passed to .optimise()
+    :type ann_SR_costs: list of float
+
+    :param data: keyword arguments for .set_up_data(), eg data_gross and data_costs
+    
+    :returns: weighting object, now optimised
+    """
+    weight_func.set_up_data(**data)
+    weight_func.optimise(ann_SR_costs=ann_SR_costs)
+
+    return weight_func
+
+def _fit_weighting_object_from_task(task):
+    ## pool.map passes a single argument
+    return fit_weighting_object(**task)
+
+def fit_weighting_objects_in_pool(task_list, workers=1):
+    """
+    Call fit_weighting_object on a number of independent tasks, using a pool of processes
+
+    :param task_list: keyword arguments for fit_weighting_object
+    :type task_list: list of dict
+
+    :param workers: Number of processes. If one, everything happens in this process
+    :type workers: int
+
+    :returns: list of optimised weighting objects, in the same order as task_list
+    """
+    return map_in_pool(_fit_weighting_object_from_task, task_list, workers)
+
+def _reseed_random():
+    """
+    Seed random from the operating system, in a new pool process
+
+    Periods with a seed set it themselves, so this only matters when the seed is None
+    """
+    random.seed()
+
+
+def map_in_pool(func, arg_list, workers=1):
+    """
+    [func(arg) for arg in arg_list], using a pool of processes if workers is more than one
+
+    func must be defined at the top level of a module so it can be sent to other processes.
+    If we're already in a pool process everything happens here, as those can't start their own pool.
+
+    :param func: function of one argument
+    :type func: function
+
+    :param arg_list: arguments
+    :type arg_list: list
+
+    :param workers: Number of processes
+    :type workers: int
+
+    :returns: list, same order as arg_list
+    """
+    workers = int(workers)
+    if workers <= 1 or len(arg_list) < 2 or in_pool_process():
+        return [func(arg) for arg in arg_list]
+
+    ## before python 3.7 forked processes all start with the same random state, so give each its own
+    pool = multiprocessing.Pool(min(workers, len(arg_list)), initializer=_reseed_random)
+    try:
+        results = pool.map(func, arg_list)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def in_pool_process():
+    """
+    Are we running in a pool process? If so we can't start another pool
+    
+    :returns: bool
+    """
+    return multiprocessing.current_process().daemon
 
 
 def display_warnings(log, cost_multiplier, equalise_gross, apply_cost_weight,  method, equalise_SR, **ignored_passed_params):
@@ -253,7 +569,7 @@ def work_out_net(data_gross, data_costs, annualisation=BUSINESS_DAYS_IN_YEAR,
                  equalise_gross=False, cost_multiplier=1.0,
                  period_target_SR=TARGET_ANN_SR/(BUSINESS_DAYS_IN_YEAR**.5)):
     """
-    Work out the net from a dataframe of gross and costs
+    Work out the net from a dataframe (or pooledData) of gross and costs
     """
     
     if equalise_gross:
@@ -268,10 +584,8 @@ def work_out_net(data_gross, data_costs, annualisation=BUSINESS_DAYS_IN_YEAR,
         
         actual_period_mean=data_gross.mean().values
         
-        ## adjustments to make to get equal mean
+        ## adjustments to make to get equal mean; the same for every row
         shifts = target_mean - actual_period_mean
-        shifts = np.array([list(shifts)]*len(data_gross.index))
-        shifts=pd.DataFrame(shifts, index=data_gross.index, columns=data_gross.columns)
     
         use_gross = data_gross + shifts
     
@@ -367,12 +681,80 @@ class momentsEstimator(object):
         return stdev_list
 
     def moments(self, data_for_estimate):
+        if isinstance(data_for_estimate, pooledData):
+            return self.pooled_moments(data_for_estimate)
+
         ans=(self.means(data_for_estimate), self.correlation(data_for_estimate),  self.vol(data_for_estimate))
         return ans
 
+    def pooled_moments(self, pooled_data):
+        """
+        Moments from pooled data, as moments would give for the stacked up frame
+
+        With the non exponential estimators we add up across pool members directly; otherwise
+          the estimators need a frame, so we stack it up
+
+        :param pooled_data: data to estimate from
+        :type pooled_data: pooledData
+
+        :returns: tuple (mean_list, corrmatrix, stdev_list)
+        """
+        simple_params = _simple_moments_params(self)
+
+        if simple_params is None:
+            return self.moments(pooled_data.stacked())
+
+        running_moments=runningMoments(pooled_data)
+        running_moments.set_window(None, None)
+
+        return self._moments_from_running(running_moments, simple_params)
+
+    def _moments_from_running(self, running_moments, simple_params):
+        ([mean_min_periods, vol_min_periods, corr_min_periods], floor_at_zero) = simple_params
+
+        mean_list=list(np.array(running_moments.means(mean_min_periods))*self.annualisation)
+        corrmatrix=running_moments.correlation(corr_min_periods, floor_at_zero)
+        stdev_list=list(np.array(running_moments.vol(vol_min_periods))*(self.annualisation**.5))
+
+        return (mean_list, corrmatrix, stdev_list)
+
+    def moments_for_fit_periods(self, data, fit_dates):
+        """
+        Moments for the fitting data in each of fit_dates, as moments would give
+
+        With the non exponential estimators we keep running sums, so each period only adds 
+          (and for rolling windows, removes) the data that has changed since the last one.
+          Otherwise, or if there's no fitting data, we get None for that period
+
+        :param data: all the data
+        :type data: pd.DataFrame TxN, or pooledData
+
+        :param fit_dates: fitting periods
+        :type fit_dates: list of fitDates
+
+        :returns: list of tuples (mean_list, corrmatrix, stdev_list) or None
+        """
+        simple_params = _simple_moments_params(self)
+
+        if simple_params is None or not data.index.is_monotonic_increasing:
+            return [None]*len(fit_dates)
+
+        running_moments=runningMoments(data)
+
+        moments_list=[]
+        for fit_period in fit_dates:
+            if fit_period.no_data:
+                moments_list.append(None)
+                continue
+
+            running_moments.set_window(fit_period.fit_start, fit_period.fit_end)
+            moments_list.append(self._moments_from_running(running_moments, simple_params))
+
+        return moments_list
+
 
 class optimiserWithParams(object):
-    def __init__(self, method, optimise_params, moments_estimator):
+    def __init__(self, method, optimise_params, moments_estimator, diagnostics="summary", diagnostics_path=None):
         """
         Create an object which does an optimisation for a single period, according to the parameters
         
@@ -381,6 +763,12 @@ class optimiserWithParams(object):
 
         :param moments_estimator: An instance of a moments estimator
         :type optimise_params: momentsEstimator
+
+        :param diagnostics: How much diagnostic information to keep, one of DIAGNOSTIC_LEVELS (None is 'none')
+        :type diagnostics: str
+
+        :param diagnostics_path: Directory to spool full diagnostics to; None to keep them in memory
+        :type diagnostics_path: str or None
     
         
         """
@@ -398,14 +786,46 @@ class optimiserWithParams(object):
         setattr(self, "params", optimise_params)
         
         setattr(self, "moments_estimator", moments_estimator)
+        setattr(self, "method", method)
+
+        if diagnostics is None:
+            diagnostics="none"
+
+        if diagnostics not in DIAGNOSTIC_LEVELS:
+            raise Exception("Diagnostics level %s unknown; try one of: %s " % (diagnostics, ", ".join(DIAGNOSTIC_LEVELS)))
+
+        setattr(self, "diagnostics", diagnostics)
+        setattr(self, "diagnostics_path", diagnostics_path)
+
+    def uses_period_moments(self):
+        ## these methods estimate moments once, from all the data in the fitting period
+        return self.method in ["one_period", "shrinkage"]
         
-    def call(self, optimise_data, cleaning, must_haves):
+    def call(self, optimise_data, cleaning, must_haves, seed=None, start_weights=None, moments=None):
         
         params=self.params
-        return self.opt_func(optimise_data, self.moments_estimator, cleaning, must_haves, **params)
+        if moments is not None:
+            ## already estimated for us
+            params=copy(params)
+            params["moments"]=moments
+
+        return self.opt_func(optimise_data, self.moments_estimator, cleaning, must_haves, 
+                             seed=seed, start_weights=start_weights, **params)
+
+    def diag_to_keep(self, diag):
+        return diag_for_level(diag, self.diagnostics, self.diagnostics_path)
+
+def _opt_single_period_task(task):
+    ## pool.map passes a single argument
+    (data, fit_period, optimiser, cleaning, seed, moments) = task
+    return optSinglePeriod(None, data, fit_period, optimiser, cleaning, seed=seed, moments=moments)
 
 class optSinglePeriod(object):
-    def __init__(self, parent, data, fit_period, optimiser, cleaning):
+    def __init__(self, parent, data, fit_period, optimiser, cleaning, seed=None, start_weights=None, moments=None):
+
+        if seed is not None:
+            ## for anything using the standard random module
+            random.seed(seed)
 
         if cleaning:
             ### Generate 'must have' from the period we need
@@ -434,19 +854,140 @@ class optSinglePeriod(object):
             subset_fitting_data=data[fit_period.fit_start:fit_period.fit_end]
     
 
-            (weights, diag)=optimiser.call(subset_fitting_data, cleaning, must_haves)
+            (weights, diag)=optimiser.call(subset_fitting_data, cleaning, must_haves, seed=seed, 
+                                           start_weights=start_weights, moments=moments)
             
-        ##
-        setattr(self, "diag", diag)
+        ## only keep as much as we've been asked to; done here so less comes back from other processes
+        setattr(self, "diag", optimiser.diag_to_keep(diag))
         setattr(self, "weights", weights)
 
 
+def diag_for_level(diag, diagnostics="summary", diagnostics_path=None):
+    """
+    Cut down the diag dict from an optimisation to the level of diagnostics we want to keep
+
+    :param diag: diagnostics from an optimisation function, or None
+    :type diag: dict
+
+    :param diagnostics: One of DIAGNOSTIC_LEVELS
+    :type diagnostics: str
+
+    :param diagnostics_path: With 'full', directory to spool to. None to keep in memory
+    :type diagnostics_path: str or None
+
+    :returns: None, dict (see summarise_diag), the original dict, or a spooledDiag
+
+    >>> diag=dict(raw=([1.0, 2.0], np.array([[1.0, 0.5], [0.5, 1.0]]), [0.1, 0.2]), sigma=None,
+    ...           mean_list=[1.0, 2.0], unclean=[0.4, 0.6], weights=[0.4, 0.6])
+    >>> diag_for_level(diag, "none") is None
+    True
+    >>> diag_for_level(diag, "summary")["avg_corr"]
+    0.5
+    >>> diag_for_level(dict(bootstraps=[diag, diag]), "summary")["monte_runs"]
+    2
+    """
+    if diag is None or diagnostics=="none":
+        return None
+
+    if diagnostics=="summary":
+        return summarise_diag(diag)
+
+    if diagnostics_path is None:
+        return diag
+
+    return spool_diag(diag, diagnostics_path)
+
+
+def summarise_diag(diag):
+    """
+    Summary statistics from the diag dict of an optimisation
+
+    For a single optimisation we keep the raw means and standard deviations, the average correlation, and
+    the weights before and after cleaning. For a bootstrap these are averaged over the runs, and we also
+    keep the number of runs and the standard deviation of the weights across them.
+
+    :param diag: diagnostics from an optimisation function
+    :type diag: dict
+
+    :returns: dict
+    """
+    if "bootstraps" in diag:
+        run_summaries=[summarise_diag(run_diag) for run_diag in diag["bootstraps"]]
+
+        def _run_average(keyname):
+            values=np.array([run_summary[keyname] for run_summary in run_summaries], dtype=float)
+            with warnings.catch_warnings():
+                ## assets with no data in any run
+                warnings.simplefilter("ignore", category=RuntimeWarning)
+                return np.nanmean(values, axis=0)
+
+        weights=np.array([run_summary["weights"] for run_summary in run_summaries], dtype=float)
+
+        return dict(monte_runs=len(run_summaries), mean_list=list(_run_average("mean_list")),
+                    stdev_list=list(_run_average("stdev_list")), avg_corr=float(_run_average("avg_corr")),
+                    unclean=list(_run_average("unclean")), weights=list(np.mean(weights, axis=0)),
+                    weights_stdev=list(np.std(weights, axis=0)))
+
+    rawmoments=diag["raw"]
+    if rawmoments is None:
+        ## eg equal weights, no moments were estimated
+        size=len(diag["weights"])
+        (mean_list, stdev_list, avg_corr)=([np.nan]*size, [np.nan]*size, np.nan)
+    else:
+        (mean_list, corrmatrix, stdev_list)=rawmoments
+        avg_corr=get_avg_corr(np.array(corrmatrix, dtype=float))
+
+    return dict(mean_list=list(mean_list), stdev_list=list(stdev_list), avg_corr=avg_corr,
+                unclean=list(diag["unclean"]), weights=list(diag["weights"]))
+
+
+class spooledDiag(object):
+    """
+    Full diagnostics for one period, written to a file rather than kept in memory
+    """
+    def __init__(self, filename):
+        setattr(self, "filename", filename)
+
+    def __repr__(self):
+        return "spooledDiag: %s" % self.filename
+
+    def load(self):
+        """
+        :returns: the diag dict we spooled
+        """
+        with open(self.filename, "rb") as fhandle:
+            return pickle.load(fhandle)
+
+
+def spool_diag(diag, diagnostics_path):
+    """
+    Write a diag dict to a new file in diagnostics_path
+
+    :param diag: diagnostics from an optimisation function
+    :type diag: dict
+
+    :param diagnostics_path: directory, created if it doesn't exist
+    :type diagnostics_path: str
+
+    :returns: spooledDiag
+    """
+    os.makedirs(diagnostics_path, exist_ok=True)
+
+    ## periods can be optimised in different processes, so let the OS pick a unique name
+    (file_number, filename)=tempfile.mkstemp(prefix="optdiag_", suffix=".pck", dir=diagnostics_path)
+    with os.fdopen(file_number, "wb") as fhandle:
+        pickle.dump(diag, fhandle)
+
+    return spooledDiag(filename)
+
+
 
 def opt_shrinkage(period_subset_data, moments_estimator,  
                    cleaning, must_haves,
                   shrinkage_SR=.9,
                   shrinkage_corr=.5 , 
                   equalise_vols=False, 
+                  solver="slsqp", start_weights=None, moments=None,
                   **ignored_args):
     """
     Given dataframe of returns; returns_to_bs, performs a shrinkage optimisation
@@ -466,6 +1007,15 @@ def opt_shrinkage(period_subset_data, moments_estimator,
     :param shrinkage_corr: Shrinkage factor to use with correlations. 1.0 = full shrinkage
     :type shrinkage_corr: float
 
+    :param solver: How to find the weights, see optimise
+    :type solver: str
+
+    :param start_weights: Where the solver starts from, if it can use them (eg weights from an earlier fit)
+    :type start_weights: list of float or None
+
+    :param moments: Moments already estimated for this data (see momentsEstimator.moments_for_fit_periods), or None
+    :type moments: tuple or None
+
     Other arguments are kept so we can use **kwargs with other optimisation functions
 
     *_params passed through to data estimation functions
@@ -474,8 +1024,11 @@ def opt_shrinkage(period_subset_data, moments_estimator,
     
     """
 
-    ## subset_data will be stacked up list, need to average
-    rawmoments=moments_estimator.moments(period_subset_data)    
+    if moments is None:
+        ## subset_data will be stacked up list, need to average
+        rawmoments=moments_estimator.moments(period_subset_data)    
+    else:
+        rawmoments=moments
     (mean_list, corrmatrix, stdev_list)=copy(rawmoments)
 
     ## equalise vols first 
@@ -491,7 +1044,7 @@ def opt_shrinkage(period_subset_data, moments_estimator,
     ## get sigma matrix back    
     sigma=sigma_from_corr_and_std(stdev_list, corrmatrix)
     
-    unclean_weights=optimise( sigma, mean_list)
+    unclean_weights=optimise( sigma, mean_list, solver=solver, start_weights=start_weights)
     
     if cleaning:
         weights=clean_weights(unclean_weights, must_haves)
@@ -552,6 +1105,7 @@ def shrink_SR(mean_list, stdev_list, shrinkage_SR, target_SR=.5):
 def markosolver(period_subset_data, moments_estimator,
                  cleaning, must_haves,
                   equalise_SR=False , equalise_vols=True,
+                  solver="slsqp", start_weights=None, moments=None,
                   **ignored_args): 
     """
     Returns the optimal portfolio for the returns data
@@ -577,6 +1131,15 @@ def markosolver(period_subset_data, moments_estimator,
     :param equalise_vols: Set all vols equal before optimising (makes more stable)
     :type equalise_vols: bool
 
+    :param solver: How to find the weights, see optimise
+    :type solver: str
+
+    :param start_weights: Where the solver starts from, if it can use them (eg weights from an earlier fit)
+    :type start_weights: list of float or None
+
+    :param moments: Moments already estimated for this data (see momentsEstimator.moments_for_fit_periods), or None
+    :type moments: tuple or None
+
     Other arguments are kept so we can use **kwargs with other optimisation functions
 
     *_params passed through to data estimation functions
@@ -586,7 +1149,28 @@ def markosolver(period_subset_data, moments_estimator,
     
     """
 
-    rawmoments=moments_estimator.moments(period_subset_data)    
+    if moments is None:
+        rawmoments=moments_estimator.moments(period_subset_data)    
+    else:
+        rawmoments=moments
+
+    return markosolver_from_moments(rawmoments, moments_estimator, cleaning, must_haves,
+                                    equalise_SR=equalise_SR, equalise_vols=equalise_vols,
+                                    solver=solver, start_weights=start_weights)
+
+def markosolver_from_moments(rawmoments, moments_estimator,
+                 cleaning, must_haves,
+                  equalise_SR=False , equalise_vols=True,
+                  solver="slsqp", start_weights=None):
+    """
+    As markosolver, but with the moments already estimated
+
+    :param rawmoments: means, correlation matrix and standard deviations, as returned by moments_estimator.moments
+    :type rawmoments: tuple
+
+    :returns: tuple: list of weights, diag dict
+    """
+
     (mean_list, corrmatrix, stdev_list)=copy(rawmoments)
 
     ## equalise vols first 
@@ -600,7 +1184,7 @@ def markosolver(period_subset_data, moments_estimator,
     
     sigma=sigma_from_corr_and_std(stdev_list, corrmatrix)
     
-    unclean_weights=optimise( sigma, mean_list)
+    unclean_weights=optimise( sigma, mean_list, solver=solver, start_weights=start_weights)
     
     if cleaning:
         weights=clean_weights(unclean_weights, must_haves)
@@ -743,32 +1327,23 @@ def fix_mus(mean_list):
     Replace nans with unfeasibly large negatives
     
     result will be zero weights for these assets
+
+    >>> fix_mus([1.0, np.nan])
+    [1.0, -9999999.9]
     """
+    mean_list=np.array(mean_list, dtype=float)
+    mean_list[np.isnan(mean_list)]=FLAG_BAD_RETURN
     
-    def _fixit(x):
-        if np.isnan(x):
-            return FLAG_BAD_RETURN
-        else:
-            return x
-    
-    mean_list=[_fixit(x) for x in mean_list]
-    
-    return mean_list
+    return list(mean_list)
 
 def un_fix_weights(mean_list, weights):
     """
     When mean has been replaced, use nan weight
     """
+    weights=np.array(weights, dtype=float)
+    weights[np.array(mean_list)==FLAG_BAD_RETURN]=np.nan
     
-    def _unfixit(xmean, xweight):
-        if xmean==FLAG_BAD_RETURN:
-            return np.nan
-        else:
-            return xweight
-    
-    fixed_weights=[_unfixit(xmean, xweight) for (xmean, xweight) in zip(mean_list, weights)]
-    
-    return fixed_weights
+    return list(weights)
 
 
 def fix_sigma(sigma):
@@ -776,22 +1351,47 @@ def fix_sigma(sigma):
     Replace nans with zeros
     
     """
-    
-    def _fixit(x):
-        if np.isnan(x):
-            return 0.0
-        else:
-            return x
-    
-    sigma=[[_fixit(x) for x in sigma_row] for sigma_row in sigma]
-    
-    sigma=np.array(sigma)
+    sigma=np.array(sigma, dtype=float)
+    sigma[np.isnan(sigma)]=0.0
     
     return sigma
 
 
 
-def optimise( sigma, mean_list):
+def optimise( sigma, mean_list, solver="slsqp", start_weights=None):
+    """
+    Long only weights adding up to one, that maximise Sharpe Ratio
+    
+    Assets with a nan mean get a nan weight
+
+    :param sigma: covariance matrix
+    :type sigma: NxN np.array
+
+    :param mean_list: expected returns
+    :type mean_list: list of float
+
+    :param solver: one of 'slsqp' (numerical gradients, starting from equal weights), 
+                   'slsqp_analytic' (analytic gradients, starting from start_weights) or
+                   'active_set' (exact solution of the equivalent quadratic programme)
+    :type solver: str
+
+    :param start_weights: Where to start from, if the solver can use them
+    :type start_weights: list of float or None
+
+    :returns: list of float
+    """
+    solver_dict=dict(slsqp=optimise_numerical_slsqp, slsqp_analytic=optimise_analytic_slsqp,
+                     active_set=optimise_active_set)
+
+    try:
+        solver_func=solver_dict[solver]
+    except KeyError:
+        raise Exception("Solver %s unknown; try one of: %s " % (solver, ", ".join(solver_dict.keys())))
+
+    return solver_func(sigma, mean_list, start_weights=start_weights)
+
+def optimise_numerical_slsqp( sigma, mean_list, start_weights=None):
+    ## always starts from equal weights, so start_weights are ignored
     
     ## will replace nans with big negatives
     mean_list=fix_mus(mean_list)
@@ -816,6 +1416,218 @@ def optimise( sigma, mean_list):
     
     return weights
 
+def neg_SR_with_gradient(weights, sigma, mus):
+    """
+    Minus the Sharpe Ratio, and its gradient
+
+    >>> sigma=np.array([[1.0, 0.2], [0.2, 2.0]])
+    >>> mus=np.array([0.5, 0.3])
+    >>> (value, gradient)=neg_SR_with_gradient(np.array([0.6, 0.4]), sigma, mus)
+    >>> np.isclose(value, neg_SR([0.6, 0.4], sigma, np.array(mus, ndmin=2).transpose()))
+    True
+    """
+    sigma_weights=sigma.dot(weights)
+    portfolio_variance=weights.dot(sigma_weights)
+    std_dev=portfolio_variance**.5
+    estreturn=weights.dot(mus)
+
+    value=-estreturn/std_dev
+    gradient=-mus/std_dev + estreturn*sigma_weights/(std_dev**3)
+
+    return (value, gradient)
+
+def _addem_jacobian(weights):
+    return -np.ones(len(weights))
+
+def _start_weights_for_solver(start_weights, valid):
+    """
+    Start weights for the assets we're optimising; equal weights if we don't have any good ones
+
+    >>> _start_weights_for_solver(None, np.array([True, False, True]))
+    array([ 0.5,  0.5])
+    >>> _start_weights_for_solver([0.2, 0.3, np.nan], np.array([True, True, True]))
+    array([ 0.4,  0.6,  0. ])
+    """
+    number_assets=np.sum(valid)
+    equal_weights=np.ones(number_assets)/number_assets
+
+    if start_weights is None:
+        return equal_weights
+
+    start_weights=np.array(start_weights, dtype=float)
+    if len(start_weights)!=len(valid):
+        return equal_weights
+
+    start_weights=start_weights[valid]
+    start_weights[np.isnan(start_weights) | (start_weights<0.0)]=0.0
+
+    if np.sum(start_weights)<=0.0:
+        return equal_weights
+
+    return start_weights/np.sum(start_weights)
+
+def optimise_analytic_slsqp( sigma, mean_list, start_weights=None):
+    """
+    SLSQP with an analytic gradient, starting from start_weights
+
+    Assets with a nan mean are left out of the problem, and get a nan weight
+
+    >>> sigma=np.array([[1.0, 0.2, 0.0], [0.2, 1.0, 0.0], [0.0, 0.0, 1.0]])
+    >>> weights=optimise_analytic_slsqp(sigma, [0.5, 0.5, np.nan])
+    >>> np.isnan(weights[2])
+    True
+    >>> np.allclose(weights[:2], [0.5, 0.5])
+    True
+    """
+    mean_list=np.array(mean_list, dtype=float)
+    valid=~np.isnan(mean_list)
+
+    weights=np.full(len(mean_list), np.nan)
+    if not np.any(valid):
+        return list(weights)
+
+    ## replaces nans with zeros
+    sigma=fix_sigma(sigma)[np.ix_(valid, valid)]
+    mus=mean_list[valid]
+    number_assets=len(mus)
+
+    ## Constraints - positive weights, adding to 1.0
+    bounds=[(0.0,1.0)]*number_assets
+    cdict=[{'type':'eq', 'fun':addem, 'jac':_addem_jacobian}]
+
+    ans=minimize(neg_SR_with_gradient, _start_weights_for_solver(start_weights, valid), (sigma, mus), 
+                 jac=True, method='SLSQP', bounds=bounds, constraints=cdict, tol=0.00001)
+
+    weights[valid]=ans['x']
+
+    return list(weights)
+
+
+def optimise_active_set( sigma, mean_list, start_weights=None):
+    """
+    Maximum Sharpe Ratio for long only weights adding up to one, using the structure of the problem
+
+    If any asset has a positive expected return, the weights are proportional to the solution of::
+
+        minimise y' sigma y, subject to mean_list' y = 1 and y >= 0
+
+    which is a small quadratic programme that we solve exactly with an active set method. 
+    Otherwise (or if that goes wrong) falls back to optimise_analytic_slsqp.
+
+    Assets with a nan mean are left out of the problem, and get a nan weight
+
+    >>> sigma=np.array([[1.0, 0.2, 0.0], [0.2, 1.0, 0.0], [0.0, 0.0, 1.0]])
+    >>> weights=optimise_active_set(sigma, [0.5, 0.5, np.nan])
+    >>> np.isnan(weights[2])
+    True
+    >>> np.allclose(weights[:2], [0.5, 0.5])
+    True
+    >>> weights=optimise_active_set(sigma, [0.5, 0.5, -0.1])
+    >>> np.allclose(weights, [0.5, 0.5, 0.0])
+    True
+    """
+    mean_list=np.array(mean_list, dtype=float)
+    valid=~np.isnan(mean_list)
+
+    weights=np.full(len(mean_list), np.nan)
+    if not np.any(valid):
+        return list(weights)
+
+    ## replaces nans with zeros
+    sigma_valid=fix_sigma(sigma)[np.ix_(valid, valid)]
+    mus=mean_list[valid]
+
+    if np.max(mus)<=0.0:
+        ## no portfolio has a positive Sharpe Ratio, so the quadratic programme doesn't help
+        return optimise_analytic_slsqp(sigma, mean_list, start_weights=start_weights)
+
+    unit_return_weights=_min_variance_unit_return(sigma_valid, mus)
+
+    if unit_return_weights is None:
+        return optimise_analytic_slsqp(sigma, mean_list, start_weights=start_weights)
+
+    weights[valid]=unit_return_weights/np.sum(unit_return_weights)
+
+    return list(weights)
+
+def _min_variance_unit_return(sigma, mus, tolerance=1e-12):
+    """
+    Active set solution of: minimise y' sigma y, subject to mus' y = 1 and y >= 0
+
+    Needs at least one positive value in mus. We start with all our money in the asset 
+      with the highest return, and add or remove assets from the free set one at a time.
+
+    :param sigma: covariance matrix
+    :type sigma: NxN np.array
+
+    :param mus: expected returns
+    :type mus: N np.array
+
+    :returns: N np.array, or None if we don't get there
+
+    >>> y=_min_variance_unit_return(np.array([[1.0, 0.0], [0.0, 1.0]]), np.array([1.0, 1.0]))
+    >>> np.allclose(y, [0.5, 0.5])
+    True
+    """
+    number_assets=len(mus)
+    best_asset=np.argmax(mus)
+
+    unit_return_weights=np.zeros(number_assets)
+    unit_return_weights[best_asset]=1.0/mus[best_asset]
+
+    free=np.zeros(number_assets, dtype=bool)
+    free[best_asset]=True
+
+    for notUsed in range(50*number_assets):
+        free_idx=np.where(free)[0]
+        gradient=sigma.dot(unit_return_weights)
+
+        ## step that minimises variance with the current free assets, keeping the return the same
+        free_count=len(free_idx)
+        kkt_matrix=np.zeros((free_count+1, free_count+1))
+        kkt_matrix[:free_count, :free_count]=sigma[np.ix_(free_idx, free_idx)]
+        kkt_matrix[:free_count, free_count]=mus[free_idx]
+        kkt_matrix[free_count, :free_count]=mus[free_idx]
+        kkt_rhs=np.append(-gradient[free_idx], 0.0)
+
+        step=np.linalg.lstsq(kkt_matrix, kkt_rhs, rcond=-1)[0][:free_count]
+
+        if np.max(np.abs(step))<=tolerance*max(1.0, np.max(np.abs(unit_return_weights))):
+            ## can't do better with these assets; would adding another one help?
+            mus_free=mus[free_idx]
+            return_multiplier=mus_free.dot(gradient[free_idx])/mus_free.dot(mus_free)
+            bound_multipliers=gradient-return_multiplier*mus
+            bound_multipliers[free]=np.inf
+
+            asset_to_free=np.argmin(bound_multipliers)
+            if bound_multipliers[asset_to_free]>=-tolerance*max(1.0, np.max(np.abs(gradient))):
+                return unit_return_weights
+
+            free[asset_to_free]=True
+            continue
+
+        ## move as far as we can before a weight hits zero
+        full_step=np.zeros(number_assets)
+        full_step[free_idx]=step
+
+        shrinking=free_idx[step<0.0]
+        step_sizes=-unit_return_weights[shrinking]/full_step[shrinking]
+
+        if len(step_sizes)>0 and np.min(step_sizes)<1.0:
+            step_size=np.min(step_sizes)
+            asset_to_fix=shrinking[np.argmin(step_sizes)]
+        else:
+            step_size=1.0
+            asset_to_fix=None
+
+        unit_return_weights=unit_return_weights+step_size*full_step
+
+        if asset_to_fix is not None:
+            unit_return_weights[asset_to_fix]=0.0
+            free[asset_to_fix]=False
+
+    return None
+
 
 def sigma_from_corr_and_std(stdev_list, corrmatrix):
     stdev=np.array(stdev_list, ndmin=2).transpose()
@@ -861,6 +1673,7 @@ def equal_weights(period_subset_data, moments_estimator,
 def bootstrap_portfolio(subset_data, moments_estimator,
                 cleaning, must_haves,
                   monte_runs=100, bootstrap_length=50,
+                  batch_bootstrap=False, bootstrap_workers=1, seed=None,
                   **other_opt_args):
     """
     Given dataframe of returns; returns_to_bs, performs a bootstrap optimisation
@@ -886,6 +1699,15 @@ def bootstrap_portfolio(subset_data, moments_estimator,
     :param bootstrap_length: Number of periods in each bootstrap
     :type bootstrap_length: int
 
+    :param batch_bootstrap: Draw all the bootstraps, and estimate their moments, in one go
+    :type batch_bootstrap: bool
+
+    :param bootstrap_workers: Number of processes to run the batched optimisations over
+    :type bootstrap_workers: int
+
+    :param seed: Seed for the batched draws; None to not seed
+    :type seed: int or None
+
     *_params passed through to data estimation functions
 
     **other_opt_args passed to single period optimiser
@@ -894,6 +1716,15 @@ def bootstrap_portfolio(subset_data, moments_estimator,
     
     """
 
+    if str2Bool(batch_bootstrap):
+        return bootstrap_portfolio_batched(subset_data, moments_estimator,
+                                           cleaning, must_haves,
+                                           monte_runs=monte_runs, bootstrap_length=bootstrap_length,
+                                           workers=bootstrap_workers, seed=seed,
+                                           **other_opt_args)
+
+    ## we draw rows from a frame; stack up pooled data once, rather than for every draw
+    subset_data=df_from_list(subset_data)
                 
     all_results=[bs_one_time(subset_data, moments_estimator,
                             cleaning, must_haves, 
@@ -958,8 +1789,186 @@ def bs_one_time(subset_data, moments_estimator,
 
     return (weights, diag)
 
+def bootstrap_portfolio_batched(subset_data, moments_estimator,
+                cleaning, must_haves,
+                  monte_runs=100, bootstrap_length=50, workers=1, seed=None,
+                  equalise_SR=False, equalise_vols=True,
+                  solver="slsqp", start_weights=None,
+                  **ignored_args):
+    """
+    As bootstrap_portfolio, but draws all the bootstraps at once
+
+    The row numbers for every run come from one draw of a seeded np.random.RandomState. Moments for
+    all the runs are worked out together (see bootstrap_moments), and then the optimisations are done
+    one run at a time; optionally over a pool of processes.
+
+    :param workers: Number of processes to do the optimisations
+    :type workers: int
+
+    :param seed: Seed for np.random.RandomState; None to not seed
+    :type seed: int or None
+
+    Other parameters as bootstrap_portfolio and markosolver
+
+    :returns: tuple: list of weights, diag dict
+    """
+    random_state = np.random.RandomState(seed)
+    bs_idx = random_state.randint(0, len(subset_data), size=(int(monte_runs), int(bootstrap_length)))
+
+    moments_list = bootstrap_moments(subset_data, bs_idx, moments_estimator)
+
+    task_list = [(rawmoments, moments_estimator, cleaning, must_haves, equalise_SR, equalise_vols,
+                  solver, start_weights)
+                 for rawmoments in moments_list]
+
+    all_results = map_in_pool(_markosolver_from_moments_task, task_list, workers)
+
+    ### We can take an average here; only because our weights always add up to 1. If that isn't true
+    ###    then you will need to some kind of renormalisation
+
+    weightlist=np.array([x[0] for x in all_results], ndmin=2)
+    diaglist=[x[1] for x in all_results]
+         
+    theweights_mean=list(np.mean(weightlist, axis=0))
+    
+    diag=dict(bootstraps=diaglist)
+    
+    return (theweights_mean, diag)
+
+def _markosolver_from_moments_task(task):
+    ## pool.map passes a single argument
+    (rawmoments, moments_estimator, cleaning, must_haves, equalise_SR, equalise_vols, 
+     solver, start_weights) = task
+    return markosolver_from_moments(rawmoments, moments_estimator, cleaning, must_haves,
+                                    equalise_SR=equalise_SR, equalise_vols=equalise_vols,
+                                    solver=solver, start_weights=start_weights)
+
+def _simple_moments_params(moments_estimator):
+    """
+    If the moments are the standard non exponential estimators returns their min_periods,
+      and whether correlations are floored. Otherwise None
+    """
+    if not (moments_estimator.mean_estimate_func is mean_estimator and 
+            moments_estimator.vol_estimate_func is vol_estimator and 
+            moments_estimator.corr_estimate_func is correlation_single_period):
+        return None
+
+    all_params = [moments_estimator.mean_estimate_params, moments_estimator.vol_estimate_params,
+                  moments_estimator.corr_estimate_params]
+
+    ## all of these functions default to using an exponent
+    if any([str2Bool(params.get("using_exponent", True)) for params in all_params]):
+        return None
 
+    min_periods = [params.get("min_periods", 20) for params in all_params]
+    floor_at_zero = moments_estimator.corr_estimate_params.get("floor_at_zero", True)
 
+    return (min_periods, floor_at_zero)
+
+def bootstrap_moments(subset_data, bs_idx, moments_estimator):
+    """
+    Moments for a number of bootstrap draws
+
+    With the standard non exponential estimators, means, vols and correlations for all the draws are
+    worked out together in array operations. Otherwise we call the moments estimator for each draw.
+
+    :param subset_data: The data to draw from
+    :type subset_data: pd.DataFrame TxN, or pooledData
+
+    :param bs_idx: row numbers to use, one row per draw
+    :type bs_idx: BxL np.array of int
+
+    :param moments_estimator: An instance of a moments estimator
+    :type moments_estimator: momentsEstimator
+
+    :returns: list of B tuples (mean_list, corrmatrix, stdev_list), as moments_estimator.moments gives for each draw
+    """
+    simple_params = _simple_moments_params(moments_estimator)
+
+    if simple_params is None:
+        ## stacks up pooled data
+        subset_data=df_from_list(subset_data)
+        return [moments_estimator.moments(subset_data.iloc[list(draw_idx), :]) for draw_idx in bs_idx]
+
+    ([mean_min_periods, vol_min_periods, corr_min_periods], floor_at_zero) = simple_params
+
+    ## BxLxN
+    data = subset_data.values.astype(float)[bs_idx]
+    present = ~np.isnan(data)
+
+    ## same test as apply_with_min_periods
+    nan_count = np.sum(~present, axis=1)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        means = np.nanmean(data, axis=1)
+        stdevs = np.nanstd(data, axis=1)
+
+    means[nan_count < mean_min_periods] = np.nan
+    stdevs[nan_count < vol_min_periods] = np.nan
+
+    means = means * moments_estimator.annualisation
+    stdevs = stdevs * (moments_estimator.annualisation**.5)
+
+    corrmatrices = _pairwise_correlations(data, present, corr_min_periods)
+    if floor_at_zero:
+        corrmatrices[corrmatrices < 0] = 0.0
+
+    return [(list(means[draw]), corrmatrices[draw], list(stdevs[draw])) 
+            for draw in range(data.shape[0])]
+
+def _pairwise_correlations(data, present, min_periods):
+    """
+    Correlations for each draw, using pairwise complete observations; same as pd.DataFrame.corr
+
+    Worked out from sums over each draw with matrix products, so we only ever need BxLxN and BxNxN arrays
+
+    :param data: BxLxN np.array
+    :param present: BxLxN np.array of bool, False where data is nan
+
+    :returns: BxNxN np.array
+    """
+    (draw_count, unused_length, size) = data.shape
+
+    ## a few draws at a time, so the BxNxN sums for lots of assets don't get too big
+    chunk_draws = max(int(PAIRWISE_CHUNK_SIZE / (size * size)), 1)
+    if draw_count > chunk_draws:
+        return np.concatenate([_pairwise_correlations(data[start:start + chunk_draws], 
+                                                      present[start:start + chunk_draws], min_periods)
+                               for start in range(0, draw_count, chunk_draws)], axis=0)
+
+    ## take the first value in each draw off each column, so the sums of squares don't lose precision
+    first_row = np.argmax(present, axis=1)
+    shift = data[np.arange(draw_count)[:, np.newaxis], first_row, np.arange(size)[np.newaxis, :]]
+    shift[np.isnan(shift)] = 0.0
+
+    present = present.astype(float)
+    values = np.where(present > 0.0, data - shift[:, np.newaxis, :], 0.0)
+    values_t = values.transpose((0, 2, 1))
+
+    ## [b, i, j] sums over the periods when both i and j have data
+    pair_count = np.matmul(present.transpose((0, 2, 1)), present)
+    sum_x = np.matmul(values_t, present)
+    sum_x_sq = np.matmul(values_t**2, present)
+    cross_sum = np.matmul(values_t, values)
+
+    sum_y = sum_x.transpose((0, 2, 1))
+    sum_y_sq = sum_x_sq.transpose((0, 2, 1))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        covariance = cross_sum - sum_x * sum_y / pair_count
+        x_sum_sq = np.maximum(sum_x_sq - sum_x**2 / pair_count, 0.0)
+        y_sum_sq = x_sum_sq.transpose((0, 2, 1))
+
+        divisor = np.sqrt(x_sum_sq * y_sum_sq)
+        correlations = covariance / divisor
+
+    ## no variation, allowing for rounding
+    no_variation = (x_sum_sq <= ROUNDING_TOLERANCE * sum_x_sq) | (y_sum_sq <= ROUNDING_TOLERANCE * sum_y_sq)
+    correlations[no_variation | (divisor == 0.0)] = np.nan
+    correlations[pair_count < min_periods] = np.nan
+
+    return correlations
 
 if __name__ == '__main__':
     import doctest
@@ -4,6 +4,8 @@ Utilities to help with pandas
 
 import pandas as pd
 import numpy as np
+import warnings
+from copy import copy
 from syscore.fileutils import get_filename_for_package
 from syscore.dateutils import BUSINESS_DAYS_IN_YEAR
 
@@ -33,8 +35,11 @@ def uniquets(x):
 
 def df_from_list(data):
     """
-    data frame from list
+    data frame from list, or pooledData
     """
+    if isinstance(data, pooledData):
+        return data.stacked()
+
     if type(data) is list:        
         column_names=list(set(sum([list(data_item.columns) for data_item in data],[])))
         column_names.sort()
@@ -71,16 +76,14 @@ def must_have_item(slice_data):
 
     :returns: list of bool
 
-    >>>
+    >>> must_have_item(pd.DataFrame(dict(a=[np.nan, 1.0], b=[np.nan, np.nan])))
+    [True, False]
     """
-        
-    def _any_data(xseries):
-        data_present=[not np.isnan(x) for x in xseries]
-        
-        return any(data_present)
-    
-    some_data=slice_data.apply(_any_data, axis=0)
-    some_data_flags=list(some_data.values)
+    if isinstance(slice_data, pooledData):
+        return slice_data.must_haves()
+
+    some_data=np.any(~np.isnan(slice_data.values.astype(float)), axis=0)
+    some_data_flags=list(some_data)
     
     return some_data_flags
 
@@ -168,28 +171,479 @@ def apply_cap(pd_series, capvalue):
 
 
 
-def fix_weights_vs_pdm(weights, pdm):
+def _as_series(x):
     """
-    Take a matrix of weights and positions/forecasts (pdm)
+    Tx1 pd.DataFrame or pd.Series to pd.Series
+    """
+    if isinstance(x, pd.DataFrame):
+        return x.iloc[:, 0]
 
-    Ensure that the weights in each row add up to 1, for active positions/forecasts (not np.nan values after forward filling)
+    return x
 
-    This deals with the problem of different rules and/or instruments having different history
 
-    :param weights: Weights to
-    :type weights: TxK pd.DataFrame (same columns as weights, perhaps different length)
+def scale_and_cap_forecasts(raw_forecast_list, scalar_list, capvalue, columns):
+    """
+    Scale and cap a number of forecasts in one pass
 
-    :param pdm:
-    :type pdm: TxK pd.DataFrame (same columns as weights, perhaps different length)
+    Gives the same answer as multiplying each raw forecast by its scalar, applying
+    apply_cap, and then concatenating; without building each series
 
-    :returns: TxK pd.DataFrame of adjusted weights
+    :param raw_forecast_list: raw forecasts
+    :type raw_forecast_list: list of Tx1 pd.Series
+
+    :param scalar_list: forecast scalars, one per raw forecast
+    :type scalar_list: list of float or Tx1 pd.Series
+
+    :param capvalue: Maximum absolute value allowed
+    :type capvlue: int or float
+
+    :param columns: column names for the result
+    :type columns: list of str
+
+    :returns: TxK pd.DataFrame
 
+    >>> x=pd.Series([2.0, 7.0, np.nan, -6.99], pd.date_range(pd.datetime(2015,1,1), periods=4))
+    >>> y=pd.Series([1.0, 1.5], pd.date_range(pd.datetime(2015,1,2), periods=2))
+    >>> ans=scale_and_cap_forecasts([x, x], [2.0, y], 5.0, ["a", "b"])
+    >>> expected=pd.concat([apply_cap(x*2.0, 5.0), apply_cap(x*y, 5.0)], axis=1)
+    >>> expected.columns=["a", "b"]
+    >>> ans.equals(expected)
+    True
+    """
+    # Will do weird things otherwise
+    assert capvalue > 0
+
+    raw_forecast_list = [_as_series(raw_forecast) for raw_forecast in raw_forecast_list]
+
+    # each product covers the raw forecast and any time series scalar
+    all_index = raw_forecast_list[0].index
+    for (raw_forecast, scalar) in zip(raw_forecast_list, scalar_list):
+        all_index = all_index.union(raw_forecast.index)
+        if isinstance(scalar, (pd.Series, pd.DataFrame)):
+            all_index = all_index.union(_as_series(scalar).index)
+
+    raw_values = np.column_stack([raw_forecast.reindex(all_index).values
+                                  for raw_forecast in raw_forecast_list])
+    scalar_values = np.column_stack([
+        _as_series(scalar).reindex(all_index).values if isinstance(scalar, (pd.Series, pd.DataFrame))
+        else np.repeat(float(scalar), len(all_index))
+        for scalar in scalar_list])
+
+    capped = np.clip(raw_values * scalar_values, -capvalue, capvalue)
+
+    return pd.DataFrame(capped, index=all_index, columns=columns)
+
+
+def combine_and_cap_forecasts(forecasts, forecast_weights, forecast_div_multiplier, capvalue):
+    """
+    Weighted sum of forecasts, multiplied by the diversification multiplier, then capped
+
+    Gives the same answer as the pandas calculation::
+
+        combined = (forecast_weights.ffill() * forecasts).sum(axis=1)
+        apply_cap(combined * forecast_div_multiplier.ffill(), capvalue)
+
+    :param forecasts: forecasts
+    :type forecasts: TxK pd.DataFrame
+
+    :param forecast_weights: weights, same columns as forecasts
+    :type forecast_weights: TxK pd.DataFrame
+
+    :param forecast_div_multiplier: multiplier
+    :type forecast_div_multiplier: Tx1 pd.Series
+
+    :param capvalue: Maximum absolute value allowed
+    :type capvlue: int or float
+
+    :returns: Tx1 pd.Series
+
+    >>> f=pd.DataFrame(dict(a=[2.0, 7.0, np.nan], b=[np.nan, 1.0, np.nan]), pd.date_range(pd.datetime(2015,1,1), periods=3))
+    >>> w=pd.DataFrame(dict(a=[0.5, 0.5, 0.5], b=[0.5, 0.5, 0.5]), pd.date_range(pd.datetime(2015,1,1), periods=3))
+    >>> fdm=pd.Series([1.0]*3, pd.date_range(pd.datetime(2015,1,1), periods=3))
+    >>> expected=apply_cap((w.ffill()*f).sum(axis=1)*fdm.ffill(), 3.0)
+    >>> combine_and_cap_forecasts(f, w, fdm, 3.0).equals(expected)
+    True
+    """
+    # Will do weird things otherwise
+    assert capvalue > 0
+
+    forecast_weights = forecast_weights.ffill()
+    forecast_div_multiplier = _as_series(forecast_div_multiplier).ffill()
+
+    # multiplying in pandas would align on the union of the indices
+    index = forecasts.index.union(forecast_weights.index)
+    weight_values = forecast_weights.reindex(index)[forecasts.columns].values
+    forecast_values = forecasts.reindex(index).values
+
+    weighted_forecasts = weight_values * forecast_values
+
+    # pandas skips nans when summing, unless they are all nan
+    all_nan = np.all(np.isnan(weighted_forecasts), axis=1)
+    weighted_forecasts[np.isnan(weighted_forecasts)] = 0.0
+    combined = weighted_forecasts.sum(axis=1)
+    combined[all_nan] = np.nan
+
+    final_index = index.union(forecast_div_multiplier.index)
+    combined = pd.Series(combined, index=index).reindex(final_index).values
+    fdm_values = forecast_div_multiplier.reindex(final_index).values
+
+    capped = np.clip(combined * fdm_values, -capvalue, capvalue)
+
+    return pd.Series(capped, index=final_index)
+
+
+class pooledData(object):
+    """
+    Data for a pool of members (eg instruments), which all have the same columns (eg trading rules)
+
+    Stored as a (date x member x column) array on the union of the members' dates, with a 
+    (date x member) mask showing which members have a row on each date. Members are never stacked 
+    into one long frame; but to anything that treats it like one (.index, .values, .shape, len, 
+    and slicing with dates) it looks exactly like what df_from_list would give for the list: 
+    member k's rows are timestamped k seconds after their date, in date then member order.
+
+    >>> a=pd.DataFrame(dict(x=[1.0, 2.0]), index=[pd.datetime(2015,1,1), pd.datetime(2015,1,2)])
+    >>> b=pd.DataFrame(dict(x=[3.0]), index=[pd.datetime(2015,1,2)])
+    >>> pooled=pooled_data_from_list([a, b])
+    >>> pooled
+    pooledData: 2 dates, 2 members, columns x
+    >>> pooled.stacked()
+                           x
+    2015-01-01 00:00:00  1.0
+    2015-01-02 00:00:00  2.0
+    2015-01-02 00:00:01  3.0
+    >>> pooled[pd.datetime(2015,1,2):].values
+    array([[ 2.],
+           [ 3.]])
+    """
+
+    def __init__(self, member_values, row_mask, dates, columns):
+        """
+        :param member_values: values, nan where a member doesn't have a row
+        :type member_values: TxMxN np.array
+
+        :param row_mask: True where a member has a row on a date
+        :type row_mask: TxM np.array of bool
+
+        :param dates: dates, in order
+        :type dates: pd.DatetimeIndex of length T
+
+        :param columns: column names
+        :type columns: list of length N
+        """
+        row_mask=np.array(row_mask, dtype=bool)
+        member_values=np.where(row_mask[:, :, np.newaxis], member_values, np.nan)
+
+        setattr(self, "member_values", member_values)
+        setattr(self, "row_mask", row_mask)
+        setattr(self, "dates", pd.DatetimeIndex(dates))
+        setattr(self, "columns", list(columns))
+
+    def __repr__(self):
+        return "pooledData: %d dates, %d members, columns %s" % (self.row_mask.shape[0], self.row_mask.shape[1], 
+                                                                ",".join([str(x) for x in self.columns]))
+
+    def _member_timestamps(self):
+        ## TxM timestamps, as df_from_list would give each member's rows
+        member_offsets=np.array([np.timedelta64(offset_value, 's') for offset_value in range(self.row_mask.shape[1])],
+                                dtype="timedelta64[ns]")
+        return self.dates.values[:, np.newaxis]+member_offsets[np.newaxis, :]
+
+    @property
+    def index(self):
+        return pd.DatetimeIndex(self._member_timestamps()[self.row_mask])
+
+    @property
+    def values(self):
+        ## RxN, one row for each row a member has, in date then member order
+        return self.member_values[self.row_mask]
+
+    @property
+    def shape(self):
+        return (int(np.sum(self.row_mask)), len(self.columns))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, date_slice):
+        """
+        Slice by dates, selecting exactly the rows that slicing the stacked frame would
+        """
+        if not isinstance(date_slice, slice):
+            raise Exception("pooledData can only be sliced by date")
+
+        timestamps=self._member_timestamps()
+        in_slice=copy(self.row_mask)
+        if date_slice.start is not None:
+            in_slice=in_slice & (timestamps>=np.datetime64(pd.Timestamp(date_slice.start)))
+        if date_slice.stop is not None:
+            in_slice=in_slice & (timestamps<=np.datetime64(pd.Timestamp(date_slice.stop)))
+
+        dates_used=np.any(in_slice, axis=1)
+
+        return pooledData(self.member_values[dates_used], in_slice[dates_used], self.dates[dates_used], self.columns)
+
+    def stacked(self):
+        """
+        The stacked up frame, as df_from_list would give
+
+        :returns: pd.DataFrame
+        """
+        return pd.DataFrame(self.values, index=self.index, columns=self.columns)
+
+    def member_frames(self):
+        """
+        Each member's data on its own
+
+        :returns: list of pd.DataFrame
+        """
+        return [pd.DataFrame(self.member_values[self.row_mask[:, member], member, :], 
+                             index=self.dates[self.row_mask[:, member]], columns=self.columns)
+                for member in range(self.row_mask.shape[1])]
+
+    def must_haves(self):
+        """
+        As must_have_item: True for columns where any member has a non nan value
+
+        :returns: list of bool
+        """
+        return list(np.any(~np.isnan(self.member_values), axis=(0, 1)))
+
+    def mean(self):
+        """
+        Mean of each column, across all members
+
+        :returns: pd.Series
+        """
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            return pd.Series(np.nanmean(self.values, axis=0), index=self.columns)
+
+    def std(self):
+        """
+        Standard deviation of each column (with ddof=1, as pandas), across all members
+
+        :returns: pd.Series
+        """
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            return pd.Series(np.nanstd(self.values, axis=0, ddof=1), index=self.columns)
+
+    def _aligned_with(self, other):
+        ## both on the union of dates
+        if other.row_mask.shape[1]!=self.row_mask.shape[1] or other.columns!=self.columns:
+            raise Exception("Can only combine pooled data with the same members and columns")
+
+        dates=self.dates.union(other.dates)
+
+        aligned=[]
+        for pooled in [self, other]:
+            rows=dates.get_indexer(pooled.dates)
+            member_values=np.full((len(dates),)+pooled.member_values.shape[1:], np.nan)
+            member_values[rows]=pooled.member_values
+            row_mask=np.zeros((len(dates), pooled.row_mask.shape[1]), dtype=bool)
+            row_mask[rows]=pooled.row_mask
+            aligned.append((member_values, row_mask))
+
+        return (dates, aligned)
+
+    def _combine(self, other, operation):
+        if isinstance(other, pooledData):
+            (dates, [(my_values, my_mask), (other_values, other_mask)])=self._aligned_with(other)
+            ## as pandas, a row in eithier is kept, with nan unless both have a value
+            return pooledData(operation(my_values, other_values), my_mask | other_mask, dates, self.columns)
+
+        ## a number, or one value per column
+        return pooledData(operation(self.member_values, np.array(other, dtype=float)), self.row_mask, 
+                          self.dates, self.columns)
+
+    def __add__(self, other):
+        return self._combine(other, np.add)
+
+    def __mul__(self, other):
+        return self._combine(other, np.multiply)
+
+def pooled_data_from_list(data_list):
+    """
+    Pool a list of data frames, without stacking them up
+
+    :param data_list: one frame for each member, with the same columns; each with unique dates
+    :type data_list: list of pd.DataFrame
+
+    :returns: pooledData
+    """
+    column_names=list(set(sum([list(data_item.columns) for data_item in data_list],[])))
+    column_names.sort()
+
+    dates=data_list[0].index
+    for data_item in data_list[1:]:
+        dates=dates.union(data_item.index)
+
+    member_values=np.full((len(dates), len(data_list), len(column_names)), np.nan)
+    row_mask=np.zeros((len(dates), len(data_list)), dtype=bool)
+
+    for (member, data_item) in enumerate(data_list):
+        rows=dates.get_indexer(data_item.index)
+        member_values[rows, member, :]=data_item[column_names].values
+        row_mask[rows, member]=True
+
+    return pooledData(member_values, row_mask, dates, column_names)
+
+class stepWeights(object):
+    """
+    Weights which only change on a few dates
+
+    Stored as the dates on which the weights change, and the weights that apply from each of those
+    dates onwards; rather than as a daily data frame. Only expanded when we know the index we need.
+
+    >>> w=stepWeights([pd.datetime(2015,1,2), pd.datetime(2015,1,4)], [[0.5, 0.5], [0.2, 0.8]], ["a", "b"])
+    >>> w.columns
+    ['a', 'b']
+    >>> w.reindex(pd.date_range(pd.datetime(2015,1,1), periods=5), method='ffill')
+                  a    b
+    2015-01-01  NaN  NaN
+    2015-01-02  0.5  0.5
+    2015-01-03  0.5  0.5
+    2015-01-04  0.2  0.8
+    2015-01-05  0.2  0.8
+    """
+
+    def __init__(self, change_dates, weights, columns, end_date=None):
+        """
+        :param change_dates: dates on which the weights change, in order
+        :type change_dates: list of datetime
+
+        :param weights: weights which apply from each change date onwards
+        :type weights: list of lists, or np.array, one row per change date
+
+        :param columns: names for each weight
+        :type columns: list of str
+
+        :param end_date: last date we'd usually want weights for; defaults to last change date
+        :type end_date: datetime or None
+        """
+        change_dates = pd.DatetimeIndex(change_dates)
+        weights = np.array(weights, dtype=float).reshape(
+            (len(change_dates), len(columns)))
+
+        if end_date is None:
+            end_date = change_dates[-1]
+
+        setattr(self, "change_dates", change_dates)
+        setattr(self, "weights", weights)
+        setattr(self, "columns", list(columns))
+        setattr(self, "end_date", end_date)
+
+    def __repr__(self):
+        return "stepWeights with %d changes for %s" % (
+            len(self.change_dates), str(self.columns))
+
+    @property
+    def index(self):
+        return self.change_dates
+
+    def reindex(self, index, method='ffill'):
+        """
+        Weights that apply on each date in index; nan before the first change date
+
+        Behaves like the reindex of a daily data frame of weights, forward filled
+
+        :param index: dates we want weights for
+        :type index: pd.DatetimeIndex
+
+        :param method: only 'ffill' makes sense for step weights
+        :type method: str
+
+        :returns: TxK pd.DataFrame
+        """
+        if method != 'ffill':
+            raise Exception("stepWeights can only be reindexed with method='ffill'")
+
+        position = np.searchsorted(self.change_dates.values,
+                                   pd.DatetimeIndex(index).values, side='right') - 1
+
+        dense_weights = self.weights[np.maximum(position, 0), :]
+        dense_weights[position < 0, :] = np.nan
+
+        return pd.DataFrame(dense_weights, index=index, columns=self.columns)
+
+    def as_df(self):
+        """
+        Daily data frame of weights, from the first change date to the end date
+
+        :returns: TxK pd.DataFrame
+        """
+        daily_index = pd.date_range(start=self.change_dates[0], end=self.end_date)
+
+        return self.reindex(daily_index)
+
+    def plot(self, *args, **kwargs):
+        return self.as_df().plot(*args, **kwargs)
+
+
+def fixed_step_weights(weight_dict, start_date, end_date):
+    """
+    Weights which never change
+
+    :param weight_dict: weights, keys are column names
+    :type weight_dict: dict of floats
+
+    :param start_date: first date the weights apply
+    :type start_date: datetime
+
+    :param end_date: last date we'd usually want weights for
+    :type end_date: datetime
+
+    :returns: stepWeights, columns sorted by name
+
+    >>> fixed_step_weights(dict(b=0.9, a=0.1), pd.datetime(2015,1,1), pd.datetime(2015,1,3)).as_df()
+                  a    b
+    2015-01-01  0.1  0.9
+    2015-01-02  0.1  0.9
+    2015-01-03  0.1  0.9
+    """
+    columns = sorted(weight_dict.keys())
+
+    return stepWeights([start_date], [[weight_dict[column] for column in columns]],
+                       columns, end_date=end_date)
+
+
+def _normalise_weight_rows(weight_values):
+    """
+    Divide each row of weights by its sum, leaving rows that add up to zero alone
+
+    Rows are added up from left to right, as the python sum does, so we get exactly the same
+    answer as working a row at a time
+
+    :param weight_values: weights
+    :type weight_values: TxK np.array
+
+    :returns: TxK np.array
+    """
+    row_sum = np.zeros(weight_values.shape[0])
+    for column_number in range(weight_values.shape[1]):
+        row_sum = row_sum + weight_values[:, column_number]
+
+    zero_sum = row_sum == 0.0
+    row_sum[zero_sum] = 1.0
+
+    new_weights = weight_values / row_sum[:, np.newaxis]
+    new_weights[zero_sum, :] = weight_values[zero_sum, :]
+
+    return new_weights
+
+
+def _masked_weights_vs_pdm(weights, pdm):
+    """
+    Weights aligned to pdm, set to zero where pdm has no value even after forward filling
+
+    :returns: TxK pd.DataFrame, not yet normalised
     """
 
     # forward fill forecasts/positions
     pdm_ffill = pdm.ffill()
 
-    # resample weights
+    # resample weights; step weights are only expanded over the dates in pdm
     adj_weights = weights.reindex(pdm_ffill.index, method='ffill')
 
     # ensure columns are aligned
@@ -198,17 +652,94 @@ def fix_weights_vs_pdm(weights, pdm):
     # remove weights if nan forecast
     adj_weights[np.isnan(pdm_ffill)] = 0.0
 
+    return adj_weights
+
+
+def fix_weights_vs_pdm(weights, pdm):
+    """
+    Take a matrix of weights and positions/forecasts (pdm)
+
+    Ensure that the weights in each row add up to 1, for active positions/forecasts (not np.nan values after forward filling)
+
+    This deals with the problem of different rules and/or instruments having different history
+
+    :param weights: Weights to
+    :type weights: TxK pd.DataFrame (same columns as weights, perhaps different length), or stepWeights
+
+    :param pdm:
+    :type pdm: TxK pd.DataFrame (same columns as weights, perhaps different length)
+
+    :returns: TxK pd.DataFrame of adjusted weights
+
+    >>> w=pd.DataFrame(dict(a=[0.2, 0.2, 0.2], b=[0.6, 0.6, 0.6]), pd.date_range(pd.datetime(2015,1,1), periods=3))
+    >>> f=pd.DataFrame(dict(a=[np.nan, np.nan, 1.0], b=[np.nan, 2.0, np.nan]), pd.date_range(pd.datetime(2015,1,1), periods=3))
+    >>> fix_weights_vs_pdm(w, f)
+                   a     b
+    2015-01-01  0.00  0.00
+    2015-01-02  0.00  1.00
+    2015-01-03  0.25  0.75
+    """
+
+    adj_weights = _masked_weights_vs_pdm(weights, pdm)
+
     # change rows so weights add to one
-    def _sum_row_fix(weight_row):
-        swr = sum(weight_row)
-        if swr == 0.0:
-            return weight_row
-        new_weights = weight_row / swr
-        return new_weights
+    return pd.DataFrame(_normalise_weight_rows(adj_weights.values),
+                        index=adj_weights.index, columns=adj_weights.columns)
 
-    adj_weights = adj_weights.apply(_sum_row_fix, 1)
 
-    return adj_weights
+def fix_weights_vs_pdm_batch(weights_list, pdm_list):
+    """
+    fix_weights_vs_pdm for a number of weight matrices at once, eg for many instruments
+
+    The weights are stacked into a single array, so the rows are normalised in one go
+
+    :param weights_list: Weights
+    :type weights_list: list of TxK pd.DataFrame or stepWeights
+
+    :param pdm_list: positions or forecasts, one for each set of weights
+    :type pdm_list: list of TxK pd.DataFrame
+
+    :returns: list of TxK pd.DataFrame of adjusted weights, same as fix_weights_vs_pdm gives for each
+
+    >>> w=pd.DataFrame(dict(a=[0.2, 0.2, 0.2], b=[0.6, 0.6, 0.6]), pd.date_range(pd.datetime(2015,1,1), periods=3))
+    >>> f=pd.DataFrame(dict(a=[np.nan, np.nan, 1.0], b=[np.nan, 2.0, np.nan]), pd.date_range(pd.datetime(2015,1,1), periods=3))
+    >>> f2=pd.DataFrame(dict(b=[1.0, 2.0]), pd.date_range(pd.datetime(2015,1,2), periods=2))
+    >>> ans=fix_weights_vs_pdm_batch([w, w], [f, f2])
+    >>> ans[0].equals(fix_weights_vs_pdm(w, f))
+    True
+    >>> ans[1].equals(fix_weights_vs_pdm(w, f2))
+    True
+    """
+    assert len(weights_list) == len(pdm_list)
+
+    if len(weights_list) == 0:
+        return []
+
+    adj_weights_list = [_masked_weights_vs_pdm(weights, pdm)
+                        for (weights, pdm) in zip(weights_list, pdm_list)]
+
+    # pad with zero weights on the right, which doesn't change any row sum
+    max_columns = max([adj_weights.shape[1] for adj_weights in adj_weights_list])
+    stacked_weights = np.zeros((sum([adj_weights.shape[0] for adj_weights in adj_weights_list]), max_columns))
+
+    row_start = 0
+    for adj_weights in adj_weights_list:
+        (row_count, column_count) = adj_weights.shape
+        stacked_weights[row_start:row_start + row_count, :column_count] = adj_weights.values
+        row_start = row_start + row_count
+
+    stacked_weights = _normalise_weight_rows(stacked_weights)
+
+    fixed_weights_list = []
+    row_start = 0
+    for adj_weights in adj_weights_list:
+        (row_count, column_count) = adj_weights.shape
+        fixed_weights_list.append(pd.DataFrame(
+            stacked_weights[row_start:row_start + row_count, :column_count],
+            index=adj_weights.index, columns=adj_weights.columns))
+        row_start = row_start + row_count
+
+    return fixed_weights_list
 
 
 def drawdown(x):
@@ -221,7 +752,7 @@ def drawdown(x):
     :returns: pd.DataFrame or Series
     
     """
-    maxx = pd.rolling_max(x, len(x), min_periods=1)
+    maxx = x.cummax()
     return x - maxx
 
 
@@ -0,0 +1,102 @@
+'''
+Tests for syscore.accounting.account_curve_stats
+'''
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from syscore.accounting import accountCurveSingle, accountCurveGroup, account_curve_stats, ACCOUNT_STATS_LIST
+from syscore.accounting import acc_list_to_pd_frame
+
+
+def _same_stat(stat1, stat2):
+    if np.isnan(stat1) or np.isnan(stat2):
+        return np.isnan(stat1) and np.isnan(stat2)
+    if np.isinf(stat1) or np.isinf(stat2):
+        return stat1 == stat2
+    return np.isclose(stat1, stat2, rtol=1e-10, atol=1e-12)
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        curves = []
+        for (start, periods) in [(pd.datetime(2010, 1, 1), 800), (pd.datetime(2010, 6, 1), 500),
+                                 (pd.datetime(2011, 1, 3), 300)]:
+            returns = pd.Series(random_state.randn(periods) + 0.05, index=pd.bdate_range(start, periods=periods))
+            returns.iloc[:10] = np.nan
+            returns.iloc[100:120] = np.nan
+            curves.append(accountCurveSingle(returns, returns * 0.9, returns * -0.1, 1000.0))
+
+        setattr(self, "curves", curves)
+
+    def test_same_as_methods(self):
+        for curve in self.curves:
+            for freq in ["daily", "weekly", "monthly"]:
+                freq_curve = getattr(curve, freq)
+                all_stats = account_curve_stats(freq_curve.values, freq_curve._returns_scalar,
+                                                freq_curve._vol_scalar)
+                for stat_name in ACCOUNT_STATS_LIST:
+                    self.assertTrue(_same_stat(float(getattr(freq_curve, stat_name)()), all_stats[stat_name][0]),
+                                    "%s %s" % (freq, stat_name))
+
+    def test_group_stats(self):
+        group = accountCurveGroup(self.curves, ["a", "b", "c"], capital=1000.0)
+        for freq in ["daily", "weekly"]:
+            for stat_name in ["sharpe", "avg_drawdown", "time_in_drawdown", "skew"]:
+                group_stats = group.get_stats(stat_name, freq=freq)
+                for (asset_name, curve) in zip(["a", "b", "c"], self.curves):
+                    one_curve_stat = float(getattr(getattr(curve.net, freq).percent(), stat_name)())
+                    self.assertTrue(_same_stat(one_curve_stat, group_stats[asset_name]), stat_name)
+
+    def test_group_frame(self):
+        group = accountCurveGroup(self.curves, ["a", "b", "c"], capital=1000.0)
+        expected = acc_list_to_pd_frame([curve.net for curve in self.curves], ["a", "b", "c"])
+
+        self.assertTrue(group.to_frame().equals(expected))
+        self.assertTrue(group.as_ts().equals(group.net.as_ts()))
+
+        ## changing what we get back doesn't change the group
+        group.to_frame().iloc[:, :] = 0.0
+        self.assertTrue(group.to_frame().equals(expected))
+
+    def test_group_members(self):
+        group = accountCurveGroup(self.curves, ["a", "b", "c"], capital=1000.0)
+
+        ## members are made again from the group's returns, and are the same as the curves we gave it
+        for (member, curve) in zip(group.to_list, self.curves):
+            for curve_type in ["net", "gross", "costs"]:
+                for freq in ["daily", "weekly"]:
+                    self.assertTrue(getattr(getattr(member, curve_type), freq).as_ts().equals(
+                        getattr(getattr(curve, curve_type), freq).as_ts()))
+            self.assertEqual(member.capital, curve.capital)
+
+        ## we only put together the weekly returns once
+        weekly_returns = group.net.aligned_returns("weekly", True)
+        group.get_stats("sharpe", freq="weekly")
+        self.assertTrue(group.net.aligned_returns("weekly", True)[0] is weekly_returns[0])
+
+    def test_bootstrap(self):
+        stack = accountCurveGroup(self.curves, ["a", "b", "c"], capital=1000.0).stack()
+        bootstrapped = stack.bootstrap(no_runs=200, length=250, seed=1)
+        bootstrapped_again = stack.bootstrap(no_runs=200, length=250, seed=1)
+
+        self.assertEqual(bootstrapped.to_frame().shape, (250, 200))
+        self.assertTrue(bootstrapped.to_frame().equals(bootstrapped_again.to_frame()))
+        self.assertTrue(bootstrapped.gross.to_frame().equals(bootstrapped_again.gross.to_frame()))
+
+        ## curves are the same as we'd get by building them one by one
+        one_run = bootstrapped["b3"]
+        expected = acc_list_to_pd_frame([curve.net for curve in bootstrapped.to_list], bootstrapped.asset_columns)
+        self.assertTrue(bootstrapped.to_frame().equals(expected))
+        np.testing.assert_allclose(one_run.gross.as_ts().values + one_run.costs.as_ts().values,
+                                   one_run.net.as_ts().values)
+
+        group_sharpe = bootstrapped.get_stats("sharpe")
+        self.assertTrue(_same_stat(float(one_run.net.percent().sharpe()), group_sharpe["b3"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,9 +6,10 @@ Created on 27 Nov 2015
 import unittest as ut
 
 import numpy as np
+import pandas as pd
 
 from syscore.pdutils import pd_readcsv_frompackage
-from syscore.algos import robust_vol_calc
+from syscore.algos import robust_vol_calc, rolling_quantile
 
 
 class Test(ut.TestCase):
@@ -56,6 +57,19 @@ class Test(ut.TestCase):
         vol = robust_vol_calc(returns, floor_days=10, floor_min_periods=5)
         self.assertAlmostEqual(vol.iloc[-1, 0], 0.42134038479240132)
 
+    def test_rolling_quantile(self):
+        data = np.random.RandomState(42).standard_normal((400, 3))
+        data[data > 1.5] = np.nan
+        data = pd.DataFrame(data)
+
+        results = rolling_quantile(data, 50, 0.05, 10)
+
+        for column in data.columns:
+            expected = pd.rolling_quantile(data[column], 50, 0.05, 10)
+            single = rolling_quantile(data[column], 50, 0.05, 10)
+            self.assertTrue(np.allclose(expected.values, single.values, equal_nan=True))
+            self.assertTrue(np.allclose(expected.values, results[column].values, equal_nan=True))
+
 """
     def test_calc_ewmac_forecast(self):
         prices=pd_readcsv_frompackage("syscore", "pricetestdata.csv", ["tests"])
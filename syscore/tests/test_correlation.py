@@ -7,6 +7,10 @@ Created on 20 Jan 2016
 '''
 import unittest
 import numpy as np
+import pandas as pd
+from syscore.genutils import str2Bool
+from syscore.correlations import CorrelationEstimator, correlation_single_period
+from syscore.pdutils import pooled_data_from_list
 from systems.tests.testdata import get_test_object_futures_with_rules_and_capping_estimate
 from systems.basesystem import System
 from systems.forecast_combine import ForecastCombineEstimated
@@ -23,6 +27,34 @@ class Test(unittest.TestCase):
     def tearDown(self):
         self.system.delete_all_items(delete_protected=True)
 
+    def _check_pooled(self, instrument_code):
+        ## the last pooled correlation should be the average of each instrument's exponential correlation
+        ## (with the lookback as it is), or without an exponent the correlation over all their forecasts
+        this_stage=self.system.combForecast
+        corr_params=self.system.config.forecast_correlation_estimate
+
+        ans=this_stage.get_forecast_correlation_matrices(instrument_code)
+        fit_period=ans.fit_dates[-1]
+
+        forecasts=[this_stage.get_all_forecasts(code, this_stage.apply_cost_weighting(code)).ffill()
+                   for code in this_stage.has_same_cheap_rules_as_code(instrument_code)]
+        forecasts=[forecast[ans.columns].resample(corr_params['frequency'], how="last")[fit_period.fit_start:fit_period.fit_end]
+                   for forecast in forecasts]
+
+        if str2Bool(corr_params['using_exponent']):
+            expected=np.mean([pd.ewmcorr(forecast, span=int(corr_params['ew_lookback']), 
+                                         min_periods=corr_params['min_periods']).values[-1]
+                              for forecast in forecasts], axis=0)
+        else:
+            expected=np.array(pd.concat(forecasts, axis=0).corr(min_periods=corr_params["min_periods"]).values)
+
+        if str2Bool(corr_params['floor_at_zero']):
+            expected[expected<0]=0.0
+
+        np.testing.assert_allclose(ans.corr_list[-1], expected, rtol=1e-6)
+
+        return ans
+
     
     def testDefaults(self):
         instrument_code="EDOLLAR"
@@ -32,13 +64,11 @@ class Test(unittest.TestCase):
         print(ans.columns)
 
         instrument_code="US10"
-        ans=self.system.combForecast.get_forecast_correlation_matrices(instrument_code)
-        self.assertAlmostEqual(ans.corr_list[-1][0][1], 0.11686990, places=5)
+        ans=self._check_pooled(instrument_code)
         print(ans.columns)
         
         instrument_code="BUND"
-        ans=self.system.combForecast.get_forecast_correlation_matrices(instrument_code)
-        self.assertAlmostEqual(ans.corr_list[-1][0][1], 0.9014138496, places=5)
+        ans=self._check_pooled(instrument_code)
         print(ans.columns)
 
     def testPooling(self):
@@ -62,30 +92,37 @@ class Test(unittest.TestCase):
         self.system.config.forecast_correlation_estimate['floor_at_zero']=False
         instrument_code="US10"
         
-        ans=self.system.combForecast.get_forecast_correlation_matrices(instrument_code)
-        self.assertAlmostEqual(ans.corr_list[-1][0][1], 0.012915602974, places=5)
+        self._check_pooled(instrument_code)
         
     def testDatemethod(self):
         self.system.config.forecast_correlation_estimate['date_method']="rolling"
         instrument_code="US10"
         
-        ans=self.system.combForecast.get_forecast_correlation_matrices(instrument_code)
-        self.assertAlmostEqual(ans.corr_list[-1][0][1], 0.1152719945526076, places=5)
+        self._check_pooled(instrument_code)
         
     def testExponent(self):
         self.system.config.forecast_correlation_estimate['using_exponent']="False"
         instrument_code="US10"
         
-        ans=self.system.combForecast.get_forecast_correlation_matrices(instrument_code)
+        ans=self._check_pooled(instrument_code)
         print(ans)
-        self.assertAlmostEqual(ans.corr_list[-1][0][1], 0.127147, places=5)
+
+    def testIncremental(self):
+        self.system.config.forecast_correlation_estimate['incremental_moments']="True"
+        instrument_code="US10"
+        
+        ## same answers as testDefaults and testExponent
+        self._check_pooled(instrument_code)
+
+        self.system.delete_all_items(delete_protected=True)
+        self.system.config.forecast_correlation_estimate['using_exponent']="False"
+        self._check_pooled(instrument_code)
 
     def testExponentLookback(self):
         self.system.config.forecast_correlation_estimate['ew_lookback']=50
         instrument_code="US10"
         
-        ans=self.system.combForecast.get_forecast_correlation_matrices(instrument_code)
-        self.assertAlmostEqual(ans.corr_list[-1][0][1], 0.0764327959, places=5)
+        self._check_pooled(instrument_code)
 
     def testminperiods(self):
         self.system.config.forecast_correlation_estimate['pool_instruments']="False"
@@ -106,6 +143,34 @@ class Test(unittest.TestCase):
         self.assertTrue(np.isnan(ans.corr_list[0][0][0]))
         self.assertTrue(np.isnan(ans.corr_list[1][0][0]))
 
+    def testPooledMembers(self):
+        random_state=np.random.RandomState(4)
+        data_list=[pd.DataFrame(random_state.randn(periods, 3)+random_state.randn(periods, 1), columns=["a", "b", "c"],
+                                index=pd.date_range(start, periods=periods, freq="W"))
+                   for (start, periods) in [(pd.datetime(2000, 1, 2), 500), (pd.datetime(2004, 1, 4), 300)]]
+        data_list[1].iloc[:50, 2]=np.nan
+        pooled=pooled_data_from_list(data_list)
+
+        ## each member gets the lookback as it is, however many members there are
+        for incremental_moments in [True, False]:
+            ans=CorrelationEstimator(pooled, ew_lookback=50, floor_at_zero=False, cleaning=False,
+                                     incremental_moments=incremental_moments)
+            from_list=CorrelationEstimator(data_list, ew_lookback=50, floor_at_zero=False, cleaning=False,
+                                           incremental_moments=incremental_moments)
+            fit_period=ans.fit_dates[-1]
+
+            expected=np.mean([pd.ewmcorr(data_item[fit_period.fit_start:fit_period.fit_end], span=50, 
+                                         min_periods=20).values[-1] for data_item in data_list], axis=0)
+
+            np.testing.assert_allclose(ans.corr_list[-1], expected, rtol=1e-8)
+            np.testing.assert_allclose(from_list.corr_list[-1], expected, rtol=1e-8)
+
+        expected=np.mean([pd.ewmcorr(data_item, span=50, min_periods=20).values[-1] for data_item in data_list], axis=0)
+        np.testing.assert_allclose(correlation_single_period(pooled, ew_lookback=50, floor_at_zero=False), 
+                                   expected, rtol=1e-8)
+        np.testing.assert_allclose(correlation_single_period(pooled, using_exponent=False, floor_at_zero=False), 
+                                   pd.concat(data_list, axis=0).corr().values, rtol=1e-8)
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
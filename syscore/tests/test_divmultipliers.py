@@ -0,0 +1,59 @@
+'''
+Tests for syscore.divmultipliers
+'''
+import unittest
+import numpy as np
+import pandas as pd
+
+from syscore.correlations import CorrelationList
+from syscore.dateutils import generate_fitting_dates
+from syscore.divmultipliers import diversification_multiplier_from_list, diversification_mult_single_period
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        index = pd.bdate_range(pd.datetime(2000, 1, 3), periods=1500)
+        fit_dates = generate_fitting_dates(pd.DataFrame(index=index, columns=["a", "b", "c"]), "expanding")
+
+        corr_list = []
+        for notUsed in fit_dates:
+            corrmatrix = np.corrcoef(random_state.randn(3, 50))
+            corrmatrix[corrmatrix < 0] = 0.0
+            corr_list.append(corrmatrix)
+
+        weights = pd.DataFrame(random_state.rand(1400, 3), index=index[100:], columns=["c", "b", "a"])
+        weights.iloc[300:400, :] = 0.0
+
+        setattr(self, "correlation_list", CorrelationList(corr_list, ["a", "b", "c"], fit_dates))
+        setattr(self, "weights", weights)
+
+    def test_periods_match_single_period(self):
+        div_mult = diversification_multiplier_from_list(self.correlation_list, self.weights, ewma_span=1)
+
+        weights = self.weights[self.correlation_list.columns]
+        for (corrmatrix, fit_period) in zip(self.correlation_list.corr_list, self.correlation_list.fit_dates):
+            weight_slice = weights[:fit_period.period_start]
+            if weight_slice.shape[0] == 0:
+                continue
+            expected = diversification_mult_single_period(corrmatrix, list(weight_slice.iloc[-1, :].values))
+            ## the multiplier changes on the first day of the period
+            self.assertAlmostEqual(div_mult[fit_period.period_start:].iloc[0], expected)
+
+    def test_daily_dm(self):
+        div_mult = diversification_multiplier_from_list(self.correlation_list, self.weights, ewma_span=1,
+                                                        daily_dm=True)
+
+        weights = self.weights[self.correlation_list.columns]
+        period_starts = [fit_period.period_start for fit_period in self.correlation_list.fit_dates]
+        for row_number in range(0, len(weights.index), 50):
+            row_date = weights.index[row_number]
+            corr_number = sum([period_start <= row_date for period_start in period_starts]) - 1
+            expected = diversification_mult_single_period(self.correlation_list.corr_list[corr_number],
+                                                          list(weights.iloc[row_number, :].values))
+            self.assertAlmostEqual(div_mult.iloc[row_number], expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,243 @@
+'''
+Tests for syscore.optimisation
+'''
+import unittest as ut
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from syscore.optimisation import momentsEstimator, bootstrap_moments, bootstrap_portfolio, GenericOptimiser, optimise, spooledDiag
+from syscore.dateutils import generate_fitting_dates
+
+
+def simple_optimise_params():
+    return dict(correlation_estimate=dict(func="syscore.correlations.correlation_single_period",
+                                          using_exponent=False, min_periods=5, floor_at_zero=True),
+                mean_estimate=dict(func="syscore.algos.mean_estimator", using_exponent=False, min_periods=3),
+                vol_estimate=dict(func="syscore.algos.vol_estimator", using_exponent=False, min_periods=3))
+
+
+def returns_for_test():
+    random_state = np.random.RandomState(0)
+    returns = pd.DataFrame(random_state.randn(200, 3), columns=["a", "b", "c"])
+    returns.iloc[:60, 1] = np.nan
+    returns.iloc[random_state.rand(200) < 0.2, 2] = np.nan
+
+    return returns
+
+
+def portfolio_SR(weights, sigma, mean_list):
+    weights = np.array(weights)
+    return weights.dot(mean_list) / (weights.dot(sigma).dot(weights) ** .5)
+
+
+class Test(ut.TestCase):
+
+    def test_bootstrap_moments(self):
+        returns = returns_for_test()
+        moments_estimator = momentsEstimator(simple_optimise_params(), 52, 0.5)
+
+        bs_idx = np.random.RandomState(1).randint(0, len(returns), size=(10, 50))
+        batched = bootstrap_moments(returns, bs_idx, moments_estimator)
+
+        for (draw_idx, batched_moments) in zip(bs_idx, batched):
+            one_draw = moments_estimator.moments(returns.iloc[list(draw_idx), :])
+            for (batched_item, one_draw_item) in zip(batched_moments, one_draw):
+                np.testing.assert_allclose(np.array(batched_item, dtype=float),
+                                           np.array(one_draw_item, dtype=float), rtol=1e-10)
+
+    def test_bootstrap_moments_wide(self):
+        ## lots of assets, as with instrument weights; some missing data and a column with no variation
+        random_state = np.random.RandomState(2)
+        returns = pd.DataFrame(random_state.randn(300, 200))
+        returns[returns > 2.0] = np.nan
+        returns.iloc[:100, 5] = np.nan
+        returns[7] = 0.25
+        moments_estimator = momentsEstimator(simple_optimise_params(), 52, 0.5)
+
+        ## more draws than we work out at once
+        bs_idx = random_state.randint(0, len(returns), size=(30, 50))
+        batched = bootstrap_moments(returns, bs_idx, moments_estimator)
+
+        for (draw_idx, batched_moments) in zip(bs_idx, batched):
+            one_draw = moments_estimator.moments(returns.iloc[list(draw_idx), :])
+            for (batched_item, one_draw_item) in zip(batched_moments, one_draw):
+                np.testing.assert_allclose(np.array(batched_item, dtype=float),
+                                           np.array(one_draw_item, dtype=float), rtol=1e-8, atol=1e-12)
+
+    def test_batched_bootstrap_is_repeatable(self):
+        returns = returns_for_test().fillna(0.0) + 0.05
+        moments_estimator = momentsEstimator(simple_optimise_params(), 52, 0.5)
+
+        (weights, diag) = bootstrap_portfolio(returns, moments_estimator, True, [True] * 3,
+                                              monte_runs=10, batch_bootstrap=True, seed=3)
+        (weights_again, diag) = bootstrap_portfolio(returns, moments_estimator, True, [True] * 3,
+                                                    monte_runs=10, batch_bootstrap=True, seed=3)
+
+        self.assertEqual(weights, weights_again)
+        self.assertAlmostEqual(sum(weights), 1.0)
+        self.assertEqual(len(diag["bootstraps"]), 10)
+
+    def test_optimise_periods_in_parallel(self):
+        random_state = np.random.RandomState(2)
+        returns = pd.DataFrame(random_state.randn(300, 3) + 0.05, columns=["a", "b", "c"],
+                               index=pd.date_range(pd.datetime(2000, 1, 7), periods=300, freq="W"))
+
+        ## slsqp_analytic can start from given weights, but each period starts from the same place
+        for solver in ["slsqp", "slsqp_analytic"]:
+            all_weights = []
+            for workers in [1, 2]:
+                optimiser = GenericOptimiser(method="bootstrap", apply_cost_weight=False, equalise_SR=False,
+                                             monte_runs=5, batch_bootstrap=True, seed=1, workers=workers,
+                                             solver=solver, **simple_optimise_params())
+                setattr(optimiser, "data", returns)
+                optimiser.optimise()
+                all_weights.append(optimiser.weights)
+
+            self.assertTrue(all_weights[0].equals(all_weights[1]), solver)
+
+    def test_analytic_solver(self):
+        random_state = np.random.RandomState(4)
+        for notUsed in range(20):
+            corrmatrix = np.corrcoef(random_state.randn(4, 60))
+            corrmatrix[corrmatrix < 0] = 0.0
+            stdev = random_state.rand(4) * 0.1 + 0.1
+            sigma = stdev[:, np.newaxis] * corrmatrix * stdev[np.newaxis, :]
+            mean_list = list(random_state.rand(4) * 0.1 + 0.02)
+
+            numerical = optimise(sigma, mean_list)
+            analytic = optimise(sigma, mean_list, solver="slsqp_analytic")
+            warm_started = optimise(sigma, mean_list, solver="slsqp_analytic", start_weights=analytic)
+
+            ## slsqp stops up to about 2.5e-3 short of the optimum weights, so compare Sharpe Ratios as well
+            for weights in [analytic, warm_started]:
+                np.testing.assert_allclose(weights, numerical, atol=5e-3)
+                self.assertTrue(portfolio_SR(weights, sigma, mean_list) >=
+                                portfolio_SR(numerical, sigma, mean_list) - 1e-8)
+
+    def test_active_set_solver(self):
+        random_state = np.random.RandomState(5)
+        for notUsed in range(20):
+            corrmatrix = np.corrcoef(random_state.randn(6, 60))
+            stdev = random_state.rand(6) * 0.1 + 0.1
+            sigma = stdev[:, np.newaxis] * corrmatrix * stdev[np.newaxis, :]
+            ## some negative means, so some weights end up at zero
+            mean_list = list(random_state.rand(6) * 0.1 - 0.02)
+
+            numerical = optimise(sigma, mean_list, solver="slsqp_analytic")
+            active_set = optimise(sigma, mean_list, solver="active_set")
+
+            ## slsqp stops a little short of the optimum, so compare Sharpe Ratios as well as weights
+            np.testing.assert_allclose(active_set, numerical, atol=5e-3)
+            self.assertTrue(portfolio_SR(active_set, sigma, mean_list) >=
+                            portfolio_SR(numerical, sigma, mean_list) - 1e-8)
+            self.assertAlmostEqual(sum(active_set), 1.0)
+            self.assertTrue(min(active_set) >= 0.0)
+
+    def test_incremental_moments(self):
+        random_state = np.random.RandomState(6)
+        returns = pd.DataFrame(random_state.randn(600, 3), columns=["a", "b", "c"],
+                               index=pd.date_range(pd.datetime(2000, 1, 7), periods=600, freq="W"))
+        returns.iloc[:200, 1] = np.nan
+        returns.iloc[random_state.rand(600) < 0.2, 2] = np.nan
+        moments_estimator = momentsEstimator(simple_optimise_params(), 52, 0.5)
+
+        for date_method in ["expanding", "rolling"]:
+            fit_dates = generate_fitting_dates(returns, date_method=date_method, rollyears=3)
+            incremental = moments_estimator.moments_for_fit_periods(returns, fit_dates)
+
+            for (fit_period, incremental_moments) in zip(fit_dates, incremental):
+                if fit_period.no_data:
+                    self.assertTrue(incremental_moments is None)
+                    continue
+
+                one_period = moments_estimator.moments(returns[fit_period.fit_start:fit_period.fit_end])
+                for (incremental_item, one_period_item) in zip(incremental_moments, one_period):
+                    np.testing.assert_allclose(np.array(incremental_item, dtype=float),
+                                               np.array(one_period_item, dtype=float), rtol=1e-8)
+
+    def test_diagnostics_levels(self):
+        random_state = np.random.RandomState(7)
+        returns = pd.DataFrame(random_state.randn(200, 3) + 0.05, columns=["a", "b", "c"],
+                               index=pd.date_range(pd.datetime(2000, 1, 7), periods=200, freq="W"))
+        diagnostics_path = tempfile.mkdtemp()
+
+        all_results = dict()
+        try:
+            for (diagnostics, path) in [("none", None), ("summary", None), ("full", None), ("full", diagnostics_path)]:
+                optimiser = GenericOptimiser(method="bootstrap", apply_cost_weight=False, equalise_SR=False,
+                                             monte_runs=5, batch_bootstrap=True, seed=1, diagnostics=diagnostics,
+                                             diagnostics_path=path, **simple_optimise_params())
+                setattr(optimiser, "data", returns)
+                optimiser.optimise()
+                all_results[(diagnostics, path)] = optimiser.results
+
+            for (none_result, summary_result, full_result, spooled_result) in zip(*[
+                    all_results[key] for key in [("none", None), ("summary", None), ("full", None),
+                                                 ("full", diagnostics_path)]]):
+                self.assertTrue(none_result.diag is None)
+                if full_result.diag is None:
+                    ## no data this period
+                    continue
+
+                self.assertEqual(summary_result.diag["monte_runs"], 5)
+                np.testing.assert_allclose(summary_result.diag["weights"], summary_result.weights)
+                self.assertEqual(len(full_result.diag["bootstraps"]), 5)
+
+                self.assertTrue(isinstance(spooled_result.diag, spooledDiag))
+                spooled = spooled_result.diag.load()
+                np.testing.assert_allclose(spooled["bootstraps"][0]["weights"],
+                                           full_result.diag["bootstraps"][0]["weights"])
+        finally:
+            shutil.rmtree(diagnostics_path)
+
+        self.assertRaises(Exception, GenericOptimiser, equalise_SR=False, diagnostics="some")
+
+    def test_result_cache(self):
+        random_state = np.random.RandomState(8)
+        returns = pd.DataFrame(random_state.randn(200, 3) + 0.05, columns=["a", "b", "c"],
+                               index=pd.date_range(pd.datetime(2000, 1, 7), periods=200, freq="W"))
+        result_cache_path = tempfile.mkdtemp()
+
+        calls = []
+
+        def _optimised(data, **extra_params):
+            optimiser = GenericOptimiser(method="shrinkage", apply_cost_weight=False, equalise_SR=False,
+                                         result_cache_path=result_cache_path,
+                                         **dict(simple_optimise_params(), **extra_params))
+            optimise_periods = optimiser.optimise_periods
+
+            def _counted_optimise_periods(*args, **kwargs):
+                calls.append(1)
+                return optimise_periods(*args, **kwargs)
+
+            setattr(optimiser, "optimise_periods", _counted_optimise_periods)
+            setattr(optimiser, "data", data)
+            optimiser.optimise()
+            return optimiser
+
+        try:
+            first = _optimised(returns)
+            self.assertEqual(len(calls), 1)
+
+            ## identical inputs come from the cache
+            cached = _optimised(returns.copy())
+            self.assertEqual(len(calls), 1)
+            self.assertTrue(cached.weights.equals(first.weights))
+            self.assertTrue(cached.raw_weights.equals(first.raw_weights))
+
+            ## different data, parameters or fitting dates mean optimising again
+            _optimised(returns * 2.0)
+            self.assertEqual(len(calls), 2)
+            _optimised(returns, shrinkage_corr=0.25)
+            self.assertEqual(len(calls), 3)
+            _optimised(returns, date_method="rolling", rollyears=1)
+            self.assertEqual(len(calls), 4)
+        finally:
+            shutil.rmtree(result_cache_path)
+
+
+if __name__ == "__main__":
+    ut.main()
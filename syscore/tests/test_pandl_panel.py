@@ -0,0 +1,70 @@
+'''
+Tests for syscore.accounting.account_curves_from_panel
+'''
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from syscore.accounting import accountCurve, account_curves_from_panel
+
+
+def _same_series(series1, series2):
+    return series1.index.equals(series2.index) and np.allclose(np.array(series1, dtype=float),
+                                                                np.array(series2, dtype=float),
+                                                                rtol=1e-9, atol=1e-9, equal_nan=True)
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        list_of_kwargs = []
+        for (instr_idx, (start, periods)) in enumerate([(pd.datetime(2001, 1, 1), 500), (pd.datetime(2001, 3, 1), 300),
+                                                        (pd.datetime(2000, 6, 1), 700), (pd.datetime(2001, 1, 10), 200)]):
+            index = pd.bdate_range(start, periods=periods)
+            price = pd.Series(100.0 + random_state.randn(periods).cumsum(), index=index)
+            price.iloc[random_state.rand(periods) < 0.05] = np.nan
+            positions = pd.Series(np.round(random_state.randn(periods).cumsum() * 3.0, 1), index=index)
+            positions.iloc[:15] = np.nan
+            fx = pd.Series(1.0 + 0.1 * random_state.rand(periods), index=index)
+            fx = fx[random_state.rand(periods) < 0.8]
+
+            kwargs = dict(price=price, positions=positions, fx=fx, value_of_price_point=float(instr_idx + 1))
+            if instr_idx == 0:
+                kwargs["SR_cost"] = 0.01
+            if instr_idx == 1:
+                kwargs["cash_costs"] = (0.5, 2.0, 0.001)
+            list_of_kwargs.append(kwargs)
+
+        ## one from a forecast, and one which can't go in the panel
+        index = pd.bdate_range(pd.datetime(2001, 1, 1), periods=300)
+        price = pd.Series(100.0 + random_state.randn(300).cumsum(), index=index)
+        forecast = pd.Series(random_state.randn(300).cumsum(), index=index)
+        list_of_kwargs.append(dict(price=price, forecast=forecast,
+                                   get_daily_returns_volatility=pd.Series(1.0, index=index)))
+        list_of_kwargs.append(dict(price=price, positions=forecast.iloc[5:].round()))
+
+        setattr(self, "list_of_kwargs", list_of_kwargs)
+
+    def test_same_as_one_at_a_time(self):
+        for (delayfill, roundpositions) in [(True, True), (False, False)]:
+            curve_kwargs = dict(capital=1000.0, ann_risk_target=0.2, delayfill=delayfill,
+                                roundpositions=roundpositions)
+            panel_curves = account_curves_from_panel(self.list_of_kwargs, **curve_kwargs)
+
+            for (kwargs, panel_curve) in zip(self.list_of_kwargs, panel_curves):
+                one_curve = accountCurve(**dict(kwargs, **curve_kwargs))
+                for curve_type in ["gross", "net", "costs"]:
+                    self.assertTrue(_same_series(getattr(one_curve, curve_type).as_ts(),
+                                                 getattr(panel_curve, curve_type).as_ts()), curve_type)
+                    self.assertTrue(_same_series(one_curve.unweighted_instr_ccy_pandl[curve_type],
+                                                 panel_curve.unweighted_instr_ccy_pandl[curve_type]), curve_type)
+
+                self.assertTrue(_same_series(one_curve.cum_trades, panel_curve.cum_trades))
+                self.assertTrue(_same_series(one_curve.trades_to_use, panel_curve.trades_to_use))
+                self.assertEqual(one_curve.capital, panel_curve.capital)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+'''
+Tests for syscore.pdutils.pooledData
+'''
+import unittest
+import pandas as pd
+import numpy as np
+from syscore.pdutils import df_from_list, pooled_data_from_list
+
+
+class Test(unittest.TestCase):
+
+    def test_pooled_data(self):
+        random_state = np.random.RandomState(0)
+        data_list = [pd.DataFrame(random_state.randn(periods, 2), columns=["b", "a"],
+                                  index=pd.date_range(start, periods=periods))
+                     for (start, periods) in [(pd.datetime(2015, 1, 1), 30), (pd.datetime(2015, 1, 10), 10)]]
+        data_list[1].iloc[:3, 0] = np.nan
+
+        pooled = pooled_data_from_list(data_list)
+        stacked = df_from_list([data_item.copy() for data_item in data_list])
+
+        self.assertTrue(pooled.stacked().equals(stacked))
+        self.assertEqual(pooled.shape, stacked.shape)
+
+        ## slicing picks out the same rows as the stacked frame, even on boundary dates
+        for (start, end) in [(pd.datetime(2015, 1, 10), pd.datetime(2015, 1, 15)),
+                             (None, pd.datetime(2015, 1, 10, 0, 0, 1)), (pd.datetime(2015, 1, 12), None)]:
+            self.assertTrue(pooled[start:end].stacked().equals(stacked[start:end]))
+
+        summed = pooled + pooled * 2.0
+        np.testing.assert_allclose(summed.values, stacked.values * 3.0)
+        np.testing.assert_allclose(pooled.std().values, stacked.std().values)
+
+        self.assertEqual(len(pooled.member_frames()), 2)
+        self.assertTrue(pooled.member_frames()[1].equals(data_list[1][["a", "b"]]))
+
+
+if __name__ == "__main__":
+    unittest.main()
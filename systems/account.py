@@ -2,11 +2,11 @@ from copy import copy
 import pandas as pd
 import numpy as np
 
-from syscore.accounting import accountCurve, accountCurveGroup, weighted
+from syscore.accounting import accountCurve, accountCurveGroup, weighted, account_curves_from_panel
 from systems.stage import SystemStage
 from systems.basesystem import ALL_KEYNAME
 from systems.defaults import system_defaults
-from syscore.algos import robust_vol_calc, apply_buffer
+from syscore.algos import apply_buffer
 from syscore.genutils import TorF
 from syscore.dateutils import ROOT_BDAYS_INYEAR
 from syscore.pdutils import  turnover
@@ -480,7 +480,8 @@ class Account(SystemStage):
 
     def get_daily_returns_volatility(self, instrument_code):
         """
-        Get the daily return (not %) volatility from previous stage, or calculate
+        Get the daily return (not %) volatility from previous stage, or from
+        the system's shared volatility
 
         KEY INPUT
 
@@ -492,20 +493,14 @@ class Account(SystemStage):
         """
 
 
-        def _get_daily_returns_volatility(system, instrument_code, this_stage):
-            if hasattr(system, "rawdata"):
-                returns_vol = system.rawdata.daily_returns_volatility(
-                    instrument_code)
-            else:
-                price = self.get_daily_price(instrument_code)
-                returns_vol = robust_vol_calc(price.diff())
-
-            return returns_vol
-
-        price_volatility = self.parent.calc_or_cache(
-            'get_daily_returns_volatility', instrument_code, _get_daily_returns_volatility, self)
+        if hasattr(self.parent, "rawdata"):
+            returns_vol = self.parent.rawdata.daily_returns_volatility(
+                instrument_code)
+        else:
+            returns_vol = self.parent.get_daily_returns_volatility(
+                instrument_code)
 
-        return price_volatility
+        return returns_vol
 
     def get_volatility_scalar(self, instrument_code):
         """
@@ -1052,47 +1047,17 @@ class Account(SystemStage):
             this_stage.log.msg("Calculating pandl for instrument for %s" % instrument_code,
                                instrument_code=instrument_code)
 
-            price = this_stage.get_daily_price(instrument_code)
-            positions = this_stage.get_buffered_position(instrument_code, roundpositions = roundpositions)
-            fx = this_stage.get_fx_rate(instrument_code)
-            value_of_price_point = this_stage.get_value_of_price_move(
-                instrument_code)
-            get_daily_returns_volatility = this_stage.get_daily_returns_volatility(
-                instrument_code)
-
-
             capital = this_stage.get_notional_capital()
             ann_risk_target = this_stage.get_ann_risk_target()
 
-            (SR_cost, cash_costs)=this_stage.get_costs(instrument_code)
-            
+            pandl_args=this_stage._pandl_args_for_instrument(instrument_code, roundpositions)
 
-            instr_pandl = accountCurve(price, positions = positions,
-                                       delayfill = delayfill, roundpositions = roundpositions, 
-                                fx=fx, value_of_price_point=value_of_price_point, capital=capital,
-                                ann_risk_target = ann_risk_target,
-                                 SR_cost=SR_cost, cash_costs = cash_costs,
-                                get_daily_returns_volatility=get_daily_returns_volatility)
+            instr_pandl = accountCurve(delayfill = delayfill, roundpositions = roundpositions, 
+                                       capital=capital, ann_risk_target = ann_risk_target,
+                                       **pandl_args)
 
-            if SR_cost is not None:
-                ## Note that SR cost is done as a proportion of capital
-                ## Since we're only using part of the capital we need to correct for this
-                turnover_for_SR=this_stage.instrument_turnover(instrument_code, roundpositions = roundpositions)
-                SR_cost = SR_cost * turnover_for_SR
-                weighting = this_stage.get_instrument_scaling_factor(instrument_code)
-                apply_weight_to_costs_only=True
-                
-                instr_pandl=weighted(instr_pandl, 
-                                 weighting = weighting,
-                                apply_weight_to_costs_only=apply_weight_to_costs_only)
-                
-            else:
-                ## Costs wil be correct
-                ## We don't need to do anything
-                pass
-                
-
-            return instr_pandl
+            return this_stage._pandl_for_instrument_with_costs(instr_pandl, instrument_code, 
+                                                               pandl_args["SR_cost"], roundpositions)
 
         instr_pandl = self.parent.calc_or_cache(
             "pandl_for_instrument", instrument_code, _pandl_for_instrument, self, 
@@ -1102,6 +1067,114 @@ class Account(SystemStage):
 
         return instr_pandl
 
+    def _pandl_args_for_instrument(self, instrument_code, roundpositions):
+        """
+        Everything accountCurve needs to work out the p&l for one instrument, apart from capital
+
+        :returns: dict
+        """
+        price = self.get_daily_price(instrument_code)
+        positions = self.get_buffered_position(instrument_code, roundpositions = roundpositions)
+        fx = self.get_fx_rate(instrument_code)
+        value_of_price_point = self.get_value_of_price_move(
+            instrument_code)
+        get_daily_returns_volatility = self.get_daily_returns_volatility(
+            instrument_code)
+
+        (SR_cost, cash_costs)=self.get_costs(instrument_code)
+
+        return dict(price=price, positions=positions, fx=fx, value_of_price_point=value_of_price_point,
+                    SR_cost=SR_cost, cash_costs=cash_costs, 
+                    get_daily_returns_volatility=get_daily_returns_volatility)
+
+    def _pandl_for_instrument_with_costs(self, instr_pandl, instrument_code, SR_cost, roundpositions):
+        """
+        Correct the costs in the p&l for one instrument, if they're SR costs
+
+        :returns: accountCurve
+        """
+
+        if SR_cost is not None:
+            ## Note that SR cost is done as a proportion of capital
+            ## Since we're only using part of the capital we need to correct for this
+            turnover_for_SR=self.instrument_turnover(instrument_code, roundpositions = roundpositions)
+            SR_cost = SR_cost * turnover_for_SR
+            weighting = self.get_instrument_scaling_factor(instrument_code)
+            apply_weight_to_costs_only=True
+            
+            instr_pandl=weighted(instr_pandl, 
+                             weighting = weighting,
+                            apply_weight_to_costs_only=apply_weight_to_costs_only)
+            
+        else:
+            ## Costs wil be correct
+            ## We don't need to do anything
+            pass
+            
+
+        return instr_pandl
+
+    def pandl_for_instrument_for_list(
+            self, instrument_code_list, delayfill=True, roundpositions=True):
+        """
+        Get the p&l for a list of instruments
+
+        Instruments that haven't already been done are worked out together (if they fit in
+          config.pandl_panel_max_size) and cached, as if pandl_for_instrument had been called for each
+
+        :param instrument_code_list: instruments to get values for
+        :type instrument_code_list: list of str
+
+        :param delayfill: Lag fills by one day
+        :type delayfill: bool
+
+        :param roundpositions: Round positions to whole contracts
+        :type roundpositions: bool
+
+        :returns: list of accountCurve
+        """
+        cache_ref=(self.name, "pandl_for_instrument", 
+                   "delayfill%sroundpositions%s" % (TorF(delayfill), TorF(roundpositions)))
+        missing_list=[instrument_code for instrument_code in instrument_code_list
+                      if self.parent.get_item_from_cache(cache_ref, instrument_code) is None]
+
+        if len(missing_list)>0:
+            self.log.terse("Calculating pandl for instruments %s" % ", ".join(missing_list))
+
+            list_of_pandl_args=[self._pandl_args_for_instrument(instrument_code, roundpositions) 
+                                for instrument_code in missing_list]
+            
+            pandl_list=self._account_curves_for_list(list_of_pandl_args, capital=self.get_notional_capital(),
+                                                     ann_risk_target=self.get_ann_risk_target(),
+                                                     delayfill=delayfill, roundpositions=roundpositions)
+
+            for (instrument_code, pandl_args, instr_pandl) in zip(missing_list, list_of_pandl_args, pandl_list):
+                instr_pandl=self._pandl_for_instrument_with_costs(instr_pandl, instrument_code, 
+                                                                  pandl_args["SR_cost"], roundpositions)
+                self.parent.set_item_in_cache(instr_pandl, cache_ref, instrument_code)
+
+        return [self.pandl_for_instrument(instrument_code, delayfill=delayfill, roundpositions=roundpositions)
+                for instrument_code in instrument_code_list]
+
+    def _account_curves_for_list(self, list_of_pandl_args, **kwargs):
+        """
+        An accountCurve for each set of arguments, worked out together if they fit in config.pandl_panel_max_size
+
+        :param list_of_pandl_args: arguments for each accountCurve
+        :type list_of_pandl_args: list of dict
+
+        :param kwargs: arguments for all the accountCurves (capital, delayfill...)
+
+        :returns: list of accountCurve
+        """
+        pandl_panel_max_size=float(self.parent.config.pandl_panel_max_size)
+        panel_size=len(list_of_pandl_args) * max([len(pandl_args["price"]) for pandl_args in list_of_pandl_args])
+        
+        if panel_size<=pandl_panel_max_size:
+            return account_curves_from_panel(list_of_pandl_args, **kwargs)
+        
+        return [accountCurve(**dict(pandl_args, **kwargs)) for pandl_args in list_of_pandl_args]
+
     def pandl_for_trading_rule(self, rule_variation_name, delayfill=True):
         """
         Get the p&l for one trading rule over multiple instruments; as % of it's risk contribution
@@ -1127,6 +1200,9 @@ class Account(SystemStage):
             instrument_list=system.get_instrument_list()
             instrument_list=[instr_code for instr_code in instrument_list 
                              if rule_variation_name in this_stage.get_trading_rule_list(instr_code)]
+
+            ## works out the p&l for all the instruments together, so the weighted p&l is quicker
+            this_stage.pandl_for_instrument_forecast_for_list(instrument_list, rule_variation_name, delayfill)
             
             ## already weighted
             ## capital on these will be the default
@@ -1191,6 +1267,9 @@ class Account(SystemStage):
             instrument_list=system.get_instrument_list()
             instrument_list=[instr_code for instr_code in instrument_list 
                              if rule_variation_name in this_stage.get_trading_rule_list(instr_code)]
+
+            ## works out the p&l for all the instruments together, so the weighted p&l is quicker
+            this_stage.pandl_for_instrument_forecast_for_list(instrument_list, rule_variation_name, delayfill)
             
             ## already weighted, don't need to do again
             pandl_by_instrument_weighted=[this_stage.pandl_for_instrument_forecast_weighted(
@@ -1238,10 +1317,8 @@ class Account(SystemStage):
             instrument_list=[instr_code for instr_code in instrument_list 
                              if rule_variation_name in this_stage.get_trading_rule_list(instr_code)]
             
-            pandl_by_instrument=[this_stage.pandl_for_instrument_forecast(
-                                            instr_code, rule_variation_name, delayfill)
-                              for instr_code in instrument_list   
-                            ]
+            pandl_by_instrument=this_stage.pandl_for_instrument_forecast_for_list(
+                                            instrument_list, rule_variation_name, delayfill)
             
             pandl_rule = accountCurveGroup(pandl_by_instrument, instrument_list, 
                                            capital= ARBITRARY_FORECAST_CAPITAL, weighted_flag=False)
@@ -1617,22 +1694,10 @@ class Account(SystemStage):
             this_stage.log.msg("Calculating pandl for instrument forecast for %s %s" % (instrument_code, rule_variation_name),
                                instrument_code=instrument_code, rule_variation_name=rule_variation_name)
     
-            ## by construction all these things are aligned
-            price = this_stage.get_daily_price(instrument_code)
-            forecast = this_stage.get_aligned_forecast(
-                instrument_code, rule_variation_name)
-            get_daily_returns_volatility = this_stage.get_daily_returns_volatility(
-                instrument_code)
-    
-            ## We NEVER use cash costs for forecasts ...
-            SR_cost = this_stage.get_SR_cost_for_instrument_forecast(instrument_code, rule_variation_name)
-                        
             ## We use percentage returns (as no 'capital') and don't round positions
-            pandl_fcast = accountCurve(price, forecast=forecast, delayfill=delayfill, 
-                                       roundpositions=False,
-                                value_of_price_point=1.0, capital=ARBITRARY_FORECAST_CAPITAL,
-                                SR_cost=SR_cost, cash_costs=None,
-                                get_daily_returns_volatility=get_daily_returns_volatility)
+            pandl_fcast = accountCurve(delayfill=delayfill, roundpositions=False, 
+                                       capital=ARBITRARY_FORECAST_CAPITAL,
+                                       **this_stage._pandl_args_for_instrument_forecast(instrument_code, rule_variation_name))
             
             return pandl_fcast
         
@@ -1644,6 +1709,66 @@ class Account(SystemStage):
 
         return pandl_fcast
 
+    def _pandl_args_for_instrument_forecast(self, instrument_code, rule_variation_name):
+        """
+        Everything accountCurve needs to work out the p&l for one instrument and forecast, apart from capital
+
+        :returns: dict
+        """
+        ## by construction all these things are aligned
+        price = self.get_daily_price(instrument_code)
+        forecast = self.get_aligned_forecast(
+            instrument_code, rule_variation_name)
+        get_daily_returns_volatility = self.get_daily_returns_volatility(
+            instrument_code)
+
+        ## We NEVER use cash costs for forecasts ...
+        SR_cost = self.get_SR_cost_for_instrument_forecast(instrument_code, rule_variation_name)
+
+        return dict(price=price, forecast=forecast, value_of_price_point=1.0, 
+                    SR_cost=SR_cost, cash_costs=None,
+                    get_daily_returns_volatility=get_daily_returns_volatility)
+
+    def pandl_for_instrument_forecast_for_list(
+            self, instrument_code_list, rule_variation_name, delayfill=True):
+        """
+        Get the p&l for a list of instruments and one forecast; as % of arbitrary capital
+
+        Instruments that haven't already been done are worked out together (if they fit in
+          config.pandl_panel_max_size) and cached, as if pandl_for_instrument_forecast had been called for each
+
+        :param instrument_code_list: instruments to get values for
+        :type instrument_code_list: list of str
+
+        :param rule_variation_name: rule to get values for
+        :type rule_variation_name: str
+
+        :param delayfill: Lag fills by one day
+        :type delayfill: bool
+
+        :returns: list of accountCurve
+        """
+        cache_ref=(self.name, "pandl_for_instrument_forecast", "delayfill%s" % TorF(delayfill))
+        missing_list=[instrument_code for instrument_code in instrument_code_list
+                      if self.parent.get_item_from_cache(cache_ref, instrument_code, rule_variation_name) is None]
+
+        if len(missing_list)>0:
+            self.log.terse("Calculating pandl for instrument forecasts for %s %s" % 
+                           (", ".join(missing_list), rule_variation_name))
+
+            list_of_pandl_args=[self._pandl_args_for_instrument_forecast(instrument_code, rule_variation_name) 
+                                for instrument_code in missing_list]
+
+            ## We use percentage returns (as no 'capital') and don't round positions
+            pandl_list=self._account_curves_for_list(list_of_pandl_args, capital=ARBITRARY_FORECAST_CAPITAL,
+                                                     delayfill=delayfill, roundpositions=False)
+
+            for (instrument_code, pandl_fcast) in zip(missing_list, pandl_list):
+                self.parent.set_item_in_cache(pandl_fcast, cache_ref, instrument_code, rule_variation_name)
+
+        return [self.pandl_for_instrument_forecast(instrument_code, rule_variation_name, delayfill=delayfill)
+                for instrument_code in instrument_code_list]
+
     def pandl_for_all_trading_rules(self, delayfill=True):
         """
         Get the p&l for all trading rules; as % of total capital
@@ -1747,11 +1872,10 @@ class Account(SystemStage):
             this_stage.log.terse("Calculating pandl for portfolio")
             capital=this_stage.get_notional_capital()
             instruments = this_stage.get_instrument_list()
-            port_pandl = [
-                this_stage.pandl_for_instrument(
-                    instrument_code,
+            port_pandl = this_stage.pandl_for_instrument_for_list(
+                    instruments,
                     delayfill=delayfill,
-                    roundpositions=roundpositions) for instrument_code in instruments]
+                    roundpositions=roundpositions)
             
             port_pandl = accountCurveGroup(port_pandl, instruments,
                                            capital=capital, 
@@ -2,12 +2,18 @@ import pickle
 from sysdata.configdata import Config
 from syslogdiag.log import logtoscreen
 from syscore.fileutils import get_filename_for_package
+from syscore.algos import vol_config_key, returns_volatility_from_config
 
 """
 This is used for items which affect an entire system, not just one instrument
 """
 ALL_KEYNAME = "all"
 
+"""
+Shared items which don't belong to any one stage are cached under this name
+"""
+SYSTEM_CACHE_NAME = "system"
+
 
 class System(object):
     '''
@@ -173,6 +179,54 @@ class System(object):
 
 
 
+    def get_daily_returns_volatility(self, instrument_code, volconfig=None):
+        """
+        Get the volatility of daily returns (not %)
+
+        This is the single place vol is calculated; every stage asks for it here
+        so each distinct series is only worked out once. It's cached by instrument
+        and a key for the vol configuration.
+
+        :param instrument_code: Instrument to get volatility for
+        :type instrument_code: str
+
+        :param volconfig: dict with func key plus arguments (*default* config.volatility_calculation)
+        :type volconfig: dict or None
+
+        :returns: Tx1 pd.DataFrame
+
+        >>> from systems.tests.testdata import get_test_object
+        >>> (rawdata, data, config)=get_test_object()
+        >>> system=System([rawdata], data)
+        >>> system.get_daily_returns_volatility("EDOLLAR").tail(2)
+                         vol
+        2015-12-10  0.054145
+        2015-12-11  0.058522
+        >>> system.get_daily_returns_volatility("EDOLLAR") is system.rawdata.daily_returns_volatility("EDOLLAR")
+        True
+        """
+        if volconfig is None:
+            volconfig = self.config.volatility_calculation
+
+        cache_ref = (SYSTEM_CACHE_NAME, "daily_returns_volatility",
+                     vol_config_key(volconfig))
+
+        vol = self.get_item_from_cache(cache_ref, instrument_code)
+
+        if vol is None:
+            self.log.msg("Calculating daily volatility for %s" % instrument_code, instrument_code=instrument_code)
+
+            if hasattr(self, "rawdata"):
+                dailyreturns = self.rawdata.daily_returns(instrument_code)
+            else:
+                dailyreturns = self.data.daily_prices(instrument_code).diff()
+
+            vol = returns_volatility_from_config(dailyreturns, volconfig)
+            self.set_item_in_cache(vol, cache_ref, instrument_code)
+
+        return vol
+
+
     """
     A cache lives inside each system object, storing preliminary results
     
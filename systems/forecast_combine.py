@@ -3,8 +3,9 @@ from copy import copy
 
 from syscore.accounting import decompose_group_pandl
 from syscore.genutils import str2Bool
-from syscore.pdutils import  fix_weights_vs_pdm, apply_cap
+from syscore.pdutils import  fix_weights_vs_pdm, combine_and_cap_forecasts, fixed_step_weights, pooled_data_from_list
 from syscore.objects import resolve_function, update_recalc
+from syscore.optimisation import fit_weighting_object, fit_weighting_objects_in_pool
 
 from systems.defaults import system_defaults
 from systems.stage import SystemStage
@@ -51,6 +52,9 @@ class ForecastCombineFixed(SystemStage):
     KEY INPUT: system.forecastScaleCap.get_capped_forecast(instrument_code, rule_variation_name)
                 found in self.get_capped_forecast(instrument_code, rule_variation_name)
 
+                system.forecastScaleCap.get_all_capped_forecasts(instrument_code, rule_variation_list)
+                found in self.get_all_capped_forecasts(instrument_code, rule_variation_list)
+
                 system.forecastScaleCap.get_forecast_cap()
                 found in self.get_forecast_cap()
                 
@@ -68,7 +72,7 @@ class ForecastCombineFixed(SystemStage):
 
         """
 
-        protected = ['get_forecast_weights', 'get_raw_forecast_weights',
+        protected = ['get_forecast_weights', 'get_raw_forecast_weights', '_raw_forecast_weights_to_combine',
                      'get_forecast_diversification_multiplier']
         setattr(self, "_protected", protected)
 
@@ -114,6 +118,24 @@ class ForecastCombineFixed(SystemStage):
         return self.parent.forecastScaleCap.get_capped_forecast(
             instrument_code, rule_variation_name)
 
+    def get_all_capped_forecasts(self, instrument_code, rule_variation_list):
+        """
+        Get the capped forecasts for several rules from the previous module
+
+        KEY INPUT
+
+        :param instrument_code:
+        :type str:
+
+        :param rule_variation_list:
+        :type list: list of str, names of the trading rule variations
+
+        :returns: TxK pd.DataFrame; columns rule_variation_list
+        """
+
+        return self.parent.forecastScaleCap.get_all_capped_forecasts(
+            instrument_code, rule_variation_list)
+
     def get_trading_rule_list(self, instrument_code):
         """
         Get list of all trading rule names
@@ -219,14 +241,9 @@ class ForecastCombineFixed(SystemStage):
             if rule_variation_list is None:
                 rule_variation_list=this_stage.get_trading_rule_list(instrument_code)
     
-            forecasts = [
-                this_stage.get_capped_forecast(
-                    instrument_code,
-                    rule_variation_name) for rule_variation_name in rule_variation_list]
-    
-            forecasts = pd.concat(forecasts, axis=1)
-            
-            forecasts.columns = rule_variation_list
+            ## scaled and capped together, without building each forecast
+            forecasts = this_stage.get_all_capped_forecasts(
+                instrument_code, rule_variation_list)
             
             forecasts = forecasts.ffill()
             
@@ -276,6 +293,25 @@ class ForecastCombineFixed(SystemStage):
         2015-12-11      0.5     0.5
         """
         def _get_raw_forecast_weights(system, instrument_code, this_stage):
+            # daily, covering the range of forecast dates
+            return this_stage._raw_forecast_weights_to_combine(instrument_code).as_df()
+
+        forecast_weights = self.parent.calc_or_cache(
+            "get_raw_forecast_weights", instrument_code, _get_raw_forecast_weights, self)
+        return forecast_weights
+
+    def _raw_forecast_weights_to_combine(self, instrument_code):
+        """
+        The raw forecast weights that get_forecast_weights uses
+
+        Fixed weights are kept as stepWeights, and only expanded over the forecast dates in fix_weights_vs_pdm
+
+        :param instrument_code:
+        :type str:
+
+        :returns: stepWeights, columns are trading rule variation names
+        """
+        def _get_raw_forecast_step_weights(system, instrument_code, this_stage):
             this_stage.log.msg("Calculating raw forecast weights for %s" % (instrument_code),
                                instrument_code=instrument_code)
 
@@ -301,8 +337,8 @@ class ForecastCombineFixed(SystemStage):
                                       for rule_name in rules])
 
             # Now we have a dict, fixed_weights.
-            # Need to turn into a timeseries covering the range of forecast
-            # dates
+            # These only need to start when the forecasts do; they're expanded
+            # over the forecast dates later
             rule_variation_list = sorted(fixed_weights.keys())
 
             forecasts_ts = this_stage.get_all_forecasts(instrument_code, rule_variation_list)
@@ -310,21 +346,13 @@ class ForecastCombineFixed(SystemStage):
             earliest_date = forecasts_ts.index[0]
             latest_date = forecasts_ts.index[-1]
 
-            # this will be daily, but will be resampled later
-            weight_ts = pd.date_range(start=earliest_date, end=latest_date)
-
-            forecasts_weights = dict([
-                (rule_variation_name, pd.Series(
-                    [fixed_weights[rule_variation_name]] * len(weight_ts), index=weight_ts))
-                for rule_variation_name in rule_variation_list])
-
-            forecasts_weights = pd.concat(forecasts_weights, axis=1)
-            forecasts_weights.columns = rule_variation_list
+            forecasts_weights = fixed_step_weights(
+                fixed_weights, earliest_date, latest_date)
 
             return forecasts_weights
 
         forecast_weights = self.parent.calc_or_cache(
-            "get_raw_forecast_weights", instrument_code, _get_raw_forecast_weights, self)
+            "_raw_forecast_weights_to_combine", instrument_code, _get_raw_forecast_step_weights, self)
         return forecast_weights
 
     def get_forecast_weights(self, instrument_code):
@@ -372,7 +400,7 @@ class ForecastCombineFixed(SystemStage):
             this_stage.log.msg("Calculating forecast weights for %s" % (instrument_code),
                                instrument_code=instrument_code)
 
-            forecast_weights = this_stage.get_raw_forecast_weights(
+            forecast_weights = this_stage._raw_forecast_weights_to_combine(
                 instrument_code)
             rule_variation_list = list(forecast_weights.columns)
             forecasts = this_stage.get_all_forecasts(instrument_code, rule_variation_list)
@@ -517,20 +545,10 @@ class ForecastCombineFixed(SystemStage):
                 instrument_code)
             forecast_cap = this_stage.get_forecast_cap()
 
-            # multiply weights by forecasts
-            #NOT NEEDED: (forecast_weights, forecasts) = forecast_weights.align(forecasts, join="right") 
-            combined_forecast = forecast_weights.ffill()* forecasts
-
-            # sum
-            combined_forecast = combined_forecast.sum(
-                axis=1)
-
-            # apply fdm
+            # multiply weights by forecasts, sum, apply fdm and cap in one pass
             # (note in this simple version we aren't adjusting FDM if forecast_weights change)
-
-            raw_combined_forecast = combined_forecast * forecast_div_multiplier.ffill()
-
-            combined_forecast = apply_cap(raw_combined_forecast, forecast_cap)
+            combined_forecast = combine_and_cap_forecasts(forecasts, forecast_weights,
+                                                          forecast_div_multiplier, forecast_cap)
 
             return combined_forecast
 
@@ -655,8 +673,8 @@ class ForecastCombineEstimated(ForecastCombineFixed):
 
             forecast_data=[this_stage.get_all_forecasts(instr_code, this_stage.apply_cost_weighting(instr_code)) for instr_code in codes_to_use]
             
-            ## if we're not pooling passes a list of one
-            forecast_data=[forecast_ts.ffill() for forecast_ts in forecast_data]
+            ## if we're not pooling this is a pool of one
+            forecast_data=pooled_data_from_list([forecast_ts.ffill() for forecast_ts in forecast_data])
 
             return corr_func(forecast_data, log=self.log.setup(call="correlation"), **corr_params)
                             
@@ -833,6 +851,34 @@ class ForecastCombineEstimated(ForecastCombineFixed):
         return cheap_rules
    
    
+    def get_cheap_rules_pooling_index(self):
+        """
+        Groups instruments which have the same set of trading rules, after max cost applied
+
+        Worked out once for the whole system, so pooled estimates can be done once per group
+
+        :returns: dict, keys are tuples of rule names, values are sorted lists of instrument codes
+
+        """
+        def _get_cheap_rules_pooling_index(system, an_ignored_variable, this_stage):
+            this_stage.log.msg("Grouping instruments by cheap trading rules")
+
+            pooling_index = dict()
+            for instrument_code in system.get_instrument_list():
+                rule_key = tuple(sorted(this_stage.apply_cost_weighting(instrument_code)))
+                pooling_index.setdefault(rule_key, []).append(instrument_code)
+
+            for instrument_list in pooling_index.values():
+                instrument_list.sort()
+
+            return pooling_index
+
+        pooling_index = self.parent.calc_or_cache(
+            'get_cheap_rules_pooling_index', ALL_KEYNAME,
+            _get_cheap_rules_pooling_index, self)
+
+        return pooling_index
+
     def has_same_cheap_rules_as_code(self, instrument_code):
         """
         Returns all instruments with same set of trading rules as this one, after max cost applied
@@ -843,131 +889,154 @@ class ForecastCombineEstimated(ForecastCombineFixed):
         :returns: list of str
 
         """
-        
-        my_rules=self.apply_cost_weighting(instrument_code)
-        instrument_list=self.parent.get_instrument_list()
-        
-        def _matches(xlist, ylist):
-            xlist.sort()
-            ylist.sort()
-            return xlist==ylist
-        
-        matching_instruments=[other_code for other_code in instrument_list 
-                           if _matches(my_rules, self.apply_cost_weighting(other_code))]
-        
-        matching_instruments.sort()
-        
-        return matching_instruments
 
-    
+        my_rules = tuple(sorted(self.apply_cost_weighting(instrument_code)))
+        pooling_index = self.get_cheap_rules_pooling_index()
+
+        matching_instruments = copy(pooling_index.get(my_rules, []))
+
+        return matching_instruments
 
     def calculation_of_raw_forecast_weights(self, instrument_code):
         """
         returns the forecast weights for a given instrument code
         
         Checks to see if there are pooled forecasts
+
+        If forecast_weight_estimate['instrument_workers'] is more than one, then all the
+          instruments (or pools of instruments) are optimised at once, using that many processes
         """
-        
-        ## Get some useful stuff from the config
-        ## do we pool our estimation?
-        pooling_returns = str2Bool(self.parent.config.forecast_weight_estimate["pool_gross_returns"])
-        pooling_costs = str2Bool(self.parent.config.forecast_cost_estimates["use_pooled_costs"])
-        
-        if (pooling_returns & pooling_costs):
+
+        workers = int(self.parent.config.forecast_weight_estimate["instrument_workers"])
+        if workers > 1:
+            self.calculation_of_raw_forecast_weights_in_pool(workers)
+
+        if self._pooling_returns_and_costs():
             return self.calculation_of_pooled_raw_forecast_weights(instrument_code)
         else:
             ## could still be using pooled returns 
             return self.calculation_of_raw_forecast_weights_for_instrument(instrument_code)
-        
 
-    def calculation_of_raw_forecast_weights_for_instrument(self, instrument_code):
+    def _pooling_returns_and_costs(self):
+        ## Get some useful stuff from the config
+        ## do we pool our estimation?
+        pooling_returns = str2Bool(self.parent.config.forecast_weight_estimate["pool_gross_returns"])
+        pooling_costs = str2Bool(self.parent.config.forecast_cost_estimates["use_pooled_costs"])
+
+        return pooling_returns & pooling_costs
+
+    def _raw_forecast_weights_cache_key(self, instrument_code):
         """
-        Does an optimisation for a single instrument
-        
-        We do this if we can't do the special case of a pooled optimisation
-        
-        Estimate the forecast weights for this instrument
+        Key for the forecast weight calculation in the cache; instruments that are pooled share one
 
-        We store this intermediate step to expose the calculation object
-        
         :param instrument_code:
         :type str:
 
-        :returns: TxK pd.DataFrame containing weights, columns are trading rule variation names, T covers all
+        :returns: str
         """
+        if self._pooling_returns_and_costs():
+            ## ensures we don't repeat optimisation
+            return "_".join(self.has_same_cheap_rules_as_code(instrument_code))
 
-        def _calculation_of_raw_forecast_weights(system, instrument_code, this_stage, 
-                                      codes_to_use, weighting_func, pool_costs, **weighting_params):
-
-            this_stage.log.terse("Calculating raw forecast weights for %s, over %s" % (instrument_code, ", ".join(codes_to_use)))
-
-            rule_list = self.apply_cost_weighting(instrument_code)
-
-            weight_func=weighting_func(log=self.log.setup(call="weighting"), **weighting_params)
-
-            if weight_func.need_data():
-    
-                ## returns a list of accountCurveGroups
-                pandl_forecasts=[this_stage.get_returns_for_optimisation(code)
-                        for code in codes_to_use]
-                
-                ## the current curve is special
-                pandl_forecasts_this_code=this_stage.get_returns_for_optimisation(instrument_code)
-                
-                ## have to decode these
-                ## returns two lists of pd.DataFrames
-                (pandl_forecasts_gross, pandl_forecasts_costs) = decompose_group_pandl(pandl_forecasts, pandl_forecasts_this_code, pool_costs=pool_costs)
+        return instrument_code
 
-                ## The weighting function requires two lists of pd.DataFrames, one gross, one for costs
-                
-                weight_func.set_up_data(data_gross = pandl_forecasts_gross, data_costs = pandl_forecasts_costs)
-            else:
-                ## in the case of equal weights, don't need data
-                
-                forecasts = this_stage.get_all_forecasts(instrument_code, rule_list)
-                weight_func.set_up_data(weight_matrix=forecasts)
+    def _raw_forecast_weights_task(self, instrument_code):
+        """
+        Everything needed to estimate the forecast weights for this instrument, without the system
 
-            SR_cost_list = [this_stage.get_SR_cost_for_instrument_forecast(instrument_code, rule_variation_name)
-                             for rule_variation_name in rule_list]
-            
-            weight_func.optimise(ann_SR_costs=SR_cost_list)
+        This is so the optimisation itself can be done in another process
 
-            return weight_func
+        :param instrument_code:
+        :type str:
 
+        :returns: dict of keyword arguments for syscore.optimisation.fit_weighting_object
+        """
 
         ## Get some useful stuff from the config
         weighting_params=copy(self.parent.config.forecast_weight_estimate)  
 
         ## do we pool our estimation?
-        pooling_returns = str2Bool(self.parent.config.forecast_weight_estimate["pool_gross_returns"])
+        pooling_returns = str2Bool(weighting_params.pop("pool_gross_returns"))
         pool_costs = str2Bool(self.parent.config.forecast_cost_estimates["use_pooled_costs"])
-        
+
+        ## not used by the optimiser
+        weighting_params.pop("instrument_workers")
+
         ## which function to use for calculation
         weighting_func=resolve_function(weighting_params.pop("func"))
-        
+
         if pooling_returns:
             ## find set of instruments with same trading rules as I have
             codes_to_use=self.has_same_cheap_rules_as_code(instrument_code)
         else:
             codes_to_use=[instrument_code]
-            
+
+        rule_list = self.apply_cost_weighting(instrument_code)
+
+        weight_func=weighting_func(log=self.log.setup(call="weighting"), **weighting_params)
+
+        if weight_func.need_data():
+
+            ## returns a list of accountCurveGroups
+            pandl_forecasts=[self.get_returns_for_optimisation(code)
+                    for code in codes_to_use]
+
+            ## have to decode these
+            ## returns two lists of pd.DataFrames
+            if pooling_returns and pool_costs:
+                ## cost pooling will already have been applied
+                (pandl_forecasts_gross, pandl_forecasts_costs) = decompose_group_pandl(pandl_forecasts, pool_costs=True)
+            else:
+                ## the current curve is special
+                pandl_forecasts_this_code=self.get_returns_for_optimisation(instrument_code)
+
+                (pandl_forecasts_gross, pandl_forecasts_costs) = decompose_group_pandl(pandl_forecasts, pandl_forecasts_this_code, pool_costs=pool_costs)
+
+            ## The weighting function requires two lists of pd.DataFrames, one gross, one for costs
+            data=dict(data_gross = pandl_forecasts_gross, data_costs = pandl_forecasts_costs)
+        else:
+            ## in the case of equal weights, don't need data
+            forecasts = self.get_all_forecasts(instrument_code, rule_list)
+            data=dict(weight_matrix=forecasts)
+
+        SR_cost_list = [self.get_SR_cost_for_instrument_forecast(instrument_code, rule_variation_name)
+                         for rule_variation_name in rule_list]
+
+        return dict(weight_func=weight_func, ann_SR_costs=SR_cost_list, **data)
+
+    def calculation_of_raw_forecast_weights_for_instrument(self, instrument_code):
+        """
+        Does an optimisation for a single instrument
+        
+        We do this if we can't do the special case of a pooled optimisation
+        
+        Estimate the forecast weights for this instrument
+
+        We store this intermediate step to expose the calculation object
+        
+        :param instrument_code:
+        :type str:
+
+        :returns: TxK pd.DataFrame containing weights, columns are trading rule variation names, T covers all
+        """
+
+        def _calculation_of_raw_forecast_weights(system, instrument_code, this_stage):
+
+            this_stage.log.terse("Calculating raw forecast weights for %s" % instrument_code)
+
+            return fit_weighting_object(**this_stage._raw_forecast_weights_task(instrument_code))
+
         ##
-        ## _get_raw_forecast_weights: function to call if we don't find in cache
+        ## _calculation_of_raw_forecast_weights: function to call if we don't find in cache
         ## self: this_system stage object
-        ## codes_to_use: instrument codes to get data for 
-        ## weighting_func: function to call to calculate weights
-        ## **weighting_params: parameters to pass to weighting function
         ##
         raw_forecast_weights_calcs = self.parent.calc_or_cache(
             'calculation_of_raw_forecast_weights', instrument_code, 
             _calculation_of_raw_forecast_weights,
-             self, codes_to_use, weighting_func, pool_costs, **weighting_params)
+             self)
 
         return raw_forecast_weights_calcs
 
-        
-        pass
-
     def calculation_of_pooled_raw_forecast_weights(self, instrument_code):
         """
         Estimate the forecast weights for this instrument
@@ -981,73 +1050,73 @@ class ForecastCombineEstimated(ForecastCombineFixed):
         """
 
         def _calculation_of_pooled_raw_forecast_weights(system, instrument_code_ref, this_stage, 
-                                      codes_to_use, weighting_func,  **weighting_params):
+                                      instrument_code):
 
             this_stage.log.terse("Calculating pooled raw forecast weights over instruments: %s" % instrument_code_ref)
 
+            return fit_weighting_object(**this_stage._raw_forecast_weights_task(instrument_code))
 
-            rule_list = self.apply_cost_weighting(instrument_code)
-
-            weight_func=weighting_func(log=self.log.setup(call="weighting"), **weighting_params)
-            if weight_func.need_data():
-    
-                ## returns a list of accountCurveGroups
-                ## cost pooling will already have been applied
-
-                pandl_forecasts=[this_stage.get_returns_for_optimisation(code)
-                        for code in codes_to_use]
-                
-                ## have to decode these
-                ## returns two lists of pd.DataFrames
-                (pandl_forecasts_gross, pandl_forecasts_costs) = decompose_group_pandl(pandl_forecasts, pool_costs=True)
-
-                ## The weighting function requires two lists of pd.DataFrames, one gross, one for costs
-                
-                weight_func.set_up_data(data_gross = pandl_forecasts_gross, data_costs = pandl_forecasts_costs)
-            else:
-                ## in the case of equal weights, don't need data
-                
-                forecasts = this_stage.get_all_forecasts(instrument_code, rule_list)
-                weight_func.set_up_data(weight_matrix=forecasts)
-
-            SR_cost_list = [this_stage.get_SR_cost_for_instrument_forecast(instrument_code, rule_variation_name)
-                             for rule_variation_name in rule_list]
-            
-            weight_func.optimise(ann_SR_costs=SR_cost_list)
-
-            return weight_func
-
-
-        ## Get some useful stuff from the config
-        weighting_params=copy(self.parent.config.forecast_weight_estimate)  
+        assert self._pooling_returns_and_costs()
 
-        ## do we pool our estimation?
-        pooling_returns = str2Bool(weighting_params.pop("pool_gross_returns"))
-        pooling_costs = self.parent.config.forecast_cost_estimates['use_pooled_costs'] 
-        
-        assert pooling_returns and pooling_costs
-        
-        ## which function to use for calculation
-        weighting_func=resolve_function(weighting_params.pop("func"))
-        
-        codes_to_use=self.has_same_cheap_rules_as_code(instrument_code)
-            
-        instrument_code_ref ="_".join(codes_to_use) ## ensures we don't repeat optimisation
+        instrument_code_ref = self._raw_forecast_weights_cache_key(instrument_code)
         
         ##
-        ## _get_raw_forecast_weights: function to call if we don't find in cache
+        ## _calculation_of_pooled_raw_forecast_weights: function to call if we don't find in cache
         ## self: this_system stage object
-        ## codes_to_use: instrument codes to get data for 
-        ## weighting_func: function to call to calculate weights
-        ## **weighting_params: parameters to pass to weighting function
+        ## instrument_code: any of the instruments in the pool will do
         ##
         raw_forecast_weights_calcs = self.parent.calc_or_cache(
             'calculation_of_raw_forecast_weights', instrument_code_ref, 
             _calculation_of_pooled_raw_forecast_weights,
-             self, codes_to_use, weighting_func, **weighting_params)
+             self, instrument_code)
 
         return raw_forecast_weights_calcs
 
+    def calculation_of_raw_forecast_weights_in_pool(self, workers):
+        """
+        Estimate the forecast weights for every instrument, in a pool of processes
+
+        Each instrument, or pool of instruments with the same cheap rules, is optimised once.
+        Data is prepared here, only the optimisation happens in the other processes. 
+        Results go into the cache where the normal calculation will find them.
+
+        :param workers: Number of processes to use
+        :type workers: int
+
+        :returns: None
+        """
+        cache_ref = (self.name, 'calculation_of_raw_forecast_weights', "")
+
+        task_dict = dict()
+        for instrument_code in self.parent.get_instrument_list():
+            instrument_code_ref = self._raw_forecast_weights_cache_key(instrument_code)
+            if instrument_code_ref in task_dict:
+                continue
+            if self.parent.get_item_from_cache(cache_ref, instrument_code_ref) is not None:
+                continue
+
+            task_dict[instrument_code_ref] = self._raw_forecast_weights_task(instrument_code)
+
+        if len(task_dict) == 0:
+            return None
+
+        instrument_code_refs = sorted(task_dict.keys())
+
+        self.log.terse("Calculating raw forecast weights for %s, using %d processes" %
+                       (", ".join(instrument_code_refs), workers))
+
+        weight_func_list = fit_weighting_objects_in_pool(
+            [task_dict[instrument_code_ref] for instrument_code_ref in instrument_code_refs], workers)
+
+        for (instrument_code_ref, weight_func) in zip(instrument_code_refs, weight_func_list):
+            self.parent.set_item_in_cache(weight_func, cache_ref, instrument_code_ref)
+
+        return None
+
+
+    def _raw_forecast_weights_to_combine(self, instrument_code):
+        ## estimated weights are already only indexed on the fitting dates
+        return self.get_raw_forecast_weights(instrument_code)
 
     def get_raw_forecast_weights(self, instrument_code):
         """
@@ -7,8 +7,9 @@ from systems.stage import SystemStage
 from systems.defaults import system_defaults
 
 from syscore.genutils import str2Bool
-from syscore.pdutils import apply_cap
+from syscore.pdutils import apply_cap, scale_and_cap_forecasts
 from syscore.objects import resolve_function
+from syscore.algos import forecast_scalar as default_scalar_function, forecast_scalars_pooled
 
 class ForecastScaleCap(SystemStage):
     """
@@ -294,6 +295,42 @@ class ForecastScaleCapFixed(SystemStage):
 
         return capped_forecast
 
+    def get_all_capped_forecasts(self, instrument_code, rule_variation_list):
+        """
+        Return the capped, scaled, forecasts for several rules at once
+
+        This goes straight from the raw forecasts and scalars in one pass; it
+        doesn't calculate or cache get_scaled_forecast or get_capped_forecast,
+        which are only worked out if they are asked for
+
+        KEY OUTPUT
+
+        :param instrument_code:
+        :type str:
+
+        :param rule_variation_list:
+        :type list: list of str, names of the trading rule variations
+
+        :returns: TxK pd.DataFrame, columns rule_variation_list; not forward filled
+
+        >>> from systems.tests.testdata import get_test_object_futures_with_rules
+        >>> from systems.basesystem import System
+        >>> (rules, rawdata, data, config)=get_test_object_futures_with_rules()
+        >>> config.forecast_cap=0.2
+        >>> system=System([rawdata, rules, ForecastScaleCapFixed()], data, config)
+        >>> system.forecastScaleCap.get_all_capped_forecasts("EDOLLAR", ["ewmac8"]).tail(2)
+                      ewmac8
+        2015-12-10 -0.190583
+        2015-12-11  0.200000
+        """
+        raw_forecast_list = [self.get_raw_forecast(instrument_code, rule_variation_name)
+                             for rule_variation_name in rule_variation_list]
+        scalar_list = [self.get_forecast_scalar(instrument_code, rule_variation_name)
+                       for rule_variation_name in rule_variation_list]
+        cap = self.get_forecast_cap()
+
+        return scale_and_cap_forecasts(raw_forecast_list, scalar_list, cap, rule_variation_list)
+
 
 class ForecastScaleCapEstimated(ForecastScaleCapFixed):
     """
@@ -325,6 +362,8 @@ class ForecastScaleCapEstimated(ForecastScaleCapFixed):
         If not cached, these are estimated from past forecasts
         
         If configuration variable pool_forecasts_for_scalar is "True", then we do this across instruments.
+        With the default scalar function the pooled scalars for all rules are estimated together,
+        and cached at the same time.
         
         :param instrument_code:
         :type str:
@@ -383,6 +422,44 @@ class ForecastScaleCapEstimated(ForecastScaleCapFixed):
             return scaling_factor
 
 
+        def _get_pooled_forecast_scalars_all_rules(
+                system, Not_Used, rule_variation_name, this_stage, instrument_list,
+                forecast_scalar_config):
+            """
+            Estimate the pooled scalars for every rule still missing from the cache
+            in one go, and put them all in the cache
+            """
+            cache_ref=(this_stage.name, "get_forecast_scalar", "")
+            rule_list=[rule_name for rule_name in system.rules.trading_rules().keys()
+                       if system.get_item_from_cache(cache_ref, ALL_KEYNAME, rule_name) is None]
+            if rule_variation_name not in rule_list:
+                rule_list.append(rule_variation_name)
+
+            this_stage.log.msg("Getting forecast scalars for %s over %s" % (", ".join(rule_list), ", ".join(instrument_list)))
+
+            ## Rules can only be done together if the cross sectional forecasts
+            ## share an index, so group them
+            groups=[]
+            for rule_name in rule_list:
+                forecast_list=[
+                    this_stage.get_raw_forecast(instrument_code, rule_name)
+                    for instrument_code in instrument_list]
+                cs_forecasts=pd.concat(forecast_list, axis=1)
+
+                matching_groups=[group for group in groups if group[0].equals(cs_forecasts.index)]
+                if len(matching_groups)==0:
+                    groups.append((cs_forecasts.index, [rule_name], [cs_forecasts]))
+                else:
+                    matching_groups[0][1].append(rule_name)
+                    matching_groups[0][2].append(cs_forecasts)
+
+            for (index_not_used, group_rule_list, cs_forecasts_list) in groups:
+                scaling_factors=forecast_scalars_pooled(cs_forecasts_list, **forecast_scalar_config)
+                for (rule_name, scaling_factor) in zip(group_rule_list, scaling_factors):
+                    system.set_item_in_cache(scaling_factor, cache_ref, ALL_KEYNAME, rule_name)
+
+            return system.get_item_from_cache(cache_ref, ALL_KEYNAME, rule_variation_name)
+
         ## Get some useful stuff from the config
         forecast_scalar_config=copy(self.parent.config.forecast_scalar_estimate)
 
@@ -400,6 +477,14 @@ class ForecastScaleCapEstimated(ForecastScaleCapFixed):
             instrument_code_key=ALL_KEYNAME
             instrument_list=self.parent.get_instrument_list()
 
+            if scalarfunction is default_scalar_function:
+                ## can do every rule at once, which is much quicker
+                forecast_scalar_value = self.parent.calc_or_cache_nested(
+                        "get_forecast_scalar", instrument_code_key, rule_variation_name,
+                        _get_pooled_forecast_scalars_all_rules, self, instrument_list, forecast_scalar_config)
+
+                return forecast_scalar_value
+
         else:
             ## not pooled
             instrument_code_key=instrument_code
@@ -0,0 +1,415 @@
+"""
+Research tools for exploring the parameters of a trading rule
+
+Building a rule variation for every set of parameters and running the whole
+system for each one is far too slow for a large grid. Instead we evaluate the
+whole grid at once: data is fetched once per instrument, rules with a grid
+version (eg ewmac) reuse intermediate calculations across all the
+parameters, and forecast scaling, capping and p&l are done with arrays
+covering many parameter sets at the same time.
+
+The p&l is the same as system.accounts.pandl_for_instrument_forecast: positions
+from capped forecasts and volatility with an arbitrary capital, costs in Sharpe
+Ratio units from forecast turnover.
+"""
+import itertools
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from syscore.accounting import DEFAULT_ANN_RISK_TARGET
+from syscore.dateutils import BUSINESS_DAYS_IN_YEAR, ROOT_BDAYS_INYEAR
+from syscore.genutils import str2Bool
+from syscore.objects import resolve_data_method
+from systems.account import ARBITRARY_FORECAST_CAPITAL
+from systems.defaults import system_defaults
+from systems.forecasting import TradingRule, DEFAULT_PRICE_SOURCE
+from systems.provided.futures_chapter15.rules import ewmac
+
+
+def ewmac_grid(price, vol, param_list):
+    """
+    ewmac forecasts for many pairs of speeds; each EWMA is only calculated once
+
+    :param price: The price or other series to use (assumed Tx1)
+    :type price: pd.Series
+
+    :param vol: The daily price unit volatility (NOT % vol)
+    :type vol: pd.Series aligned to price
+
+    :param param_list: Each element is a set of arguments for ewmac
+    :type param_list: list of dicts, with keys Lfast, Lslow
+
+    :returns: TxP pd.DataFrame, one column per element of param_list
+    """
+    spans = set([params['Lfast'] for params in param_list] +
+                [params['Lslow'] for params in param_list])
+    ewmas = dict([(span, pd.ewma(price, span=span).values) for span in spans])
+    vol_values = vol.ffill().values
+
+    forecasts = np.column_stack([
+        (ewmas[params['Lfast']] - ewmas[params['Lslow']]) / vol_values
+        for params in param_list])
+
+    return pd.DataFrame(forecasts, index=price.index)
+
+
+"""
+Rule functions which have a grid version. The grid version takes the same data
+as the rule, plus a list of argument dicts, and returns a TxP data frame
+"""
+GRID_RULE_FUNCTIONS = {ewmac: ewmac_grid}
+
+
+def trading_rule_grid_search(system, rule, param_grid, instrument_list=None,
+                             delayfill=True, combinations_per_chunk=100):
+    """
+    Evaluate a trading rule over every combination of a parameter grid
+
+    :param system: system containing the data, and optionally rawdata and accounts stages
+    :type system: systems.basesystem.System
+
+    :param rule: Trading rule; any form accepted by TradingRule. Fixed
+                 arguments come from the rule's other_args
+    :type rule: TradingRule, function, str, tuple or dict
+
+    :param param_grid: values to try for each parameter
+    :type param_grid: dict of lists, eg dict(Lfast=[2,4,8], Lslow=[32,64])
+
+    :param instrument_list: instruments to use (*default* system.get_instrument_list())
+    :type instrument_list: list of str or None
+
+    :param delayfill: Lag fills by one day
+    :type delayfill: bool
+
+    :param combinations_per_chunk: parameter sets evaluated together; bounds memory use
+    :type combinations_per_chunk: int
+
+    :returns: pd.DataFrame with one row per (parameters, instrument); columns
+              are the parameters, instrument, sharpe, gross_sharpe, turnover and SR_cost
+    """
+    rule = TradingRule(rule)
+
+    if instrument_list is None:
+        instrument_list = system.get_instrument_list()
+
+    param_names = sorted(param_grid.keys())
+    param_list = []
+    for param_values in itertools.product(*[param_grid[param_name] for param_name in param_names]):
+        params = dict(rule.other_args)
+        params.update(dict(zip(param_names, param_values)))
+        param_list.append(params)
+
+    system.log.terse("Grid search over %d parameter sets for %d instruments" %
+                     (len(param_list), len(instrument_list)))
+
+    inputs = dict([(instrument_code, _get_instrument_inputs(system, rule, instrument_code))
+                   for instrument_code in instrument_list])
+
+    results = []
+    for chunk_start in range(0, len(param_list), combinations_per_chunk):
+        param_chunk = param_list[chunk_start:chunk_start + combinations_per_chunk]
+        chunk_results = _evaluate_param_chunk(
+            system, rule, param_chunk, instrument_list, inputs, delayfill)
+
+        for (params, param_results) in zip(param_chunk, chunk_results):
+            for (instrument_code, stats) in zip(instrument_list, param_results):
+                row = [params[param_name] for param_name in param_names]
+                results.append(row + [instrument_code] + stats)
+
+    columns = param_names + ["instrument",
+                             "sharpe", "gross_sharpe", "turnover", "SR_cost"]
+
+    return pd.DataFrame(results, columns=columns)
+
+
+def _get_instrument_inputs(system, rule, instrument_code):
+    """
+    Get everything that doesn't depend on the parameters, once per instrument
+
+    :returns: dict with rule data, price, vol and SR cost per unit of turnover
+    """
+    datalist = rule.data
+    if len(datalist) == 0:
+        datalist = [DEFAULT_PRICE_SOURCE]
+
+    rule_data = [resolve_data_method(system, data_string)(instrument_code)
+                 for data_string in datalist]
+
+    if hasattr(system, "accounts"):
+        price = system.accounts.get_daily_price(instrument_code)
+        vol = system.accounts.get_daily_returns_volatility(instrument_code)
+        SR_cost_per_turnover = system.accounts.get_SR_cost(instrument_code)
+    else:
+        if hasattr(system, "rawdata"):
+            price = system.rawdata.get_daily_prices(instrument_code)
+        else:
+            price = system.data.daily_prices(instrument_code)
+        vol = system.get_daily_returns_volatility(instrument_code)
+        SR_cost_per_turnover = 0.0
+
+    return dict(rule_data=rule_data, price=price, vol=vol,
+                SR_cost_per_turnover=SR_cost_per_turnover)
+
+
+def _evaluate_param_chunk(system, rule, param_chunk, instrument_list, inputs, delayfill):
+    """
+    Scale, cap and work out p&l statistics for a chunk of parameter sets
+
+    :returns: list (one per parameter set) of lists (one per instrument) of stats
+    """
+    grid_function = GRID_RULE_FUNCTIONS.get(rule.function, None)
+
+    raw_forecasts = []
+    for instrument_code in instrument_list:
+        rule_data = inputs[instrument_code]['rule_data']
+        if grid_function is None:
+            forecasts = pd.concat([rule.function(*rule_data, **params)
+                                   for params in param_chunk], axis=1)
+            forecasts.columns = range(len(param_chunk))
+        else:
+            forecasts = grid_function(*rule_data, param_list=param_chunk)
+        raw_forecasts.append(forecasts)
+
+    scalars = _forecast_scalars(system, raw_forecasts)
+    forecast_cap = system.config.forecast_cap
+
+    capped_forecasts = []
+    turnovers = []
+    for (raw_forecast, scalar) in zip(raw_forecasts, scalars):
+        capped = np.clip(raw_forecast.values * scalar, -forecast_cap, forecast_cap)
+        capped_forecasts.append(pd.DataFrame(capped, index=raw_forecast.index))
+        turnovers.append(_turnover(capped))
+
+    use_pooled_turnover = str2Bool(
+        system.config.forecast_cost_estimates['use_pooled_turnover'])
+    forecast_lengths = _forecast_lengths(system, raw_forecasts)
+    if use_pooled_turnover:
+        # weight by length
+        pooled_turnover = np.sum(np.vstack(turnovers) *
+                                 forecast_lengths[:, np.newaxis], axis=0) / forecast_lengths.sum()
+        turnovers = [pooled_turnover] * len(capped_forecasts)
+
+    SR_costs = [turnover * inputs[instrument_code]['SR_cost_per_turnover']
+                for (instrument_code, turnover) in zip(instrument_list, turnovers)]
+
+    use_pooled_costs = str2Bool(
+        system.config.forecast_cost_estimates['use_pooled_costs'])
+    if use_pooled_costs:
+        # as accounts.get_SR_cost_instr_forecast_for_list; weight by length
+        pooled_SR_cost = np.sum(np.vstack(SR_costs) *
+                                forecast_lengths[:, np.newaxis], axis=0) / forecast_lengths.sum()
+        SR_costs = [pooled_SR_cost] * len(capped_forecasts)
+
+    chunk_stats = []
+    for (instrument_code, capped, turnover, SR_cost) in zip(instrument_list, capped_forecasts,
+                                                            turnovers, SR_costs):
+        instrument_inputs = inputs[instrument_code]
+        (sharpe, gross_sharpe) = _forecast_pandl_sharpe(
+            instrument_inputs['price'], instrument_inputs['vol'], capped, SR_cost, delayfill)
+
+        chunk_stats.append([list(stats) for stats in zip(sharpe, gross_sharpe, turnover, SR_cost)])
+
+    # transpose so we have parameter sets first, then instruments
+    return [list(param_stats) for param_stats in zip(*chunk_stats)]
+
+
+def _forecast_scalars(system, raw_forecasts):
+    """
+    Forecast scalars for many parameter sets, the same as syscore.algos.forecast_scalar
+
+    :returns: list of TxP np.arrays, one per instrument aligned to its forecasts
+    """
+    scalar_config = system.config.forecast_scalar_estimate
+    pool_instruments = str2Bool(scalar_config['pool_instruments'])
+    window = scalar_config.get('window', 250000)
+    min_periods = scalar_config.get('min_periods', 500)
+    backfill = str2Bool(scalar_config.get('backfill', True))
+
+    if not pool_instruments or len(raw_forecasts) == 1:
+        return [_scalar_from_abs_forecast(np.abs(forecast.values), window, min_periods, backfill)
+                for forecast in raw_forecasts]
+
+    # pool: cross sectional median of forward filled forecasts
+    all_index = raw_forecasts[0].index
+    for forecast in raw_forecasts[1:]:
+        all_index = all_index.union(forecast.index)
+
+    stacked = np.dstack([_ffill_array(forecast.reindex(all_index).values)
+                         for forecast in raw_forecasts])
+    with warnings.catch_warnings():
+        # all nan slices are expected before any forecasts exist
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        cs_median = np.nanmedian(np.abs(stacked), axis=2)
+
+    pooled_scalar = _scalar_from_abs_forecast(
+        cs_median, window, min_periods, backfill)
+
+    return [pooled_scalar[all_index.get_indexer(forecast.index), :]
+            for forecast in raw_forecasts]
+
+
+def _forecast_lengths(system, raw_forecasts):
+    """
+    Length of each capped forecast as the system has it, for weighting pooled turnovers and costs
+
+    With pooled forecast scalars the system's capped forecasts are all on the
+    joint index of every instrument, so they have the same length
+
+    :returns: np.array, one per instrument
+    """
+    pool_instruments = str2Bool(
+        system.config.forecast_scalar_estimate['pool_instruments'])
+
+    if not pool_instruments or len(raw_forecasts) == 1:
+        return np.array([float(len(forecast.index)) for forecast in raw_forecasts])
+
+    all_index = raw_forecasts[0].index
+    for forecast in raw_forecasts[1:]:
+        all_index = all_index.union(forecast.index)
+
+    return np.array([float(len(all_index))] * len(raw_forecasts))
+
+
+def _scalar_from_abs_forecast(abs_forecast, window, min_periods, backfill):
+    """
+    Rolling mean of absolute forecasts in each column, turned into a scalar
+    """
+    target_abs_forecast = system_defaults['average_absolute_forecast']
+
+    not_nan = ~np.isnan(abs_forecast)
+    cum_count = np.cumsum(not_nan, axis=0)
+    cum_sum = np.cumsum(np.where(not_nan, abs_forecast, 0.0), axis=0)
+
+    if window < abs_forecast.shape[0]:
+        cum_count[window:] = cum_count[window:] - cum_count[:-window]
+        cum_sum[window:] = cum_sum[window:] - cum_sum[:-window]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        avg_abs_value = cum_sum / cum_count
+        scaling_factor = target_abs_forecast / avg_abs_value
+
+    scaling_factor[cum_count < max(min_periods, 1)] = np.nan
+
+    if backfill:
+        scaling_factor = _ffill_array(scaling_factor[::-1])[::-1]
+
+    return scaling_factor
+
+
+def _turnover(capped_forecast):
+    """
+    Annualised turnover of each column, normalised by the average absolute forecast
+
+    Same as syscore.pdutils.turnover for a daily forecast
+    """
+    average_forecast_for_turnover = system_defaults['average_absolute_forecast']
+    normalised_changes = np.abs(
+        np.diff(capped_forecast / average_forecast_for_turnover, axis=0))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        avg_daily = np.nanmean(normalised_changes, axis=0)
+
+    return avg_daily * BUSINESS_DAYS_IN_YEAR
+
+
+def _forecast_pandl_sharpe(price, vol, capped_forecast, SR_cost, delayfill):
+    """
+    Net and gross Sharpe ratios of trading each forecast column, as pandl_with_data would
+
+    :param price: daily price
+    :type price: Tx1 pd.Series
+
+    :param vol: daily returns volatility aligned to price
+    :type vol: Tx1 pd.Series
+
+    :param capped_forecast: capped forecasts
+    :type capped_forecast: TxP pd.DataFrame
+
+    :param SR_cost: annual cost of each forecast in SR units
+    :type SR_cost: np.array length P
+
+    :returns: 2 tuple of np.arrays length P
+    """
+    forecast = _ffill_array(capped_forecast.reindex(price.index).values)
+    price_values = price.values
+    vol_values = _ffill_array(vol.reindex(price.index).values[:, np.newaxis])
+
+    daily_risk_capital = ARBITRARY_FORECAST_CAPITAL * \
+        DEFAULT_ANN_RISK_TARGET / ROOT_BDAYS_INYEAR
+    multiplier = daily_risk_capital / 10.0
+
+    positions = (forecast * multiplier) / vol_values
+    if delayfill:
+        positions = _shift_array(positions)
+
+    cum_trades = _ffill_array(positions)
+    price_returns = np.diff(price_values, axis=0)
+    price_returns = np.concatenate([[np.nan], price_returns])
+
+    returns = _shift_array(cum_trades) * price_returns[:, np.newaxis]
+    returns = _match_cumsum_diff(returns)
+
+    # costs are negative returns, spread evenly over the year
+    ann_risk = ARBITRARY_FORECAST_CAPITAL * DEFAULT_ANN_RISK_TARGET
+    daily_costs = -SR_cost * ann_risk / BUSINESS_DAYS_IN_YEAR
+    costs = np.tile(daily_costs, (len(price_values), 1))
+    costs[0, :] = 0.0
+
+    net_returns = returns + costs
+
+    return (_sharpe(net_returns), _sharpe(returns))
+
+
+def _sharpe(returns):
+    """
+    Annualised Sharpe ratio of each column of daily returns, ignoring nans
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        mean_return = np.nanmean(returns, axis=0) * BUSINESS_DAYS_IN_YEAR
+        not_nan = np.sum(~np.isnan(returns), axis=0)
+        demeaned = returns - np.nanmean(returns, axis=0)
+        variance = np.nansum(demeaned ** 2, axis=0) / (not_nan - 1.0)
+        vol = np.sqrt(variance) * ROOT_BDAYS_INYEAR
+
+        return mean_return / vol
+
+
+def _ffill_array(x):
+    """
+    Forward fill each column of a 2d array
+    """
+    row_index = np.where(np.isnan(x), 0, np.arange(x.shape[0])[:, np.newaxis])
+    row_index = np.maximum.accumulate(row_index, axis=0)
+
+    return x[row_index, np.arange(x.shape[1])]
+
+
+def _shift_array(x):
+    """
+    Shift each column of a 2d array down one row, like pd.DataFrame.shift(1)
+    """
+    shifted = np.empty(x.shape)
+    shifted[0, :] = np.nan
+    shifted[1:, :] = x[:-1, :]
+
+    return shifted
+
+
+def _match_cumsum_diff(returns):
+    """
+    pandl_with_data does returns.cumsum().ffill().diff(); this zeros nans after
+    the first valid value, and loses the first valid value itself
+    """
+    valid = ~np.isnan(returns)
+    started = np.logical_or.accumulate(valid, axis=0)
+    first_valid = started & ~np.vstack([np.zeros((1, returns.shape[1]), dtype=bool),
+                                        started[:-1, :]])
+
+    returns = np.where(started & ~valid, 0.0, returns)
+    returns[first_valid] = np.nan
+
+    return returns
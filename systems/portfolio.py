@@ -5,7 +5,7 @@ from syscore.accounting import decompose_group_pandl
 
 from systems.stage import SystemStage
 from systems.basesystem import ALL_KEYNAME
-from syscore.pdutils import  fix_weights_vs_pdm
+from syscore.pdutils import  fix_weights_vs_pdm, fixed_step_weights
 from syscore.objects import update_recalc, resolve_function
 from syscore.genutils import str2Bool
 
@@ -75,7 +75,8 @@ class PortfoliosFixed(SystemStage):
 
         """
         protected = ["get_instrument_weights",
-                     "get_instrument_diversification_multiplier", "get_raw_instrument_weights"]
+                     "get_instrument_diversification_multiplier", "get_raw_instrument_weights",
+                     "_raw_instrument_weights_to_combine"]
 
         setattr(self, "_protected", protected)
 
@@ -167,6 +168,22 @@ class PortfoliosFixed(SystemStage):
 
         """
         def _get_raw_instrument_weights(system, an_ignored_variable, this_stage):
+            # daily, covering the range of subsystem position dates
+            return this_stage._raw_instrument_weights_to_combine().as_df()
+
+        instrument_weights = self.parent.calc_or_cache(
+            "get_raw_instrument_weights", ALL_KEYNAME, _get_raw_instrument_weights, self)
+        return instrument_weights
+
+    def _raw_instrument_weights_to_combine(self):
+        """
+        The raw instrument weights that get_instrument_weights uses
+
+        Fixed weights are kept as stepWeights, and only expanded over the subsystem position dates in fix_weights_vs_pdm
+
+        :returns: stepWeights, columns are instrument names
+        """
+        def _get_raw_instrument_step_weights(system, an_ignored_variable, this_stage):
             this_stage.log.msg("Calculating raw instrument weights")
 
             try:
@@ -183,8 +200,8 @@ class PortfoliosFixed(SystemStage):
                     [(instrument_code, weight) for instrument_code in instruments])
 
             # Now we have a dict, fixed_weights.
-            # Need to turn into a timeseries covering the range of forecast
-            # dates
+            # These only need to start when the first subsystem position does;
+            # they're expanded over the position dates later
             instrument_list = sorted(instrument_weights.keys())
 
             subsys_ts = [
@@ -194,22 +211,13 @@ class PortfoliosFixed(SystemStage):
             earliest_date = min([min(fts) for fts in subsys_ts])
             latest_date = max([max(fts) for fts in subsys_ts])
 
-            # this will be daily, but will be resampled later
-            weight_ts = pd.date_range(start=earliest_date, end=latest_date)
-
-            instrument_weights_weights = dict([
-                (instrument_code, pd.Series([instrument_weights[
-                 instrument_code]] * len(weight_ts), index=weight_ts))
-                for instrument_code in instrument_list])
-
-            instrument_weights_weights = pd.concat(
-                instrument_weights_weights, axis=1)
-            instrument_weights_weights.columns = instrument_list
+            instrument_weights_weights = fixed_step_weights(
+                instrument_weights, earliest_date, latest_date)
 
             return instrument_weights_weights
 
         instrument_weights = self.parent.calc_or_cache(
-            "get_raw_instrument_weights", ALL_KEYNAME, _get_raw_instrument_weights, self)
+            "_raw_instrument_weights_to_combine", ALL_KEYNAME, _get_raw_instrument_step_weights, self)
         return instrument_weights
 
     def get_instrument_weights(self):
@@ -225,7 +233,7 @@ class PortfoliosFixed(SystemStage):
 
             this_stage.log.terse("Calculating instrument weights")
 
-            raw_instr_weights = this_stage.get_raw_instrument_weights()
+            raw_instr_weights = this_stage._raw_instrument_weights_to_combine()
             instrument_list = list(raw_instr_weights.columns)
 
             subsys_positions = [this_stage.get_subsystem_position(instrument_code)
@@ -719,6 +727,10 @@ class PortfoliosEstimated(PortfoliosFixed):
             self)
         return instrument_div_multiplier
 
+    def _raw_instrument_weights_to_combine(self):
+        ## estimated weights are already only indexed on the fitting dates
+        return self.get_raw_instrument_weights()
+
     def get_raw_instrument_weights(self):
         """
         Estimate the instrument weights 
@@ -2,7 +2,6 @@ from systems.defaults import system_defaults
 from systems.stage import SystemStage
 from systems.basesystem import ALL_KEYNAME
 from syscore.dateutils import ROOT_BDAYS_INYEAR
-from syscore.algos import robust_vol_calc
 
 
 class PositionSizing(SystemStage):
@@ -112,7 +111,7 @@ class PositionSizing(SystemStage):
                     instrument_code)
             else:
                 price = system.data.daily_prices(instrument_code)
-                return_vol = robust_vol_calc(price.diff())
+                return_vol = system.get_daily_returns_volatility(instrument_code)
                 daily_perc_vol = 100.0 * return_vol / price
 
             return daily_perc_vol
@@ -1,7 +1,4 @@
 from systems.stage import SystemStage
-from copy import copy
-
-from syscore.objects import resolve_function
 
 
 class RawData(SystemStage):
@@ -130,7 +127,8 @@ class RawData(SystemStage):
         """
         Gets volatility of daily returns (not % returns)
 
-        This is done using a user defined function
+        This is done using a user defined function, and cached by the system so
+        other stages asking for the same volatility share it
 
         We get this from:
           the configuration object
@@ -172,23 +170,9 @@ class RawData(SystemStage):
         2015-12-11  0.058626
 
         """
-        def _daily_returns_volatility(system, instrument_code, this_stage):
-            this_stage.log.msg("Calculating daily volatility for %s" % instrument_code, instrument_code=instrument_code)
-
-            dailyreturns = this_stage.daily_returns(instrument_code)
-
-            volconfig=copy(system.config.volatility_calculation)
-
-            # volconfig contains 'func' and some other arguments
-            # we turn func which could be a string into a function, and then
-            # call it with the other ags
-            volfunction = resolve_function(volconfig.pop('func'))
-            vol = volfunction(dailyreturns, **volconfig)
-
-            return vol
+        volconfig = self.parent.config.volatility_calculation
 
-        vol = self.parent.calc_or_cache(
-            "daily_returns_volatility", instrument_code, _daily_returns_volatility, self)
+        vol = self.parent.get_daily_returns_volatility(instrument_code, volconfig)
 
         return vol
 
@@ -0,0 +1,42 @@
+'''
+Check the grid search gives the same answers as the system
+'''
+import unittest
+
+from sysdata.configdata import Config
+from systems.gridsearch import trading_rule_grid_search
+from systems.provided.futures_chapter15.basesystem import futures_system
+from systems.provided.futures_chapter15.rules import ewmac
+
+
+class Test(unittest.TestCase):
+
+    def test_grid_matches_system(self):
+        self._check_grid_matches_system()
+
+    def test_grid_matches_system_pooled_costs(self):
+        self._check_grid_matches_system(use_pooled_costs=True)
+
+    def _check_grid_matches_system(self, use_pooled_costs=False):
+        rule = (ewmac, ["rawdata.get_daily_prices", "rawdata.daily_returns_volatility"], dict(Lfast=8, Lslow=32))
+
+        config = Config("systems.provided.futures_chapter15.futuresconfig.yaml")
+        config.use_forecast_scale_estimates = True
+        config.forecast_cost_estimates = dict(use_pooled_costs=use_pooled_costs)
+        system = futures_system(config=config, trading_rules=dict(ewmac8_32=rule), log_level="off")
+
+        results = trading_rule_grid_search(system, rule, dict(Lfast=[4, 8], Lslow=[32, 64]))
+        self.assertEqual(len(results.index), 4 * len(system.get_instrument_list()))
+
+        for instrument_code in system.get_instrument_list():
+            row = results[(results.Lfast == 8) & (results.Lslow == 32) &
+                          (results.instrument == instrument_code)].iloc[0]
+            pandl = system.accounts.pandl_for_instrument_forecast(instrument_code, "ewmac8_32")
+
+            self.assertAlmostEqual(row.sharpe, pandl.sharpe(), 6)
+            self.assertAlmostEqual(row.gross_sharpe, pandl.gross.sharpe(), 6)
+            self.assertAlmostEqual(row.SR_cost, system.accounts.get_SR_cost_for_instrument_forecast(instrument_code, "ewmac8_32"), 6)
+
+
+if __name__ == "__main__":
+    unittest.main()